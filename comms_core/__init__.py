@@ -1,5 +1,17 @@
 from .logger import Logger
+from .send_queue import PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK
 from .server import Server
 from .client import Client
-from .csm import CustomSocketMessage
-from .data_interface import Interface
\ No newline at end of file
+from .csm import CustomSocketMessage, CSMDecoder, CSMDecodeError
+from .data_interface import Interface
+from .history import History
+from .codec import BinaryMessage
+from .schema import Schema
+from .interface_sync import InterfaceSender, InterfaceReceiver
+from .udp import UDPChannel
+from .metrics import MetricsExporter
+from .recorder import FlightRecorder, FlightLog, Replayer
+from .rpc import RPCError
+from .selector_server import SelectorServer
+from .async_server import AsyncServer
+from .async_client import AsyncClient
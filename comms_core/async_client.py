@@ -0,0 +1,183 @@
+import socket
+import asyncio
+import inspect
+from typing import Callable, Dict, Union
+
+from .logger import Logger
+from .framing import ChunkAssembler, FrameError, FLAG_CONTROL, pack_frame, unpack_message, read_frame
+from .handshake import build_handshake, check_wire_format, control_frame
+from .csm import CustomSocketMessage
+from .data_interface import Interface
+from .send_queue import SendQueue
+
+_STOP = object()
+
+class AsyncClient(Logger):
+    '''
+    asyncio version of Client. Incoming messages are passed to the callback (plain function
+    or coroutine function) and can also be consumed with `async for data in client`.
+    '''
+
+    def __init__(self, server_address : str, *, callback : Callable = None, port = 37564, TD=False, wire_format = 'text', max_messages = 1024,
+                 queue_size = 1024, queue_policy = 'drop_oldest') -> None:
+        super().__init__('AsyncClient')
+        if server_address == 'debug':
+            server_address = socket.gethostname()
+        self.server_address = (server_address, port)
+        self.callback = callback
+        self.TD = TD
+        # Format used when send() is given a dict or Interface, announced to the server in the handshake
+        self.wire_format = check_wire_format(wire_format)
+
+        self.reader : asyncio.StreamReader = None
+        self.writer : asyncio.StreamWriter = None
+        self.init = False
+        self.data = None
+
+        self.active = False
+        self.run_task : asyncio.Task = None
+        # Messages sent while disconnected, never blocks the event loop
+        self.send_queue = SendQueue(queue_size, queue_policy)
+        # Oldest messages are dropped if nobody is iterating over the client
+        self.messages = asyncio.Queue(max_messages)
+        # topic -> callback (None to use the default callback), sent again on every reconnect
+        self.subscriptions : Dict[str, Callable] = {}
+        self.topic_data : Dict[str, Union[str, bytes]] = {}
+
+    async def _init_connection(self):
+        try:
+            self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.server_address), timeout=5)
+            self.init = True
+            self.log(f'Connected to {self.server_address}')
+            return True
+        except asyncio.TimeoutError:
+            return False
+        except ConnectionRefusedError:
+            self.warning(f'Connection refused by {self.server_address}')
+            return False
+        except Exception as e:
+            return False
+
+    async def _run(self):
+        while self.active:
+            if not await self._init_connection():
+                await asyncio.sleep(5)
+                continue
+            try:
+                if not self.TD:
+                    self.writer.write(pack_frame(build_handshake(socket.gethostname(), format=self.wire_format)))
+                    for topic in list(self.subscriptions):
+                        self._write(pack_frame(control_frame('subscribe', topic)))
+                await self._flush()
+                await self._receive()
+            except (asyncio.IncompleteReadError, ConnectionError, FrameError) as e:
+                self.warning(f'Lost connection to {self.server_address}')
+                self.warning(e)
+            finally:
+                self.init = False
+                self.writer.close()
+
+    async def _receive(self):
+        # Threaded servers write bulk messages in pieces
+        assembler = ChunkAssembler()
+        while self.active:
+            frame = assembler.add(*await read_frame(self.reader))
+            if frame is None:
+                continue
+            payload, flags = frame
+            if flags & FLAG_CONTROL:
+                continue
+            data, topic = unpack_message(payload, flags)
+            self.message('Received: %s from %s', self.payload(data), self.server_address)
+            callback = self.callback
+            if topic is None:
+                self.data = data
+            else:
+                self.topic_data[topic] = data
+                callback = self.subscriptions.get(topic) or callback
+            if callback is not None:
+                result = callback(data, self.server_address)
+                if inspect.isawaitable(result):
+                    await result
+            self._put_message(data)
+
+    def _put_message(self, data):
+        if self.messages.full():
+            self.messages.get_nowait()
+        self.messages.put_nowait(data)
+
+    async def _flush(self):
+        for data in self.send_queue.get_all():
+            self._write(pack_frame(data))
+            self.message('Sent: %s to %s', self.payload(data), self.server_address)
+        await self.writer.drain()
+
+    def _write(self, frame : Union[bytes, list]):
+        if isinstance(frame, list):
+            self.writer.writelines(frame)
+        else:
+            self.writer.write(frame)
+
+    async def start(self):
+        self.active = True
+        self.run_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.log("Shutting down client")
+        self.active = False
+        if self.run_task is not None:
+            self.run_task.cancel()
+            try:
+                await self.run_task
+            except asyncio.CancelledError:
+                pass
+        self._put_message(_STOP)
+
+    async def send(self, data : Union[str, bytes, dict, Interface], *, key = None) -> bool:
+        '''
+        Send immediately if connected, otherwise queue until the connection is made.
+        Returns False if the message could not be queued.
+        '''
+        if isinstance(data, (dict, Interface)):
+            data = CustomSocketMessage.encode_for_wire(data, self.wire_format)
+        if not self.init:
+            return self.send_queue.put(data, key=key, block=False)
+        try:
+            self._write(pack_frame(data))
+            self.message('Sent: %s to %s', self.payload(data), self.server_address)
+            await self.writer.drain()
+        except ConnectionError:
+            self.init = False
+            return False
+        return True
+
+    def queue_depth(self) -> int:
+        return len(self.send_queue)
+
+    def get_data(self, topic : str = None) -> Union[str, bytes]:
+        '''Latest direct message, or latest message published on a topic'''
+        if topic is not None:
+            return self.topic_data.get(topic)
+        return self.data
+
+    async def subscribe(self, topic : str, callback : Callable = None):
+        '''
+        Receive what the server publishes on a topic. Messages go to `callback` if given,
+        otherwise to the default callback. Subscriptions are kept across reconnects.
+        '''
+        self.subscriptions[topic] = callback
+        if self.init:
+            await self.send(control_frame('subscribe', topic))
+
+    async def unsubscribe(self, topic : str):
+        if self.subscriptions.pop(topic, False) is not False and self.init:
+            await self.send(control_frame('unsubscribe', topic))
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Union[str, bytes]:
+        data = await self.messages.get()
+        if data is _STOP:
+            raise StopAsyncIteration
+        return data
@@ -0,0 +1,207 @@
+import asyncio
+import inspect
+from typing import Dict, Callable, List, Union, Tuple
+
+from .logger import Logger
+from .framing import ChunkAssembler, FrameError, Frame, FLAG_CONTROL, pack_frame, unpack_message, read_frame
+from .handshake import is_handshake, parse_handshake, parse_control, control_frame
+from .csm import CustomSocketMessage
+from .data_interface import Interface
+
+_STOP = object()
+
+class AsyncServer(Logger):
+    '''
+    asyncio version of Server with the same send/get_data/set_callback API.
+    Incoming messages can also be consumed with `async for data, addr in server`.
+    '''
+
+    def __init__(self, *, default_callback: Callable = None, port = 37564, max_messages = 1024):
+        super().__init__('AsyncServer')
+        self.local_server_address = ('0.0.0.0', port)
+        self.default_callback = default_callback
+
+        self.server : asyncio.AbstractServer = None
+        self.connections: Dict[tuple, Dict] = {}
+        # topic -> subscribed addresses (dicts used as ordered sets)
+        self.topics: Dict[str, Dict[tuple, None]] = {}
+        self.active = False
+        # Oldest messages are dropped if nobody is iterating over the server
+        self.messages = asyncio.Queue(max_messages)
+
+    async def start(self):
+        self.active = True
+        self.server = await asyncio.start_server(self._handle_client, *self.local_server_address, reuse_address=True)
+
+    async def stop(self):
+        self.log("Shutting down server")
+        self.active = False
+        if self.server is not None:
+            self.server.close()
+        for addr, info in list(self.connections.items()):
+            info['task'].cancel()
+            info['writer'].close()
+        self.connections.clear()
+        self.topics.clear()
+        if self.server is not None:
+            await self.server.wait_closed()
+        self._put_message(_STOP)
+
+    def _kill_client(self, addr):
+        self.warning(f'Lost connection to {addr}')
+        if addr not in self.connections:
+            return
+        info = self.connections.pop(addr)
+        info['writer'].close()
+        for topic in info['topics']:
+            self._unsubscribe(addr, topic)
+
+    def _unsubscribe(self, addr, topic : str):
+        addresses = self.topics.get(topic)
+        if addresses is not None:
+            addresses.pop(addr, None)
+            if not addresses:
+                del self.topics[topic]
+
+    def _on_control(self, addr, command : str, argument : str):
+        if command == 'subscribe':
+            self.topics.setdefault(argument, {})[addr] = None
+            self.connections[addr]['topics'].add(argument)
+        elif command == 'unsubscribe':
+            self._unsubscribe(addr, argument)
+            self.connections[addr]['topics'].discard(argument)
+        else:
+            self.warning(f'Unknown control message {command!r} from {addr}')
+
+    @staticmethod
+    def _is_handshake(data : Union[str, bytes]) -> bool:
+        return is_handshake(data)
+
+    def _on_handshake(self, addr, data : str):
+        hostname, options = parse_handshake(data)
+        if options.get('format') == 'binary':
+            self.connections[addr]['wire_format'] = 'binary'
+        if 'session' in options:
+            # Sessions are not resumed by this server, the client stops waiting for a resume and sends
+            self.connections[addr]['writer'].writelines(pack_frame(control_frame('session', 'none')))
+        self.log(f'Handshake from {hostname} at {addr}: {options}')
+
+    async def _handle_client(self, reader : asyncio.StreamReader, writer : asyncio.StreamWriter):
+        addr = writer.get_extra_info('peername')[:2]
+        self.connections[addr] = {
+            'reader': reader,
+            'writer': writer,
+            'ip': addr[0],
+            'callback': self.default_callback,
+            'data': None,
+            'wire_format': 'text',
+            'topics': set(),
+            'task': asyncio.current_task(),
+        }
+        self.log(f'Connected to {addr}')
+        # Threaded clients write bulk messages in pieces
+        assembler = ChunkAssembler()
+        # Only the first data frame of a connection can be its handshake
+        first_frame = True
+        try:
+            while self.active:
+                frame = assembler.add(*await read_frame(reader))
+                if frame is None:
+                    continue
+                payload, flags = frame
+                if flags & FLAG_CONTROL:
+                    self._on_control(addr, *parse_control(payload))
+                    continue
+                data, _ = unpack_message(payload, flags)
+                self.message('Received: %s from %s', self.payload(data), addr)
+                handshake = first_frame and self._is_handshake(data)
+                first_frame = False
+                if handshake:
+                    self._on_handshake(addr, data)
+                    continue
+                self.connections[addr]['data'] = data
+                callback = self.connections[addr]['callback']
+                if callback:
+                    result = callback(data, addr)
+                    if inspect.isawaitable(result):
+                        await result
+                self._put_message((data, addr))
+        except (asyncio.IncompleteReadError, ConnectionError, FrameError):
+            self._kill_client(addr)
+        except asyncio.CancelledError:
+            # Cancelled by stop()
+            pass
+
+    def _put_message(self, item):
+        if self.messages.full():
+            self.messages.get_nowait()
+        self.messages.put_nowait(item)
+
+    async def _send_data(self, addr, data : Union[str, bytes, dict, Interface]):
+        await self._send_frames(self._frames_for([addr], data))
+
+    def _frames_for(self, targets : List[tuple], data : Union[str, bytes, dict, Interface], topic : str = None) -> List[Tuple[tuple, list]]:
+        # Encoded and framed once per wire format, the buffers are shared between the targets
+        frames : Dict[str, list] = {}
+        queued = []
+        for addr in targets:
+            wire_format = self.connections[addr]['wire_format']
+            if wire_format not in frames:
+                payload = data
+                if isinstance(data, (dict, Interface)):
+                    payload = CustomSocketMessage.encode_for_wire(data, wire_format)
+                frames[wire_format] = pack_frame(Frame(payload, topic=topic))
+            queued.append((addr, frames[wire_format]))
+        return queued
+
+    async def _send_frames(self, queued : List[Tuple[tuple, list]]) -> int:
+        sent = 0
+        for addr, frame in queued:
+            if addr not in self.connections:
+                continue
+            writer : asyncio.StreamWriter = self.connections[addr]['writer']
+            try:
+                writer.writelines(frame)
+                await writer.drain()
+                sent += 1
+            except ConnectionError:
+                self._kill_client(addr)
+        return sent
+
+    async def publish(self, topic : str, data : Union[str, bytes, dict, Interface]) -> int:
+        '''Send to every client subscribed to the topic, returns the number of subscribers it was sent to'''
+        return await self._send_frames(self._frames_for(list(self.topics.get(topic, ())), data, topic))
+
+    async def broadcast(self, data : Union[str, bytes, dict, Interface]) -> int:
+        return await self._send_frames(self._frames_for(list(self.connections), data))
+
+    async def send(self, data: Union[str, bytes, dict, Interface], addr : Union[tuple, str] = None):
+        if addr is None:
+            if len(self.connections) == 0:
+                return
+            addr = next(iter(self.connections))
+        if isinstance(addr, tuple):
+            if addr in self.connections:
+                await self._send_data(addr, data)
+        if isinstance(addr, str):
+            for address in [address for address, info in self.connections.items() if info['ip'] == addr]:
+                await self._send_data(address, data)
+
+    def set_callback(self, addr, callback: Callable):
+        if addr in self.connections:
+            self.connections[addr]['callback'] = callback
+
+    def get_data(self, ip) -> Union[str, bytes]:
+        for addr, info in self.connections.items():
+            if info["ip"] == ip:
+                return info['data']
+        return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self) -> Tuple[Union[str, bytes], tuple]:
+        item = await self.messages.get()
+        if item is _STOP:
+            raise StopAsyncIteration
+        return item
@@ -1,19 +1,49 @@
 import time
+import uuid
+import random
 import socket
-from typing import List, Dict, Callable
+from typing import Any, List, Dict, Callable, Tuple, Union
+from concurrent.futures import Executor, Future
 from threading import Thread, Lock
 
 from .logger import Logger
+from .framing import FrameBuffer, FrameError, FrameWriter, Frame, FLAG_CONTROL, FLAG_RPC, unpack_message
+from .handshake import build_handshake, check_wire_format, control_frame, parse_control
+from .compression import DEFAULT_THRESHOLD, make_compressors, offer
+from .csm import CustomSocketMessage
+from .data_interface import Interface
+from .udp import UDPChannel
+from .send_queue import LaneQueue, PRIORITY_NORMAL, PRIORITY_BULK, check_priority
+from .metrics import ConnectionMetrics
+from .recorder import FlightRecorder, INBOUND
+from .session import Session, parse_count
+from .rpc import RPCEndpoint, REPLY_TIMEOUT
+from .shm import SHM_AVAILABLE, ShmLink, ShmWriter, is_same_host
+from .dispatch import CallbackDispatcher
+
+# Servers that do not answer the session handshake option within this time do not support resuming
+SESSION_REPLY_TIMEOUT = 1.0
 
 class Client(Logger):
 
-    def __init__(self, server_address : str, *, callback = None, port = 37564, TD=False) -> None:
+    def __init__(self, server_address : str, *, callback = None, port = 37564, TD=False, wire_format = 'text', udp = False, telemetry_callback : Callable = None,
+                 queue_size = 1024, queue_policy = 'drop_oldest', compression = None, compression_threshold = DEFAULT_THRESHOLD,
+                 metrics = True, recorder : FlightRecorder = None, reconnect_delay = 0.05, max_reconnect_delay = 5.0,
+                 resume = True, retransmit_size = 1024, rpc_workers = 4, shared_memory = True, callback_workers = 1,
+                 callback_executor : Executor = None, inbox_size = 1024, inbox_policy = 'drop_oldest',
+                 inbox_timeout = 1.0) -> None:
         super().__init__('Client')
         if server_address == 'debug':
             server_address = socket.gethostname()
         self.server_address = (server_address, port)
         self.callback = callback
         self.TD = TD
+        # Format used when send() is given a dict or Interface, announced to the server in the handshake
+        self.wire_format = check_wire_format(wire_format)
+        # Codecs offered in the handshake, the server picks one (or none) for the connection
+        self.compressors = make_compressors(compression)
+        self.compression_threshold = compression_threshold
+        self.compressor = None
 
         self.conn = None
         self.address = None
@@ -22,28 +52,83 @@ class Client(Logger):
 
         self.read_thread = Thread(target=self._run, daemon=True)
         self.read_lock = Lock()
-        self.send_lock = Lock()
         self.active = False
-        self.send_queue : List[str] = []
+        # Bounded per priority lane, messages sent while disconnected wait here until the connection is made
+        self.send_queue = LaneQueue(queue_size, queue_policy)
+        self.frame_buffer = FrameBuffer()
+        self.writer = FrameWriter()
+        # topic -> callback (None to use the default callback), sent again on every reconnect
+        self.subscriptions : Dict[str, Callable] = {}
+        self.topic_data : Dict[str, Union[str, bytes]] = {}
+
+        # Optional datagram channel for latest-value-wins telemetry, see send_telemetry
+        self.udp = UDPChannel(callback=telemetry_callback) if udp else None
+        self.last_hello = 0
+        # Counters and latency histograms for stats(), kept across reconnects
+        self.metrics = ConnectionMetrics() if metrics else None
+        # Optional capture of every message sent and received, see recorder.py
+        self.recorder = recorder
+        # After a lost connection: one immediate retry, then exponential backoff with jitter
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.reconnect_attempts = 0
+        # Resumable session (see session.py), kept across reconnects. Until the server has answered
+        # the handshake the queue is held back, so the messages it missed are written first.
+        self.session = Session(uuid.uuid4().hex, retransmit_size) if resume and not TD else None
+        self.session_ready = False
+        self.session_deadline = 0
+        # Calls to the server and handlers for the server's calls, see call() and register()
+        self.rpc = RPCEndpoint(rpc_workers)
+        # Callbacks run in order on their own thread (or callback_executor) instead of the I/O thread, see dispatch.py
+        self.dispatcher = CallbackDispatcher(callback_workers, inbox_size=inbox_size, inbox_policy=inbox_policy,
+                                             inbox_timeout=inbox_timeout,
+                                             executor=callback_executor)
+        # With a server on the same machine the connection switches to shared memory rings (see shm.py),
+        # then send() writes to the ring right away and a reader thread dispatches what the server writes
+        self.shared_memory = shared_memory and SHM_AVAILABLE
+        self.shm : ShmLink = None
+        self.write_lock = Lock()
         
 
     def __del__(self):
-        self.client_socket.close()
+        # The constructor may have failed before the socket was created
+        client_socket = getattr(self, 'client_socket', None)
+        if client_socket is not None:
+            client_socket.close()
 
     def _init_connection(self):
+        if hasattr(self, 'client_socket'):
+            # Left open when the previous connection was lost
+            self.client_socket.close()
+        if self.shm is not None:
+            self._close_shm()
         try:
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.settimeout(0.05)
+            # Small urgent frames must not wait for the acknowledgement of a bulk piece
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             if self.client_socket.connect_ex(self.server_address) != 0:
                 self.client_socket.close()
                 raise ConnectionRefusedError
+            self.frame_buffer = FrameBuffer()
+            self._clear_writer()
+            self.compressor = None
+            self.session_ready = self.session is None
+            self.session_deadline = time.monotonic() + SESSION_REPLY_TIMEOUT
+            self.reconnect_attempts = 0
             self.init = True
+            if self.metrics is not None:
+                self.metrics.on_connect()
             self.log(f'Connected to {self.server_address}')
             return True
         except socket.timeout:
             return False
         except ConnectionRefusedError:
-            self.warning(f'Connection refused by {self.server_address}')
+            # Only the first failure is a warning, the retries would flood the log
+            if self.reconnect_attempts == 0:
+                self.warning(f'Connection refused by {self.server_address}')
+            else:
+                self.debug(f'Connection refused by {self.server_address}')
             return False
         except Exception as e:
             return False
@@ -51,73 +136,398 @@ class Client(Logger):
     def _run(self):
         while self.active:
             if not self.init:
-                if not self._init_connection():
-                    time.sleep(5)
+                if self.shm is not None:
+                    # Joins the ring's reader thread, which may be waiting for the write lock
+                    self._close_shm()
+                # Under the write lock so subscribe() either finds the connection with its handshake written or not at all
+                with self.write_lock:
+                    connected = self._init_connection()
+                    if connected and not self.TD:
+                        # Written first so it always goes out before the queued messages
+                        session = self.session
+                        local = self.shared_memory and is_same_host(self.client_socket)
+                        self.writer.add(build_handshake(socket.gethostname(), format=self.wire_format, compress=offer(self.compressors),
+                                                        session=session.id if session else None,
+                                                        ack=session.received if session else None,
+                                                        shm=1 if local else None))
+                        for topic in list(self.subscriptions):
+                            self.writer.add(control_frame('subscribe', topic))
+                if not connected:
+                    time.sleep(self._reconnect_backoff())
                     continue
-                if not self.TD:
-                    self.send(f'Client: {socket.gethostname()}')
-            self.receive()
-            self._send()
-            time.sleep(0.01)
+            frames = self._read_data()
+            # Waiting for data (the socket timeout) and the sleep are not part of the loop time
+            start = time.perf_counter()
+            self._dispatch(frames)
+            with self.write_lock:
+                self._send()
+            self._send_hello()
+            self.rpc.expire()
+            if self.metrics is not None:
+                self.metrics.loop_time.record(time.perf_counter() - start)
+            # The rest of a bulk message is read right away, its pieces would trickle in otherwise
+            if not self.frame_buffer.in_bulk:
+                time.sleep(0.01)
+
+    def _reconnect_backoff(self) -> float:
+        '''Seconds to wait before the next connection attempt, jittered so clients do not retry in lockstep'''
+        self.reconnect_attempts += 1
+        if self.reconnect_attempts == 1:
+            return 0
+        delay = min(self.max_reconnect_delay, self.reconnect_delay * 2 ** (self.reconnect_attempts - 2))
+        return random.uniform(delay / 2, delay)
+
+    def _send_hello(self):
+        # Repeated so the server learns our UDP address even if a hello is lost
+        if self.udp is None or not self.init or time.time() - self.last_hello < 1:
+            return
+        self.last_hello = time.time()
+        try:
+            self.udp.send_hello(self.server_address)
+        except OSError:
+            pass
 
     def start(self):
         self.active = True
+        if self.udp is not None:
+            self.udp.start()
         self.read_thread.start()
 
     def stop(self):
         try:
             self.log("Shutting down client")
             self.active = False
+            self.send_queue.close()
             self.read_thread.join(5)
+            self.rpc.shutdown()
+            self.dispatcher.shutdown()
+            if self.shm is not None:
+                self._close_shm()
+            if self.udp is not None:
+                self.udp.stop()
             self.client_socket.shutdown(socket.SHUT_RDWR)
             self.client_socket.close()
         except:
             pass
     
-    def _read_data(self):
+    def _read_data(self) -> List[Tuple[bytes, int]]:
         try:
-            data = self.client_socket.recv(4096).decode()
+            nbytes = self.frame_buffer.recv_into(self.client_socket)
+            if nbytes == 0:
+                raise ConnectionResetError('Connection closed by server')
+            frames = list(self.frame_buffer.frames())
+            if self.metrics is not None:
+                self.metrics.on_read(nbytes, len(frames))
+            return frames
         except socket.timeout:
-            data = None
-        except ConnectionResetError as e:
-            data = None
-            self.init = False
-            self.warning(f'Lost connection to {self.server_address}')
-            self.warning(e)
-        return data
+            return []
+        except (ConnectionResetError, FrameError) as e:
+            self._lost_connection(e)
+            return []
+
+    def _lost_connection(self, error : Exception):
+        self.init = False
+        self.warning(f'Lost connection to {self.server_address}')
+        self.warning(error)
+        if self.session is None:
+            # Without a session nothing is resent, calls in flight will not be answered
+            self.rpc.fail(ConnectionError(f'Lost connection to {self.server_address}'))
 
     def receive(self):
         if not self.init:
             return
+        self._dispatch(self._read_data())
+
+    def _dispatch(self, frames : List[Tuple[bytes, int]]):
+        # Handed to the dispatcher after the read lock is released, get_data() must not wait for a full inbox
+        calls = []
         with self.read_lock:
-            data = self._read_data()
-            if data:
-                self.log(f'Received: {data} from {self.server_address}')
-                self.data = data
-                if self.callback is not None: 
-                    self.callback(data, self.server_address)
+            for payload, flags in frames:
+                if flags & FLAG_CONTROL:
+                    self._on_control(*parse_control(payload))
+                    continue
+                try:
+                    data, topic = unpack_message(payload, flags, self.compressor)
+                except FrameError as e:
+                    self._lost_connection(e)
+                    break
+                self.message('Received: %s from %s', self.payload(data), self.server_address)
+                if self.session is not None and self.session_ready:
+                    self.session.on_received()
+                if flags & FLAG_RPC:
+                    self.rpc.on_frame(data, self.server_address, self._rpc_reply)
+                    continue
+                if self.recorder is not None:
+                    self.recorder.record(INBOUND, self.server_address, data, topic)
+                callback = self.callback
+                if topic is None:
+                    self.data = data
+                else:
+                    self.topic_data[topic] = data
+                    callback = self.subscriptions.get(topic) or callback
+                if callback is not None:
+                    calls.append((callback, data))
+        for callback, data in calls:
+            self.dispatcher.submit(self.server_address, callback, data, self.server_address)
     
-    def get_data(self) -> str: 
+    def _on_control(self, command : str, argument : str):
+        if command == 'compress':
+            self.compressor = next((compressor for compressor in self.compressors if compressor.token == argument), None)
+            self.log(f'Compression for {self.server_address}: {argument}')
+        elif command == 'ack':
+            count = parse_count(argument)
+            if count is None:
+                self.warning(f'Invalid ack {argument!r} from {self.server_address}')
+            elif self.session is not None:
+                self.session.on_ack(count)
+        elif command == 'session':
+            self._on_session(argument)
+        elif command == 'shm':
+            self._on_shm(argument)
+        else:
+            self.warning(f'Unknown control message {command!r} from {self.server_address}')
+
+    def _on_session(self, argument : str):
+        '''Server's answer to the session in the handshake: 'none', 'new' or the number of our messages it received'''
+        if self.session is None:
+            return
+        self.session_ready = True
+        if argument not in ('none', 'new') and parse_count(argument) is None:
+            self.warning(f'Invalid session reply {argument!r} from {self.server_address}, messages will not be resent after a reconnect')
+            self.session = None
+            return
+        if argument == 'none':
+            self.log(f'{self.server_address} does not resume sessions')
+            self.session = None
+            return
+        # Under the write lock like _write_control, send() may be writing to the ring from another thread
+        with self.write_lock:
+            if argument == 'new':
+                resend = self.session.restart()
+                if resend:
+                    self.warning(f'{self.server_address} did not know the session, sending {len(resend)} unacknowledged messages again')
+                for data, priority in resend:
+                    self._write(data, priority)
+                return
+            lost = self.session.lost
+            resend = self.session.unacknowledged(parse_count(argument))
+            # Numbered again like new messages, bulk ones in pieces so they do not hold up the others
+            for data, priority in resend:
+                self._write(data, priority)
+        if self.session.lost > lost:
+            self.warning(f'{self.session.lost - lost} messages to {self.server_address} were no longer in the retransmit buffer')
+        self.log(f'Resumed session with {self.server_address}, resent {len(resend)} messages')
+
+    def _on_shm(self, names : str):
+        '''The server switched to shared memory, everything after its reply is in the rings'''
+        try:
+            link = ShmLink.attach(names, self._on_shm_frames)
+        except OSError as e:
+            # The server writes to the rings from now on, start over on a connection without them
+            self.shared_memory = False
+            self._lost_connection(e)
+            return
+        with self.write_lock:
+            # Tells the server to start reading the ring, after our last frame on the socket
+            self.writer.add(control_frame('shm', 'ready'))
+            self.writer = ShmWriter(link.send_ring, self.writer)
+            self.shm = link
+        link.start()
+        self.log(f'Switched to shared memory with {self.server_address}')
+
+    def _on_shm_frames(self, frames : List[Tuple[bytes, int]]):
+        # Called from the shared memory reader thread
+        if self.metrics is not None:
+            self.metrics.on_read(sum(len(payload) for payload, _ in frames), len(frames))
+        self._dispatch(frames)
+        self._write_now()
+
+    def _close_shm(self):
+        self.shm.close()
+        self.shm = None
+        self._clear_writer()
+        writer = FrameWriter()
+        writer.bytes_written, writer.partial_writes = self.writer.bytes_written, self.writer.partial_writes
+        self.writer = writer
+
+    def _write_now(self):
+        '''With shared memory, queued messages are written by the sending thread instead of the I/O loop'''
+        if self.shm is not None:
+            with self.write_lock:
+                self._send()
+
+    def get_data(self, topic : str = None) -> Union[str, bytes]: 
+        '''Latest direct message, or latest message published on a topic'''
         with self.read_lock:
+            if topic is not None:
+                return self.topic_data.get(topic)
             return self.data
 
-    def send(self, data : str):
-        with self.send_lock:
-            self.send_queue.append(data)
+    def subscribe(self, topic : str, callback : Callable = None):
+        '''
+        Receive what the server publishes on a topic. Messages go to `callback` if given,
+        otherwise to the default callback. Subscriptions are kept across reconnects.
+        '''
+        self.subscriptions[topic] = callback
+        self._write_control(control_frame('subscribe', topic))
+
+    def unsubscribe(self, topic : str):
+        if self.subscriptions.pop(topic, False) is not False:
+            self._write_control(control_frame('unsubscribe', topic))
+
+    def _write_control(self, frame : Frame):
+        # Straight to the writer like the handshake, a full send queue must not drop it. While disconnected
+        # there is nothing to do, the subscriptions are sent again after the next handshake.
+        with self.write_lock:
+            if not self.init:
+                return
+            self.writer.add(frame)
+        self._write_now()
+
+    def send(self, data : Union[str, bytes, dict, Interface], *, key = None, block = True, timeout : float = None,
+             priority = PRIORITY_NORMAL) -> bool:
+        '''
+        Queue data for the server. `key` is used by the 'coalesce' queue policy, `block` and
+        `timeout` by the 'block' policy. `priority` is the lane: PRIORITY_HIGH (e.g. an emergency stop),
+        PRIORITY_NORMAL or PRIORITY_BULK (large data, written in pieces the other lanes can overtake).
+        Returns False if the message was not accepted.
+        '''
+        check_priority(priority)
+        if isinstance(data, (dict, Interface)):
+            data = CustomSocketMessage.encode_for_wire(data, self.wire_format)
+        accepted = self.send_queue.put(data, key=key, block=block, timeout=timeout, priority=priority)
+        self._write_now()
+        return accepted
+
+    def call(self, method : str, *, timeout : float = None, **kwargs) -> Future:
+        '''
+        Calls a handler the server registered, returns a Future of its result. The future fails with
+        RPCError if the handler raised, with TimeoutError after `timeout` seconds without a response.
+        Any number of calls can be in flight, e.g. to pipeline commands:
+            futures = [client.call('set_mode', mode=2), client.call('start_mission', name='gate')]
+        '''
+        future, frame = self.rpc.request(method, kwargs, self.server_address, timeout)
+        if not self.send_queue.put(frame, timeout=timeout):
+            self.rpc.cancel(future, ConnectionError('Send queue is full or closed'))
+        self._write_now()
+        return future
+
+    def register(self, method : str, handler : Callable):
+        '''Handler for the server's calls of `method`, called as handler(**kwargs) on a worker thread'''
+        self.rpc.register(method, handler)
+
+    def _rpc_reply(self, frame : Frame):
+        # Called from an RPC worker, which can wait for room in the queue
+        if not self.send_queue.put(frame, timeout=REPLY_TIMEOUT):
+            self.warning(f'Dropped an RPC response to {self.server_address}, the send queue is full or closed')
+        self._write_now()
+
+    def queue_depth(self) -> int:
+        return len(self.send_queue)
 
-    def _send_data(self, data : str):
+    def send_telemetry(self, stream : str, data : Union[str, bytes, dict, Interface]):
+        '''Send on the UDP channel, the server only keeps the newest message of each stream'''
+        if self.udp is None:
+            raise RuntimeError('Client was created without udp=True')
+        self.udp.send(stream, data, self.server_address)
+
+    def get_telemetry(self, stream : str) -> Union[str, bytes]:
+        if self.udp is None:
+            return None
+        return self.udp.get_data(stream)
+
+    def _flush(self) -> bool:
+        '''Returns True once everything was written'''
         try:
-            self.client_socket.send(data.encode())
-            self.log(f'Sent: {data} to {self.server_address}')
-        except ConnectionResetError:
-            self.init = False
-        except BrokenPipeError:
-            self.init = False
+            return self.writer.flush(self.client_socket)
+        except OSError as e:
+            self._lost_connection(e)
+            return False
+
+    def _compress(self, data : Union[str, bytes, list, Frame]) -> Union[str, bytes, list, Frame]:
+        if self.compressor is not None and not isinstance(data, Frame):
+            return Frame(data, compressor=self.compressor, threshold=self.compression_threshold)
+        return data
 
     def _send(self):
         if not self.init:
             return
-        with self.send_lock:
-            for data in self.send_queue:
-                self._send_data(data)
-            self.send_queue = []
\ No newline at end of file
+        if not self.session_ready:
+            if time.monotonic() < self.session_deadline:
+                # Only the handshake goes out until the server answered it
+                self._flush()
+                return
+            self.warning(f'No session reply from {self.server_address}, messages will not be resent after a reconnect')
+            self.session = None
+            self.session_ready = True
+        while True:
+            messages = self._write_queued()
+            if self.session is not None:
+                now = time.monotonic()
+                if self.session.ack_due(now):
+                    self.writer.add(self.session.ack_frame(now))
+            full = not self.writer.has_room()
+            if messages:
+                self.message('Writing %d messages to %s', len(messages), self.server_address)
+            # Whatever the socket does not accept now is written on the next iteration
+            done = self._flush()
+            self._count_completed()
+            if self.metrics is not None:
+                # Messages whose last byte went out, in this flush or after an earlier partial write
+                sent = self.writer.sent_marks()
+                if sent:
+                    self.metrics.on_flush(sent, time.monotonic())
+            # Bulk messages go out one piece per flush, what was queued in the meantime goes before the next piece.
+            # Messages left in the queue because the writer was full go out once it was written.
+            if not self.init or not (self.writer.chunks_waiting() or (done and full)):
+                return
+
+    def _write_queued(self) -> List[Tuple[Any, float, int]]:
+        '''
+        Moves queued messages to the writer while it has room, so messages sent while the server does
+        not read stay in the bounded send queue where its policy applies. Returns those written.
+        '''
+        messages = []
+        while len(self.send_queue) and self.writer.has_room():
+            batch = self.send_queue.get_batch(self.writer.room(), bulk=self.writer.has_room(bulk=True))
+            if not batch:
+                break
+            for data, enqueued, priority in batch:
+                if self.recorder is not None:
+                    self.recorder.record_sent(self.server_address, data)
+                self._write(data, priority, (enqueued, priority) if self.metrics is not None else None)
+            messages += batch
+        return messages
+
+    def _write(self, data : Union[str, bytes, list, Frame], priority : int, mark : Tuple[float, int] = None):
+        bulk = priority == PRIORITY_BULK
+        self.writer.add(self._compress(data), bulk=bulk, message=data, mark=mark)
+        # Bulk messages that finished while `data` was added went out before it
+        self._count_completed()
+        if self.session is not None and not bulk:
+            self.session.on_sent(data, priority)
+
+    def _count_completed(self):
+        # A bulk message is numbered for the session once its last piece is written, that is when the server receives it
+        completed = self.writer.completed()
+        if self.session is not None:
+            for data in completed:
+                self.session.on_sent(data, PRIORITY_BULK)
+
+    def _clear_writer(self):
+        # Bulk messages finished but not numbered yet, and those cut short (resent whole when the session resumes)
+        unfinished = self.writer.completed() + self.writer.clear()
+        if self.session is not None:
+            for data in unfinished:
+                self.session.on_sent(data, PRIORITY_BULK)
+
+    def stats(self) -> dict:
+        '''Snapshot of the connection counters and latency histograms (see metrics.py)'''
+        stats = {'server': f'{self.server_address[0]}:{self.server_address[1]}', 'connected': self.init,
+                 'transport': 'shm' if self.shm is not None else 'tcp'}
+        if self.metrics is not None:
+            stats.update(self.metrics.snapshot(self.send_queue, self.writer))
+        stats['callbacks'] = self.dispatcher.stats()
+        if self.udp is not None:
+            stats['udp_dropped'] = self.udp.dropped
+        return stats
\ No newline at end of file
@@ -0,0 +1,352 @@
+import struct
+from typing import Any, List, Tuple, Union
+
+from comms_core.data_interface import Interface
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Binary messages start with a magic byte that can never begin a text CSM message
+MAGIC = b'\xb5'
+VERSION = 1
+
+_U32 = struct.Struct('<I')
+_I64 = struct.Struct('<q')
+_F64 = struct.Struct('<d')
+
+# Type tags
+NONE = ord('N')
+TRUE = ord('T')
+FALSE = ord('F')
+INT = ord('i')
+BIG_INT = ord('I')
+FLOAT = ord('d')
+STR = ord('s')
+BYTES = ord('b')
+LIST = ord('l')
+TUPLE = ord('t')
+DICT = ord('m')
+FLOAT_LIST = ord('D')
+FLOAT_TUPLE = ord('E')
+INT_LIST = ord('Q')
+INT_TUPLE = ord('R')
+ARRAY = ord('A')
+
+# Raw array data starts on a multiple of this offset from the start of the message
+ARRAY_ALIGNMENT = 16
+
+
+class BinaryCodecError(ValueError):
+    pass
+
+
+_BUFFER = 'buffer'
+
+_unpack_u32 = _U32.unpack_from
+_unpack_i64 = _I64.unpack_from
+_unpack_f64 = _F64.unpack_from
+
+
+def _encode_value(value, fmt : list, args : list):
+    '''
+    Append the struct format and arguments for `value`.
+    The whole message is packed with a single struct.pack call at the end.
+    '''
+    value_type = type(value)
+    if value_type is float:
+        fmt.append('Bd')
+        args += (FLOAT, value)
+    elif value_type is str:
+        raw = value.encode()
+        fmt.append(f'BI{len(raw)}s')
+        args += (STR, len(raw), raw)
+    elif value_type is bool:
+        fmt.append('B')
+        args.append(TRUE if value else FALSE)
+    elif value_type is int:
+        _encode_int(value, fmt, args)
+    elif value_type is list or value_type is tuple:
+        _encode_sequence(value, value_type is tuple, fmt, args)
+    elif value is None:
+        fmt.append('B')
+        args.append(NONE)
+    elif value_type is bytes or value_type is bytearray:
+        fmt.append(f'BI{len(value)}s')
+        args += (BYTES, len(value), value)
+    elif value_type is dict:
+        _encode_dict(value, fmt, args)
+    # Subclasses (IntEnum, namedtuple, ...) fall back to their base type
+    elif isinstance(value, bool):
+        _encode_value(bool(value), fmt, args)
+    elif isinstance(value, int):
+        _encode_int(int(value), fmt, args)
+    elif isinstance(value, float):
+        _encode_value(float(value), fmt, args)
+    elif isinstance(value, str):
+        _encode_value(str(value), fmt, args)
+    elif isinstance(value, (bytes, bytearray)):
+        _encode_value(bytes(value), fmt, args)
+    elif isinstance(value, (list, tuple)):
+        _encode_sequence(value, isinstance(value, tuple), fmt, args)
+    elif isinstance(value, dict):
+        _encode_dict(value, fmt, args)
+    elif np is not None and isinstance(value, np.ndarray):
+        _encode_array(value, fmt, args)
+    elif np is not None and isinstance(value, np.generic):
+        _encode_value(value.item(), fmt, args)
+    else:
+        raise BinaryCodecError(f'Cannot encode value of type {value_type.__name__}')
+
+def _encode_array(value, fmt : list, args : list):
+    if value.dtype.hasobject or value.dtype.fields is not None:
+        raise BinaryCodecError(f'Cannot encode array with dtype {value.dtype}')
+    value = np.ascontiguousarray(value)
+    dtype = value.dtype.str.encode()
+    fmt.append(f'BB{len(dtype)}sB{value.ndim}QQ')
+    args += (ARRAY, len(dtype), dtype, value.ndim, *value.shape, value.nbytes)
+    # The array buffer is not packed, it is passed through as its own segment
+    fmt.append((_BUFFER, len(args)))
+    # An empty array's view cannot be cast
+    args.append(memoryview(value).cast('B') if value.size else memoryview(b''))
+
+def _pack_segments(fmt : list, args : list) -> List[Union[bytes, memoryview]]:
+    '''Pack the format pieces between array buffers, returns the message as a list of buffers'''
+    segments = []
+    size = 0
+    start = 0
+    arg_start = 0
+    for i, piece in enumerate(fmt):
+        if type(piece) is not tuple:
+            continue
+        _, arg_index = piece
+        packed = struct.pack('<' + ''.join(fmt[start:i]).lstrip('<'), *args[arg_start:arg_index])
+        size += len(packed)
+        padding = -size % ARRAY_ALIGNMENT
+        segments.append(packed + bytes(padding))
+        size += padding
+        buffer = args[arg_index]
+        segments.append(buffer)
+        size += buffer.nbytes
+        start = i + 1
+        arg_start = arg_index + 1
+    segments.append(struct.pack('<' + ''.join(fmt[start:]).lstrip('<'), *args[arg_start:]))
+    return segments
+
+def _encode_int(value : int, fmt : list, args : list):
+    if -0x8000000000000000 <= value <= 0x7fffffffffffffff:
+        fmt.append('Bq')
+        args += (INT, value)
+    else:
+        raw = value.to_bytes((value.bit_length() + 8) // 8, 'little', signed=True)
+        fmt.append(f'BI{len(raw)}s')
+        args += (BIG_INT, len(raw), raw)
+
+def _encode_sequence(value, is_tuple : bool, fmt : list, args : list):
+    count = len(value)
+    if count:
+        # Homogeneous numeric sequences are packed as a flat array
+        item_types = set(map(type, value))
+        if len(item_types) == 1:
+            item_type = item_types.pop()
+            if item_type is float:
+                fmt.append(f'BI{count}d')
+                args += (FLOAT_TUPLE if is_tuple else FLOAT_LIST, count)
+                args += value
+                return
+            if item_type is int and min(value) >= -0x8000000000000000 and max(value) <= 0x7fffffffffffffff:
+                fmt.append(f'BI{count}q')
+                args += (INT_TUPLE if is_tuple else INT_LIST, count)
+                args += value
+                return
+    fmt.append('BI')
+    args += (TUPLE if is_tuple else LIST, count)
+    for item in value:
+        _encode_value(item, fmt, args)
+
+# Encoded form of recently used dict keys, keys repeat on every message
+_KEY_CACHE = {}
+_KEY_CACHE_SIZE = 4096
+
+def _encode_key(key : str) -> tuple:
+    if len(_KEY_CACHE) >= _KEY_CACHE_SIZE:
+        _KEY_CACHE.clear()
+    raw = key.encode()
+    entry = _KEY_CACHE[key] = (f'BI{len(raw)}s', (STR, len(raw), raw))
+    return entry
+
+def _encode_dict(value : dict, fmt : list, args : list):
+    fmt.append('BI')
+    args += (DICT, len(value))
+    fmt_append = fmt.append
+    for key, item in value.items():
+        if type(key) is str:
+            entry = _KEY_CACHE.get(key) or _encode_key(key)
+            fmt_append(entry[0])
+            args += entry[1]
+        else:
+            _encode_value(key, fmt, args)
+        # Inline the common scalar types, everything else goes through _encode_value
+        item_type = type(item)
+        if item_type is float:
+            fmt_append('Bd')
+            args += (FLOAT, item)
+        elif item_type is int and -0x8000000000000000 <= item <= 0x7fffffffffffffff:
+            fmt_append('Bq')
+            args += (INT, item)
+        else:
+            _encode_value(item, fmt, args)
+
+
+def _decode_value(buf : bytes, offset : int) -> Tuple[Any, int]:
+    tag = buf[offset]
+    offset += 1
+    if tag == FLOAT:
+        return _unpack_f64(buf, offset)[0], offset + 8
+    if tag == INT:
+        return _unpack_i64(buf, offset)[0], offset + 8
+    if tag == STR:
+        length = _unpack_u32(buf, offset)[0]
+        offset += 4
+        return buf[offset:offset + length].decode(), offset + length
+    if tag == TRUE:
+        return True, offset
+    if tag == FALSE:
+        return False, offset
+    if tag == NONE:
+        return None, offset
+    if tag == FLOAT_LIST or tag == FLOAT_TUPLE or tag == INT_LIST or tag == INT_TUPLE:
+        count = _unpack_u32(buf, offset)[0]
+        offset += 4
+        code = 'd' if tag == FLOAT_LIST or tag == FLOAT_TUPLE else 'q'
+        items = struct.unpack_from(f'<{count}{code}', buf, offset)
+        if tag == FLOAT_LIST or tag == INT_LIST:
+            items = list(items)
+        return items, offset + 8 * count
+    if tag == LIST or tag == TUPLE:
+        count = _unpack_u32(buf, offset)[0]
+        offset += 4
+        items = []
+        for _ in range(count):
+            item, offset = _decode_value(buf, offset)
+            items.append(item)
+        return (tuple(items) if tag == TUPLE else items), offset
+    if tag == DICT:
+        return _decode_dict(buf, offset)
+    if tag == BYTES:
+        length = _unpack_u32(buf, offset)[0]
+        offset += 4
+        return buf[offset:offset + length], offset + length
+    if tag == ARRAY:
+        return _decode_array(buf, offset)
+    if tag == BIG_INT:
+        length = _unpack_u32(buf, offset)[0]
+        offset += 4
+        return int.from_bytes(buf[offset:offset + length], 'little', signed=True), offset + length
+    raise BinaryCodecError(f'Unknown type tag {tag!r} at offset {offset - 1}')
+
+def _decode_array(buf : bytes, offset : int) -> Tuple[Any, int]:
+    if np is None:
+        raise BinaryCodecError('Received a numpy array but numpy is not installed')
+    length = buf[offset]
+    dtype = np.dtype(buf[offset + 1:offset + 1 + length].decode())
+    offset += 1 + length
+    ndim = buf[offset]
+    offset += 1
+    *shape, nbytes = struct.unpack_from(f'<{ndim}QQ', buf, offset)
+    offset += 8 * (ndim + 1)
+    offset += -offset % ARRAY_ALIGNMENT
+    # The array is a read-only view over the received message, no copy is made
+    array = np.frombuffer(buf, dtype=dtype, count=nbytes // dtype.itemsize, offset=offset).reshape(shape)
+    return array, offset + nbytes
+
+def _decode_dict(buf : bytes, offset : int) -> Tuple[dict, int]:
+    count = _unpack_u32(buf, offset)[0]
+    offset += 4
+    result = {}
+    for _ in range(count):
+        # Inline the common case of a str key with a float or int value
+        if buf[offset] == STR:
+            length = _unpack_u32(buf, offset + 1)[0]
+            offset += 5
+            key = buf[offset:offset + length].decode()
+            offset += length
+        else:
+            key, offset = _decode_value(buf, offset)
+        tag = buf[offset]
+        if tag == FLOAT:
+            result[key] = _unpack_f64(buf, offset + 1)[0]
+            offset += 9
+        elif tag == INT:
+            result[key] = _unpack_i64(buf, offset + 1)[0]
+            offset += 9
+        else:
+            result[key], offset = _decode_value(buf, offset)
+    return result, offset
+
+
+class BinaryMessage:
+    '''
+    Typed binary counterpart of CustomSocketMessage.
+    Round-trips int, float, str, bool, None, bytes, dicts and arbitrarily nested lists/tuples.
+    numpy arrays are sent as dtype/shape plus their raw buffer when numpy is installed.
+    '''
+
+    @staticmethod
+    def is_binary(message) -> bool:
+        return isinstance(message, (bytes, bytearray, memoryview)) and len(message) > 1 and message[0] == MAGIC[0]
+
+    @staticmethod
+    def encode_vars(**kwargs) -> bytes:
+        return BinaryMessage.encode(kwargs)
+
+    @staticmethod
+    def encode(data : Union[dict, Interface]) -> bytes:
+        if isinstance(data, Interface):
+            data = data.to_dict()
+        fmt = ['<BB']
+        args = [MAGIC[0], VERSION]
+        _encode_dict(data, fmt, args)
+        try:
+            message_format = ''.join(fmt)
+        except TypeError:
+            # The message contains array buffers
+            return b''.join(_pack_segments(fmt, args))
+        return struct.pack(message_format, *args)
+
+    @staticmethod
+    def encode_buffers(data : Union[dict, Interface]) -> Union[bytes, List[Union[bytes, memoryview]]]:
+        '''
+        Like encode, but array data is not copied into the message. Returns bytes if the
+        message has no arrays, otherwise a list of buffers to be sent back to back.
+        '''
+        if isinstance(data, Interface):
+            data = data.to_dict()
+        fmt = ['<BB']
+        args = [MAGIC[0], VERSION]
+        _encode_dict(data, fmt, args)
+        try:
+            message_format = ''.join(fmt)
+        except TypeError:
+            return _pack_segments(fmt, args)
+        return struct.pack(message_format, *args)
+
+    @staticmethod
+    def decode(message : Union[bytes, bytearray, memoryview], *, as_interface = False) -> Union[dict, Interface]:
+        if not BinaryMessage.is_binary(message):
+            raise BinaryCodecError('Not a binary message')
+        if message[1] != VERSION:
+            raise BinaryCodecError(f'Unsupported binary message version {message[1]}')
+        if not isinstance(message, bytes):
+            message = bytes(message)
+        try:
+            data, _ = _decode_value(message, 2)
+        # ValueError and TypeError come from invalid utf-8 and array headers (dtype, shape, size)
+        except (struct.error, IndexError, ValueError, TypeError) as e:
+            raise BinaryCodecError(f'Malformed binary message: {e}') from e
+        if as_interface:
+            interface = Interface()
+            interface.from_dict(data)
+            return interface
+        return data
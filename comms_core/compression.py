@@ -0,0 +1,140 @@
+import lzma
+import zlib
+from typing import Dict, List, Type, Union
+
+from .framing import FrameError
+
+# Payloads smaller than this are sent as they are, compressing them costs more latency than it saves
+DEFAULT_THRESHOLD = 512
+
+
+class Compressor:
+    '''
+    Interface for payload compression codecs. Subclasses set `name`, implement compress and
+    decompress, and are made available to the handshake with register_compressor.
+
+    Both ends have to use the same preset dictionary (if any), the handshake compares
+    `token` (the codec name plus a checksum of the dictionary) to make sure they do.
+    '''
+
+    name : str = None
+
+    def __init__(self, *, zdict : bytes = None):
+        self.zdict = zdict
+
+    @property
+    def token(self) -> str:
+        if self.zdict is None:
+            return self.name
+        return f'{self.name}:{zlib.crc32(self.zdict):08x}'
+
+    def compress(self, data : bytes) -> bytes:
+        raise NotImplementedError
+
+    def decompress(self, data : bytes, max_length : int) -> bytes:
+        '''Raises FrameError if the data is invalid or decompresses to more than max_length bytes'''
+        raise NotImplementedError
+
+
+class ZlibCompressor(Compressor):
+    '''Raw deflate (no zlib header or checksum, TCP already checks the data), optionally with a preset dictionary'''
+
+    name = 'zlib'
+
+    def __init__(self, *, level = 6, zdict : bytes = None):
+        super().__init__(zdict=zdict)
+        self.level = level
+        self.options = {} if zdict is None else {'zdict': zdict}
+
+    def compress(self, data : bytes) -> bytes:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, **self.options)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data : bytes, max_length : int) -> bytes:
+        decompressor = zlib.decompressobj(-15, **self.options)
+        try:
+            result = decompressor.decompress(data, max_length)
+        except zlib.error as e:
+            raise FrameError(f'Invalid zlib payload: {e}')
+        if not decompressor.eof:
+            raise FrameError(f'Compressed payload is truncated or larger than {max_length} bytes')
+        return result
+
+
+class LzmaCompressor(Compressor):
+    '''Raw LZMA2, slower than zlib but smaller on large payloads. Does not support preset dictionaries.'''
+
+    name = 'lzma'
+
+    def __init__(self, *, preset = 6):
+        super().__init__()
+        self.filters = [{'id': lzma.FILTER_LZMA2, 'preset': preset}]
+
+    def compress(self, data : bytes) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.filters)
+
+    def decompress(self, data : bytes, max_length : int) -> bytes:
+        decompressor = lzma.LZMADecompressor(lzma.FORMAT_RAW, filters=self.filters)
+        try:
+            result = decompressor.decompress(data, max_length)
+        except lzma.LZMAError as e:
+            raise FrameError(f'Invalid lzma payload: {e}')
+        if not decompressor.eof:
+            raise FrameError(f'Compressed payload is truncated or larger than {max_length} bytes')
+        return result
+
+
+COMPRESSORS : Dict[str, Type[Compressor]] = {}
+
+
+def register_compressor(compressor : Type[Compressor]) -> Type[Compressor]:
+    COMPRESSORS[compressor.name] = compressor
+    return compressor
+
+register_compressor(ZlibCompressor)
+register_compressor(LzmaCompressor)
+
+
+def make_compressors(compression : Union[str, Compressor, List[Union[str, Compressor]], None]) -> List[Compressor]:
+    '''
+    Accepts a codec name, a Compressor instance or a list of them (in order of preference).
+    Returns the list of Compressor instances.
+    '''
+    if compression is None:
+        return []
+    if not isinstance(compression, (list, tuple)):
+        compression = [compression]
+    compressors = []
+    for item in compression:
+        if isinstance(item, str):
+            if item not in COMPRESSORS:
+                raise ValueError(f'Unknown compression {item!r}, expected one of {tuple(COMPRESSORS)}')
+            item = COMPRESSORS[item]()
+        compressors.append(item)
+    return compressors
+
+
+def offer(compressors : List[Compressor]) -> Union[str, None]:
+    '''Value of the handshake 'compress' option'''
+    if not compressors:
+        return None
+    return ','.join(compressor.token for compressor in compressors)
+
+
+def negotiate(offered : str, compressors : List[Compressor]) -> Union[Compressor, None]:
+    '''First codec of the peer's offer that we support with the same dictionary'''
+    tokens = {compressor.token: compressor for compressor in compressors}
+    for token in offered.split(','):
+        if token in tokens:
+            return tokens[token]
+    return None
+
+
+def build_dictionary(samples : List[Union[str, bytes]], size = 32 * 1024) -> bytes:
+    '''
+    Preset dictionary from typical messages. deflate looks back at most 32KB and finds
+    matches at the end of the dictionary with the shortest distances, so the most common
+    messages should be passed last.
+    '''
+    data = b''.join(sample.encode() if isinstance(sample, str) else bytes(sample) for sample in samples)
+    return data[-size:]
@@ -1,5 +1,108 @@
+import codecs
 from comms_core.data_interface import Interface
-from typing import Union
+from comms_core.codec import BinaryMessage
+from comms_core.schema import Schema
+from typing import Any, Iterable, Iterator, List, Tuple, Union
+
+# Every item of a text message is '{key:value<type>}' followed by ITEM_SEPARATOR
+ITEM_SEPARATOR = '*%*'
+
+
+class CSMDecodeError(ValueError):
+    '''A malformed item of a text message, the other items are still decoded'''
+
+    def __init__(self, item : str, reason : str):
+        super().__init__(f'Cannot decode {item[:64]!r}: {reason}')
+        self.item = item
+
+
+class CSMDecoder:
+    '''
+    Incremental decoder of CustomSocketMessage text messages.
+
+    feed() takes the message in str or bytes chunks as they arrive and returns the (key, value)
+    pairs completed by the chunk, finish() returns the last item if the message did not end with
+    a separator. The unfinished item is kept as a list of its pieces, joined once its separator
+    arrives, and each chunk is searched once. Malformed items (and bytes that are not utf-8) are
+    skipped and kept in `errors`.
+
+        decoder = CSMDecoder()
+        for chunk in chunks:
+            for key, value in decoder.feed(chunk):
+                ...
+        data = dict(decoder.finish())
+    '''
+
+    def __init__(self):
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        # Pieces of the unfinished item, and its last characters where a separator may have started
+        self.parts : List[str] = []
+        self.head = ''
+        self.errors : List[CSMDecodeError] = []
+
+    def feed(self, chunk : Union[str, bytes, bytearray, memoryview]) -> List[Tuple[str, Any]]:
+        if not isinstance(chunk, str):
+            try:
+                # A multi-byte character split between chunks is completed by the next one
+                chunk = self.text_decoder.decode(chunk)
+            except UnicodeDecodeError as e:
+                self.errors.append(CSMDecodeError(bytes(chunk).decode('utf-8', 'replace'), str(e)))
+                self.text_decoder.reset()
+                return []
+        if not chunk:
+            return []
+        items = []
+        head = self.head
+        text = head + chunk
+        position = 0
+        end = text.find(ITEM_SEPARATOR)
+        while end != -1:
+            if position == 0:
+                # Completes the unfinished item, whose last characters are `head`
+                pending = ''.join(self.parts)
+                item = self._item(pending[:len(pending) - len(head)] + text[:end])
+            else:
+                item = self._item(text[position:end])
+            if item is not None:
+                items.append(item)
+            position = end + len(ITEM_SEPARATOR)
+            end = text.find(ITEM_SEPARATOR, position)
+        if position == 0:
+            self.parts.append(chunk)
+            rest = text
+        else:
+            rest = text[position:]
+            self.parts = [rest] if rest else []
+        self.head = rest[len(rest) - len(ITEM_SEPARATOR) + 1:]
+        return items
+
+    def finish(self) -> List[Tuple[str, Any]]:
+        '''Returns the item left at the end of the message and resets the decoder for the next one'''
+        try:
+            self.parts.append(self.text_decoder.decode(b'', final=True))
+        except UnicodeDecodeError as e:
+            self.errors.append(CSMDecodeError(''.join(self.parts), str(e)))
+        tail = ''.join(self.parts)
+        self.parts = []
+        self.head = ''
+        self.text_decoder.reset()
+        item = self._item(tail)
+        return [] if item is None else [item]
+
+    def _item(self, text : str) -> Union[Tuple[str, Any], None]:
+        return _decode_item(text, self.errors)
+
+
+def _decode_item(text : str, errors : List[CSMDecodeError]) -> Union[Tuple[str, Any], None]:
+    '''(key, value) of an item, None if it is empty or malformed (the error is added to `errors`)'''
+    if text == '':
+        return None
+    try:
+        return CustomSocketMessage._process_message(text)
+    except (ValueError, IndexError) as e:
+        errors.append(CSMDecodeError(text, str(e)))
+        return None
+
 
 class CustomSocketMessage:
 
@@ -14,7 +117,9 @@ class CustomSocketMessage:
         return CustomSocketMessage.encode(data)
 
     @staticmethod
-    def encode(data : Union[dict, Interface]) -> str:
+    def encode(data : Union[dict, Interface], *, binary = False) -> Union[str, bytes]:
+        if binary:
+            return BinaryMessage.encode(data)
         if isinstance(data, Interface):
             data = data.to_dict()
         message = ''
@@ -23,9 +128,16 @@ class CustomSocketMessage:
                 build = f'{key}:{data[key].hex()}<{type(data[key]).__name__}>'
             else:
                 build = f'{key}:{data[key]}<{type(data[key]).__name__}>'
-            message += '{' + build + '}*%*'
+            message += '{' + build + '}' + ITEM_SEPARATOR
         return message
     
+    @staticmethod
+    def encode_for_wire(data : Union[dict, Interface], wire_format : str) -> Union[str, bytes, list]:
+        '''Encode for a connection, binary messages with arrays come back as a list of buffers'''
+        if wire_format == 'binary':
+            return BinaryMessage.encode_buffers(data)
+        return CustomSocketMessage.encode(data)
+
     @staticmethod
     def _process_2D_list(data : str) -> Union[tuple, list]:
         '''
@@ -118,17 +230,37 @@ class CustomSocketMessage:
 
 
     @staticmethod
-    def decode(message : str, *, as_interface = False) -> dict:
+    def decode_stream(chunks : Iterable[Union[str, bytes]]) -> Iterator[Tuple[str, Any]]:
+        '''Decodes a text message from its chunks (e.g. as they are received), yielding (key, value) pairs as they complete'''
+        decoder = CSMDecoder()
+        for chunk in chunks:
+            yield from decoder.feed(chunk)
+        yield from decoder.finish()
+
+    @staticmethod
+    def decode(message : Union[str, bytes], *, as_interface = False, errors : List[CSMDecodeError] = None) -> dict:
+        '''
+        Decodes a whole message. Malformed items of a text message are skipped, the others are still
+        decoded, and a CSMDecodeError for each is appended to `errors` if a list is given.
+        '''
+        if BinaryMessage.is_binary(message):
+            return BinaryMessage.decode(message, as_interface=as_interface)
+        if Schema.is_schema_message(message):
+            return Schema.decode_message(message, as_interface=as_interface)
+        if errors is None:
+            errors = []
+        if not isinstance(message, str):
+            try:
+                message = bytes(message).decode()
+            except UnicodeDecodeError as e:
+                errors.append(CSMDecodeError(bytes(message).decode('utf-8', 'replace'), str(e)))
+                message = ''
+        # The whole message is here, no need for the incremental search
         data = {}
-        try:
-            message = message.split('*%*')
-            for item in message:
-                if item == '':
-                    continue
-                key, value = CustomSocketMessage._process_message(item)
-                data[key] = value
-        except:
-            pass
+        for text in message.split(ITEM_SEPARATOR):
+            item = _decode_item(text, errors)
+            if item is not None:
+                data[item[0]] = item[1]
         if as_interface:
                 interface = Interface()
                 interface.from_dict(data)
@@ -8,12 +8,50 @@
 # It should also be able to cleanly append a dictionary to itself and update its variables accordingly
 # The class should also be able to convert itself into a dictionary
 
+import re
 import time
-from typing import Any, Dict, Union
+import heapq
+import fnmatch
+import weakref
+import itertools
+from threading import Event, Lock, Thread
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from comms_core.history import History
+
+_observer_ids = itertools.count(1)
+
+# Longest sleep of an expiry timer, so it notices its Interface was garbage collected
+EXPIRY_TIMER_MAX_WAIT = 1.0
+
+def _run_expiry_timer(reference : weakref.ref):
+    '''Expire the values of an Interface at their remove time while it has observers, so they hear about it'''
+    while True:
+        interface = reference()
+        if interface is None:
+            return
+        with interface.interface_observer_lock:
+            if not interface.interface_observers:
+                interface.interface_expiry_timer = None
+                return
+        interface.expire()
+        wake = interface.interface_expiry_wake
+        next_wake = time.time() + EXPIRY_TIMER_MAX_WAIT
+        with interface.interface_lock:
+            if interface.interface_expiry:
+                next_wake = min(next_wake, interface.interface_expiry[0][0] + 0.001)
+        interface.interface_expiry_next = next_wake
+        # Only the weak reference is kept while sleeping
+        del interface
+        wake.wait(max(next_wake - time.time(), 0))
+        wake.clear()
 
 # A small helper class so each value can have a timestamp
 class DataObject:
 
+    # Thousands of these live in a world model, slots keep them small and fast to create
+    __slots__ = ('data', 'timestamp', '_timeout', 'deadline')
+
     def __init__(self, data = None, *, timeout = None, timestamp = None):
         self.set_data(data, timeout, timestamp)
 
@@ -21,10 +59,19 @@ class DataObject:
         return self.data == other.data
 
     def __floordiv__(self, data):
-        self.data = data
-        self.timestamp = time.time()
+        self.set_data(data, self._timeout)
         return self
 
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+        # Absolute time after which the value is gone, so reads compare against it directly
+        self.deadline = None if timeout is None else self.timestamp + timeout
+
     def set_data(self, data, timeout = None, timestamp = None):
         self.data = data
         self.timestamp = timestamp
@@ -33,7 +80,7 @@ class DataObject:
         self.timeout = timeout
 
     def get_data(self):
-        if self.timeout is not None and time.time() - self.timestamp > self.timeout:
+        if self.deadline is not None and time.time() > self.deadline:
             return None
         return self.data
 
@@ -51,6 +98,14 @@ class Interface:
     local_variables = [
         'interface_local_data',
         'interface_local_timestamp',
+        'interface_expiry',
+        'interface_observers',
+        'interface_observer_lock',
+        'interface_lock',
+        'interface_history',
+        'interface_expiry_timer',
+        'interface_expiry_wake',
+        'interface_expiry_next',
         'default_remove_time'
     ]
 
@@ -58,42 +113,190 @@ class Interface:
         self.default_remove_time = default_remove_time
         self.interface_local_data : Dict[str, DataObject] = {}
         self.interface_local_timestamp = time.time()
+        # Min-heap of (deadline, key) for the values with a remove time. Entries are not removed
+        # when a value is updated, an entry is stale if the key's deadline no longer matches it.
+        self.interface_expiry : List[Tuple[float, str]] = []
+        # id -> (matcher, callback, executor), replaced rather than modified so notifying needs no lock
+        self.interface_observers : Dict[int, tuple] = {}
+        self.interface_observer_lock = Lock()
+        # Guards interface_local_data and the deadline heap, the expiry timer changes them from its own thread.
+        # Observers are called after it is released.
+        self.interface_lock = Lock()
+        # Keys with history enabled, see enable_history
+        self.interface_history : Dict[str, History] = {}
+        # Runs while there are observers, sleeps until the head of the deadline heap
+        self.interface_expiry_timer : Union[Thread, None] = None
+        self.interface_expiry_wake = Event()
+        self.interface_expiry_next = float('inf')
 
     def change_default_remove_time(self, remove_time):
-        self.default_remove_time = remove_time
-        for key in self.interface_local_data:
-            self.set_remove_time(key, remove_time)
+        with self.interface_lock:
+            self.default_remove_time = remove_time
+            for data_object in self.interface_local_data.values():
+                data_object.timeout = remove_time
+            self._rebuild_expiry()
+            if self.interface_expiry:
+                self._wake_expiry_timer(self.interface_expiry[0][0])
 
     def set_remove_time(self, key, remove_time):
-        self.interface_local_data[key].timeout = remove_time
+        with self.interface_lock:
+            data_object = self.interface_local_data[key]
+            data_object.timeout = remove_time
+            if data_object.deadline is not None:
+                heapq.heappush(self.interface_expiry, (data_object.deadline, key))
+                self._wake_expiry_timer(data_object.deadline)
+
+    def _wake_expiry_timer(self, deadline : float):
+        if self.interface_expiry_timer is not None and deadline < self.interface_expiry_next:
+            self.interface_expiry_wake.set()
+
+    def _rebuild_expiry(self):
+        # Called with interface_lock held
+        self.interface_expiry = [(data_object.deadline, key) for key, data_object in self.interface_local_data.items()
+                                 if data_object.deadline is not None]
+        heapq.heapify(self.interface_expiry)
+
+    def expire(self, now : float = None) -> List[str]:
+        '''Remove every value past its remove time, returns the removed keys'''
+        expiry = self.interface_expiry
+        if not expiry:
+            return []
+        if now is None:
+            now = time.time()
+        expired = []
+        local_data = self.interface_local_data
+        with self.interface_lock:
+            while expiry and expiry[0][0] < now:
+                deadline, key = heapq.heappop(expiry)
+                data_object = local_data.get(key)
+                if data_object is not None and data_object.deadline == deadline:
+                    del local_data[key]
+                    expired.append(key)
+        if expired and self.interface_observers:
+            self._notify({}, expired)
+        return expired
+
+    def subscribe(self, pattern : str, callback : Callable, *, executor = None) -> int:
+        '''
+        Call `callback(changed, removed)` when keys matching the pattern (a key or an fnmatch
+        pattern like 'pose_*') are set, deleted or expire. `changed` maps keys to their new values,
+        `removed` lists deleted and expired keys. from_dict makes a single call with every
+        matching key. Expiry is reported at the remove time by a timer thread that runs while
+        the interface has observers. With an executor the callback is submitted to it, otherwise
+        it runs in the thread that made the change (the timer thread for expiry). Returns an id
+        for unsubscribe.
+        '''
+        if any(char in pattern for char in '*?['):
+            matcher = re.compile(fnmatch.translate(pattern)).match
+        else:
+            matcher = pattern.__eq__
+        with self.interface_observer_lock:
+            observer_id = next(_observer_ids)
+            self.interface_observers = {**self.interface_observers, observer_id: (matcher, callback, executor)}
+            if self.interface_expiry_timer is None:
+                self.interface_expiry_next = float('inf')
+                self.interface_expiry_timer = Thread(target=_run_expiry_timer, args=(weakref.ref(self),), daemon=True)
+                self.interface_expiry_timer.start()
+        return observer_id
+
+    def unsubscribe(self, observer_id : int):
+        with self.interface_observer_lock:
+            observers = dict(self.interface_observers)
+            observers.pop(observer_id, None)
+            self.interface_observers = observers
+        if not observers:
+            # Let the expiry timer see there is nobody left to notify
+            self.interface_expiry_wake.set()
+
+    def _notify(self, changed : Dict[str, Any], removed : List[str]):
+        for matcher, callback, executor in self.interface_observers.values():
+            matched_changes = {key: value for key, value in changed.items() if matcher(key)}
+            matched_removed = [key for key in removed if matcher(key)]
+            if not matched_changes and not matched_removed:
+                continue
+            if executor is not None:
+                executor.submit(callback, matched_changes, matched_removed)
+            else:
+                callback(matched_changes, matched_removed)
+
+    def wait_for_change(self, pattern : str = '*', timeout : float = None) -> bool:
+        '''
+        Sleep until a key matching the pattern changes, is removed or expires.
+        Returns False if the timeout passed first.
+        '''
+        changed = Event()
+        observer_id = self.subscribe(pattern, lambda changes, removed: changed.set())
+        try:
+            # Expiry is reported by the timer thread started with the subscription
+            return changed.wait(timeout)
+        finally:
+            self.unsubscribe(observer_id)
+
+    def enable_history(self, key : str, capacity = 256) -> History:
+        '''Keep the last `capacity` values of a key, including the current one if it is set'''
+        with self.interface_lock:
+            history = self.interface_history.get(key)
+            if history is None:
+                history = self.interface_history[key] = History(capacity)
+                data_object = self.interface_local_data.get(key)
+                if data_object is not None:
+                    history.append(data_object.timestamp, data_object.data)
+            return history
+
+    def disable_history(self, key : str):
+        self.interface_history.pop(key, None)
+
+    def history(self, key : str) -> Union[History, None]:
+        return self.interface_history.get(key)
+
+    def _set(self, name : str, value : Any, timestamp : float):
+        # Called with interface_lock held
+        data_object = self.interface_local_data.get(name)
+        if data_object is None:
+            data_object = self.interface_local_data[name] = DataObject(value, timeout = self.default_remove_time, timestamp = timestamp)
+        else:
+            data_object.set_data(value, data_object.timeout, timestamp)
+        if self.interface_history and name in self.interface_history:
+            self.interface_history[name].append(data_object.timestamp, value)
+        if data_object.deadline is not None:
+            expiry = self.interface_expiry
+            heapq.heappush(expiry, (data_object.deadline, name))
+            if data_object.deadline < self.interface_expiry_next:
+                self._wake_expiry_timer(data_object.deadline)
+            if len(expiry) > 2 * len(self.interface_local_data) + 64:
+                # Mostly stale entries from frequently updated keys
+                self._rebuild_expiry()
 
     def get_timestamp(self):
         return self.interface_local_timestamp
 
     def get_data_object(self, name : str) -> Union[DataObject, None]:
-        if name not in self.interface_local_data:
-            return None
-        return self.interface_local_data[name]
+        return self.interface_local_data.get(name)
 
     def __setattr__(self, name: str, value: Any) -> None:
         if name in Interface.local_variables:
             return super().__setattr__(name, value)
-        if name in self.interface_local_data:
-            self.interface_local_data[name] // value
-        else:
-            self.interface_local_data[name] = DataObject(value, timeout = self.default_remove_time)
-        self.interface_local_timestamp = time.time()
+        now = time.time()
+        with self.interface_lock:
+            self._set(name, value, now)
+            self.interface_local_timestamp = now
+        if self.interface_observers:
+            self._notify({name: value}, [])
 
     def __getattr__(self, name: str) -> Any:
         if name in Interface.local_variables:
             return super().__getattr__(name)
-        if name not in self.interface_local_data:
+        data_object = self.interface_local_data.get(name)
+        if data_object is None:
             return None
-        return self.interface_local_data[name].get_data()
+        return data_object.get_data()
     
     def __delattr__(self, name: str) -> None:
-        if name in self.interface_local_data:
-            del self.interface_local_data[name]
+        # A heap entry left behind is skipped by expire() since the key is gone
+        with self.interface_lock:
+            removed = self.interface_local_data.pop(name, None) is not None
+        if removed and self.interface_observers:
+            self._notify({}, [name])
 
     def __add__(self, other):
         if isinstance(other, dict):
@@ -111,14 +314,42 @@ class Interface:
     def __delitem__(self, name: str) -> None:
         self.__delattr__(name)
 
+    # Membership and length only compare deadlines, they must not remove keys from under a running iteration
     def __contains__(self, name: str) -> bool:
-        return name in self.interface_local_data
+        data_object = self.interface_local_data.get(name)
+        return data_object is not None and (data_object.deadline is None or data_object.deadline >= time.time())
     
     def __iter__(self):
-        return iter(self.interface_local_data)
+        self.expire()
+        with self.interface_lock:
+            return iter(list(self.interface_local_data))
     
     def __len__(self):
-        return len(self.interface_local_data)
+        now = time.time()
+        local_data = self.interface_local_data
+        expired = 0
+        with self.interface_lock:
+            for key in self._past_deadline(now):
+                data_object = local_data.get(key)
+                if data_object is not None and data_object.deadline is not None and data_object.deadline < now:
+                    expired += 1
+            return len(local_data) - expired
+
+    def _past_deadline(self, now : float) -> set:
+        '''Keys of the heap entries before `now` (some may be stale), found without popping them. Called with interface_lock held.'''
+        expiry = self.interface_expiry
+        keys = set()
+        positions = [0]
+        while positions:
+            position = positions.pop()
+            try:
+                deadline, key = expiry[position]
+            except IndexError:
+                continue
+            if deadline < now:
+                keys.add(key)
+                positions += (2 * position + 1, 2 * position + 2)
+        return keys
     
     def __str__(self):
         return f'Interface: Last Update: {self.interface_local_timestamp}\n' + str(self.to_dict_with_timestamps())
@@ -126,27 +357,33 @@ class Interface:
     def __repr__(self) -> str:
         return str(self)
     
+    # Snapshots evict the expired keys in one pass and then copy the values without checking the clock per key
     def to_dict(self):
-        return {key: self.interface_local_data[key].get_data() for key in self.interface_local_data}
+        self.expire()
+        with self.interface_lock:
+            return {key: data_object.data for key, data_object in self.interface_local_data.items()}
     
     def to_dict_with_timestamps(self):
-        return {key: (self.interface_local_data[key].get_data(), self.interface_local_data[key].get_timestamp()) for key in self.interface_local_data}
+        self.expire()
+        with self.interface_lock:
+            return {key: (data_object.data, data_object.timestamp) for key, data_object in self.interface_local_data.items()}
     
     def from_dict(self, data: Dict[str, Any]):
-        for key in data:
-            if key in self.interface_local_data:
-                self.interface_local_data[key] // data[key]
-            else:
-                self.interface_local_data[key] = DataObject(data[key], timeout = self.default_remove_time)
-        self.interface_local_timestamp = time.time()
+        now = time.time()
+        with self.interface_lock:
+            for key, value in data.items():
+                self._set(key, value, now)
+            self.interface_local_timestamp = now
+        if self.interface_observers:
+            self._notify(data, [])
 
     def from_dict_with_timestamps(self, data: Dict[str, tuple]):
-        for key in data:
-            if key in self.interface_local_data:
-                self.interface_local_data[key] // data[key]
-            else:
-                self.interface_local_data[key] = DataObject(data[key][0], timeout = self.default_remove_time, timestamp = data[key][1])
-        self.interface_local_timestamp = time.time()
+        with self.interface_lock:
+            for key, (value, timestamp) in data.items():
+                self._set(key, value, timestamp)
+            self.interface_local_timestamp = time.time()
+        if self.interface_observers:
+            self._notify({key: value for key, (value, _) in data.items()}, [])
 
     def from_interface(self, other):
         self.from_dict_with_timestamps(other.to_dict_with_timestamps())
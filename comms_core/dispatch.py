@@ -0,0 +1,136 @@
+from concurrent.futures import Executor, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict, Hashable
+
+from .logger import Logger
+from .send_queue import SendQueue, check_queue_policy
+
+
+class CallbackDispatcher(Logger):
+    '''
+    Runs message callbacks away from the I/O threads of a Client or Server.
+
+    Every connection has a bounded inbox (a SendQueue, with the same policies) drained by one task
+    at a time on a thread pool: a connection's callbacks run one after the other in the order the
+    messages arrived, different connections run in parallel. With the default 'drop_oldest' policy a
+    full inbox drops its oldest message so the I/O thread never waits for a slow callback. With 'block'
+    the I/O thread waits up to `inbox_timeout` seconds for room (the sender is slowed down by TCP flow
+    control) and the message is dropped after that. Every dropped message is logged as a warning.
+
+    With `executor` (e.g. a ProcessPoolExecutor) every call is submitted to it and waited for by the
+    drain task, so CPU heavy callbacks use several cores and still see one connection's messages in
+    order. The callbacks and messages must then be picklable.
+
+    With workers=0 and no executor, callbacks run right away on the I/O thread.
+    '''
+
+    def __init__(self, workers = 4, *, inbox_size = 1024, inbox_policy = 'drop_oldest', inbox_timeout = 1.0,
+                 executor : Executor = None):
+        super().__init__('CallbackDispatcher')
+        check_queue_policy(inbox_policy)
+        self.workers = workers
+        self.inbox_size = inbox_size
+        self.inbox_policy = inbox_policy
+        self.inbox_timeout = inbox_timeout
+        self.executor = executor
+        self.pool : ThreadPoolExecutor = None
+        # connection -> [inbox, draining]
+        self.inboxes : Dict[Hashable, list] = {}
+        self.lock = Lock()
+        # Messages that timed out waiting for room, and dropped by inboxes that were discarded since
+        self.dropped = 0
+        self.closed = False
+
+    @property
+    def inline(self) -> bool:
+        return self.workers == 0 and self.executor is None
+
+    def submit(self, connection : Hashable, callback : Callable, data : Any, peer : Any) -> bool:
+        '''Queues callback(data, peer) behind the connection's earlier messages, returns False if it was not accepted'''
+        if self.inline:
+            self._call(callback, data, peer)
+            return True
+        with self.lock:
+            if self.closed:
+                return False
+            entry = self.inboxes.get(connection)
+            if entry is None:
+                entry = self.inboxes[connection] = [SendQueue(self.inbox_size, self.inbox_policy), False]
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max(1, self.workers), thread_name_prefix='callback')
+        inbox : SendQueue = entry[0]
+        dropped = inbox.dropped
+        if not inbox.put((callback, data, peer), timeout=self.inbox_timeout):
+            with self.lock:
+                if self.closed or inbox.closed:
+                    return False
+                self.dropped += 1
+            self.warning('Callback inbox of %s full for %ss, dropped a message', peer, self.inbox_timeout)
+            return False
+        # drop_oldest made room for this message
+        if inbox.dropped != dropped:
+            self.warning('Callback inbox of %s full, dropped its oldest message', peer)
+        with self.lock:
+            # A drain task that is running picks the message up
+            if entry[1]:
+                return True
+            entry[1] = True
+        try:
+            self.pool.submit(self._drain, entry)
+        except RuntimeError:
+            # Shut down in the meantime
+            return False
+        return True
+
+    def _drain(self, entry : list):
+        inbox : SendQueue = entry[0]
+        for callback, data, peer in inbox.get_all():
+            self._call(callback, data, peer)
+        with self.lock:
+            # Checked under the lock, submit() starts a new task for anything queued after this
+            if len(inbox) == 0 or self.closed:
+                entry[1] = False
+                return
+        # Back at the end of the pool's queue so a busy connection does not hold a worker forever
+        self.pool.submit(self._drain, entry)
+
+    def _call(self, callback : Callable, data : Any, peer : Any):
+        try:
+            if self.executor is not None:
+                self.executor.submit(callback, data, peer).result()
+            else:
+                callback(data, peer)
+        except Exception as e:
+            self.error(f'Callback for {peer} failed: {type(e).__name__}: {e}')
+
+    def discard(self, connection : Hashable):
+        '''The connection was closed, the messages already in its inbox are still delivered'''
+        with self.lock:
+            entry = self.inboxes.pop(connection, None)
+            if entry is not None:
+                self.dropped += entry[0].dropped
+
+    def queue_depth(self, connection : Hashable = None) -> int:
+        '''Messages waiting for a callback, of one connection or of all of them'''
+        with self.lock:
+            entries = list(self.inboxes.values()) if connection is None else [self.inboxes.get(connection)]
+        return sum(len(entry[0]) for entry in entries if entry is not None)
+
+    def stats(self) -> dict:
+        with self.lock:
+            entries = list(self.inboxes.values())
+            dropped = self.dropped
+        return {'queued': sum(len(entry[0]) for entry in entries),
+                'dropped': dropped + sum(entry[0].dropped for entry in entries)}
+
+    def shutdown(self):
+        '''Messages still queued are dropped, an executor passed in is left to its owner'''
+        with self.lock:
+            self.closed = True
+            entries = list(self.inboxes.values())
+            self.inboxes.clear()
+        for inbox, _ in entries:
+            inbox.close()
+            inbox.clear()
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
@@ -0,0 +1,439 @@
+import os
+import struct
+import socket
+from collections import deque
+from typing import Any, Deque, Iterator, List, Tuple, Union
+
+# Every message on the stream is sent as a frame:
+# [length : uint32][flags : uint8][payload : length bytes]
+HEADER = struct.Struct('!IB')
+
+# Payload is raw bytes rather than utf-8 text
+FLAG_BYTES = 0x01
+# Payload starts with the name of the topic it was published on: [length : uint16][utf-8 name]
+FLAG_TOPIC = 0x02
+# Payload is a protocol message ('<command> <argument>', utf-8) and not passed to callbacks
+FLAG_CONTROL = 0x04
+# Payload (including the topic name) is compressed with the codec negotiated in the handshake
+FLAG_COMPRESSED = 0x08
+# Payload is an RPC request or response (see rpc.py) and not passed to callbacks
+FLAG_RPC = 0x10
+# Payload is a piece of a bulk message, with FLAG_MORE on every piece but the last one (which carries
+# the message's flags). Other frames may be written between the pieces, only one message is split at a time.
+FLAG_CHUNK = 0x20
+FLAG_MORE = 0x40
+
+TOPIC_HEADER = struct.Struct('!H')
+
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+# Size of the pieces bulk messages are written in, more urgent frames can go out between two of them
+CHUNK_SIZE = 64 * 1024
+
+# Bytes a FrameWriter holds for the socket before the I/O loops stop taking messages from the send queue
+WRITE_LIMIT = 256 * 1024
+
+
+class FrameError(Exception):
+    pass
+
+
+def _payload_parts(data : Union[str, bytes, list], flags : int) -> Tuple[list, int]:
+    if isinstance(data, str):
+        return [data.encode()], flags
+    if isinstance(data, list):
+        return [memoryview(part).cast('B') for part in data], flags | FLAG_BYTES
+    return [data], flags | FLAG_BYTES
+
+
+class Frame:
+    '''
+    A message encoded once that can be queued for any number of connections,
+    FrameWriter references its payload instead of encoding or copying it again.
+    With a compressor, payloads of at least `threshold` bytes are compressed (when that makes them smaller).
+    The original data and topic are kept for the flight recorder.
+    '''
+
+    __slots__ = ('parts', 'flags', 'length', 'data', 'topic')
+
+    def __init__(self, data : Union[str, bytes, list], flags : int = 0, *, topic : str = None,
+                 compressor = None, threshold : int = 0):
+        parts, flags = _payload_parts(data, flags)
+        if topic is not None:
+            name = topic.encode()
+            parts.insert(0, TOPIC_HEADER.pack(len(name)) + name)
+            flags |= FLAG_TOPIC
+        if compressor is not None and sum(len(part) for part in parts) >= threshold:
+            payload = b''.join(parts)
+            compressed = compressor.compress(payload)
+            if len(compressed) < len(payload):
+                parts = [compressed]
+                flags |= FLAG_COMPRESSED
+        self.parts = parts
+        self.flags = flags
+        self.length = sum(len(part) for part in parts)
+        self.data = data
+        self.topic = topic
+
+
+def pack_frame(data : Union[str, bytes, list, Frame], flags : int = 0) -> Union[bytes, list]:
+    '''
+    Returns the frame as bytes, or as a list of buffers (header first) when the data is
+    a list of buffers or a Frame to be sent with scatter-gather I/O without joining them.
+    '''
+    if isinstance(data, Frame):
+        return [HEADER.pack(data.length, data.flags), *data.parts]
+    if isinstance(data, str):
+        payload = data.encode()
+    elif isinstance(data, list):
+        return [HEADER.pack(sum(memoryview(part).nbytes for part in data), flags | FLAG_BYTES), *data]
+    else:
+        payload = bytes(data)
+        flags |= FLAG_BYTES
+    return HEADER.pack(len(payload), flags) + payload
+
+
+def _max_iov() -> int:
+    try:
+        return max(16, os.sysconf('SC_IOV_MAX'))
+    except (AttributeError, ValueError, OSError):
+        return 1024
+
+# Maximum number of buffers passed to one sendmsg call
+IOV_MAX = _max_iov()
+
+
+class FrameWriter:
+    '''
+    Outgoing frames of one connection, written with scatter-gather I/O.
+
+    Headers and small payloads are packed back to back into a preallocated buffer, larger
+    payloads and array buffers are referenced without copying. flush() writes everything
+    pending with a single sendmsg call and keeps track of partial writes, so it can be called
+    again on the next loop iteration (or writable event) to resume where it stopped.
+
+    Bulk frames wait in their own queue and are written in CHUNK_SIZE pieces (FLAG_CHUNK), one piece per
+    flush() and only once everything else went out, so frames added in the meantime overtake them.
+
+    The writer itself is not bounded, callers check has_room() before adding more so messages of a
+    stalled connection stay in its (bounded) send queue.
+    '''
+
+    def __init__(self, buffer_size : int = 65536, *, copy_threshold : int = 4096, chunk_size : int = CHUNK_SIZE,
+                 limit : int = WRITE_LIMIT):
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.copy_threshold = copy_threshold
+        # Used part of the buffer, and the start of the part not yet referenced in pending
+        self.offset = 0
+        self.region_start = 0
+        self.pending : List[memoryview] = []
+        self.pending_bytes = 0
+        self.chunk_size = chunk_size
+        self.limit = limit
+        # [payload buffers left, flags, message, mark] of the bulk frames, the first one may be partly written
+        self.bulk : Deque[list] = deque()
+        self.bulk_bytes = 0
+        # Messages of the bulk frames whose last piece was written since the last call to completed()
+        self.finished : List[Any] = []
+        # Totals for the metrics, kept by clear()
+        self.bytes_written = 0
+        self.partial_writes = 0
+        # Bytes of frames added so far, and (position of the last byte, mark) of the marked frames not written yet
+        self.position = 0
+        self.marks : Deque[tuple] = deque()
+        # Marks of the frames written since the last call to sent_marks()
+        self.sent : List[Any] = []
+
+    def __len__(self):
+        return self.pending_bytes + self.offset - self.region_start + self.bulk_bytes
+
+    def has_room(self, bulk = False) -> bool:
+        '''
+        Whether more frames should be added: less than `limit` bytes wait for the socket,
+        or for a bulk frame, no other bulk frame is waiting.
+        '''
+        if bulk:
+            return not self.bulk
+        return self.room() > 0
+
+    def room(self) -> int:
+        '''Bytes of regular frames that can still be added before reaching `limit`'''
+        return self.limit - (self.pending_bytes + self.offset - self.region_start)
+
+    def _close_region(self):
+        if self.offset > self.region_start:
+            self.pending.append(self.view[self.region_start:self.offset])
+            self.pending_bytes += self.offset - self.region_start
+            self.region_start = self.offset
+
+    def _append(self, data):
+        '''Copy small data into the buffer, reference anything else'''
+        size = len(data)
+        if size <= self.copy_threshold and len(self.buffer) - self.offset >= size:
+            self.buffer[self.offset:self.offset + size] = data
+            self.offset += size
+        else:
+            self._close_region()
+            self.pending.append(data if isinstance(data, memoryview) else memoryview(data))
+            self.pending_bytes += size
+
+    def add(self, data : Union[str, bytes, list, Frame], flags : int = 0, *, bulk = False, message : Any = None,
+            mark : Any = None):
+        '''
+        Queues a frame. A bulk frame is written later in pieces, `message` (the data by default) is
+        returned by completed() once its last piece was queued for the socket.
+        `mark` (e.g. the enqueue time for the metrics) is returned by sent_marks() once the last byte
+        of the frame was written to the socket.
+        '''
+        if isinstance(data, Frame):
+            parts, flags, length = data.parts, data.flags, data.length
+        else:
+            parts, flags = _payload_parts(data, flags)
+            length = sum(len(part) for part in parts)
+        if bulk:
+            self.bulk.append([[memoryview(part).cast('B') for part in parts], flags, data if message is None else message, mark])
+            self.bulk_bytes += length
+            return
+        self._add_frame(parts, flags, length)
+        if mark is not None:
+            self.marks.append((self.position, mark))
+
+    def _add_frame(self, parts : list, flags : int, length : int):
+        self.position += HEADER.size + length
+        if len(self.buffer) - self.offset >= HEADER.size:
+            HEADER.pack_into(self.buffer, self.offset, length, flags)
+            self.offset += HEADER.size
+        else:
+            self._close_region()
+            header = HEADER.pack(length, flags)
+            self.pending.append(memoryview(header))
+            self.pending_bytes += len(header)
+        for part in parts:
+            self._append(part)
+
+    def _next_chunk(self):
+        entry = self.bulk[0]
+        parts, flags, message, mark = entry
+        size = 0
+        chunk = []
+        while parts and size < self.chunk_size:
+            part = parts[0]
+            missing = self.chunk_size - size
+            if part.nbytes > missing:
+                parts[0] = part[missing:]
+                part = part[:missing]
+            else:
+                parts.pop(0)
+            chunk.append(part)
+            size += part.nbytes
+        self.bulk_bytes -= size
+        if parts:
+            self._add_frame(chunk, FLAG_CHUNK | FLAG_MORE, size)
+        else:
+            self.bulk.popleft()
+            self._add_frame(chunk, flags | FLAG_CHUNK, size)
+            self.finished.append(message)
+            if mark is not None:
+                self.marks.append((self.position, mark))
+
+    def chunks_waiting(self) -> bool:
+        '''Everything but bulk pieces was written, the next flush() starts a new piece'''
+        return bool(self.bulk) and not self.pending and self.offset == self.region_start
+
+    def completed(self) -> List[Any]:
+        '''Messages of the bulk frames fully queued for the socket since the last call, in the order they complete'''
+        finished, self.finished = self.finished, []
+        return finished
+
+    def sent_marks(self) -> List[Any]:
+        '''Marks of the frames whose last byte was written to the socket since the last call, in order'''
+        sent, self.sent = self.sent, []
+        return sent
+
+    def flush(self, sock : socket.socket) -> bool:
+        '''
+        One sendmsg call with everything pending, or with the next piece of a bulk frame if nothing else is.
+        Returns True once nothing is left to write.
+        Raises the socket errors (ConnectionResetError, BrokenPipeError, ...) to the caller.
+        '''
+        self._close_region()
+        if not self.pending:
+            if not self.bulk:
+                return True
+            self._next_chunk()
+            self._close_region()
+        buffers = self.pending[:IOV_MAX]
+        try:
+            if hasattr(sock, 'sendmsg'):
+                sent = sock.sendmsg(buffers)
+            else:
+                sent = sock.send(b''.join(buffers))
+        except (BlockingIOError, InterruptedError, socket.timeout):
+            # Nothing was written, try again later
+            return False
+        self.pending_bytes -= sent
+        self.bytes_written += sent
+        marks = self.marks
+        while marks and marks[0][0] <= self.bytes_written:
+            self.sent.append(marks.popleft()[1])
+        written = 0
+        while written < len(buffers) and sent >= buffers[written].nbytes:
+            sent -= buffers[written].nbytes
+            written += 1
+        del self.pending[:written]
+        if sent:
+            self.partial_writes += 1
+            self.pending[0] = self.pending[0][sent:]
+        if self.pending:
+            return False
+        # Everything went out, the buffer can be reused from the start
+        self.offset = self.region_start = 0
+        return not self.bulk
+
+    def clear(self) -> List[Any]:
+        '''Drops everything pending, returns the messages of the bulk frames that were not completely written'''
+        unfinished = [message for _, _, message, _ in self.bulk]
+        self.pending.clear()
+        self.pending_bytes = 0
+        # Positions continue from what was actually written
+        self.position = self.bytes_written
+        self.marks.clear()
+        self.offset = self.region_start = 0
+        self.bulk.clear()
+        self.bulk_bytes = 0
+        return unfinished
+
+
+def unpack_payload(payload : bytes, flags : int) -> Union[str, bytes]:
+    if flags & FLAG_BYTES:
+        return payload
+    return payload.decode()
+
+
+def unpack_message(payload : bytes, flags : int, compressor = None) -> Tuple[Union[str, bytes], Union[str, None]]:
+    '''
+    Returns the data and the topic it was published on (None for a direct message).
+    `compressor` is the codec negotiated for the connection, if any.
+    '''
+    if flags & FLAG_COMPRESSED:
+        if compressor is None:
+            raise FrameError('Received a compressed frame but no compression was negotiated')
+        payload = compressor.decompress(payload, MAX_FRAME_SIZE)
+    if not flags & FLAG_TOPIC:
+        return unpack_payload(payload, flags), None
+    (length,) = TOPIC_HEADER.unpack_from(payload)
+    offset = TOPIC_HEADER.size + length
+    return unpack_payload(payload[offset:], flags), payload[TOPIC_HEADER.size:offset].decode()
+
+
+class FrameBuffer:
+    '''
+    Reusable receive buffer that reassembles frames from a byte stream.
+    Data is received directly into the buffer with recv_into, complete frames are
+    sliced out and any partial frame is kept until the rest of it arrives.
+    '''
+
+    def __init__(self, size : int = 65536, *, max_frame_size : int = MAX_FRAME_SIZE):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+        self.max_frame_size = max_frame_size
+        self.assembler = ChunkAssembler(max_frame_size)
+
+    def __len__(self):
+        return self.end - self.start
+
+    def _reserve(self, needed : int):
+        '''Make sure at least `needed` bytes are free at the end of the buffer'''
+        if len(self.buffer) - self.end >= needed:
+            return
+        pending = self.end - self.start
+        if len(self.buffer) - pending >= needed:
+            # Compact, move the pending bytes to the front
+            self.buffer[:pending] = self.view[self.start:self.end]
+        else:
+            size = len(self.buffer)
+            while size - pending < needed:
+                size *= 2
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.start:self.end]
+            self.view.release()
+            self.buffer = buffer
+            self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = pending
+
+    @property
+    def in_bulk(self) -> bool:
+        '''Part of a bulk message was received, the rest of its pieces are on the way'''
+        return bool(self.assembler.chunks)
+
+    def recv_into(self, sock, size : int = 4096) -> int:
+        '''Receive from the socket into the buffer, returns the number of bytes read (0 if closed)'''
+        self._reserve(size)
+        n = sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def feed(self, data : bytes):
+        self._reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+
+    def frames(self) -> Iterator[Tuple[bytes, int]]:
+        '''Yield (payload, flags) for every complete frame in the buffer, pieces of a bulk message are joined'''
+        while self.end - self.start >= HEADER.size:
+            length, flags = HEADER.unpack_from(self.buffer, self.start)
+            if length > self.max_frame_size:
+                raise FrameError(f'Frame of {length} bytes exceeds the maximum of {self.max_frame_size}')
+            frame_end = self.start + HEADER.size + length
+            if frame_end > self.end:
+                # Partial frame, make room so the rest can be received in place
+                self._reserve(frame_end - self.end)
+                break
+            payload = bytes(self.view[self.start + HEADER.size:frame_end])
+            self.start = frame_end
+            frame = self.assembler.add(payload, flags)
+            if frame is not None:
+                yield frame
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def messages(self) -> Iterator[Union[str, bytes]]:
+        for payload, flags in self.frames():
+            yield unpack_payload(payload, flags)
+
+
+class ChunkAssembler:
+    '''Puts bulk messages written in pieces (FLAG_CHUNK) back together on the receiving side'''
+
+    def __init__(self, max_size : int = MAX_FRAME_SIZE):
+        self.max_size = max_size
+        self.chunks : List[bytes] = []
+        self.size = 0
+
+    def add(self, payload : bytes, flags : int) -> Union[Tuple[bytes, int], None]:
+        '''(payload, flags) of a complete frame, None while a message is still missing pieces'''
+        if not flags & FLAG_CHUNK:
+            return payload, flags
+        self.size += len(payload)
+        if self.size > self.max_size:
+            raise FrameError(f'Chunked message exceeds the maximum of {self.max_size} bytes')
+        self.chunks.append(payload)
+        if flags & FLAG_MORE:
+            return None
+        payload = b''.join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return payload, flags & ~FLAG_CHUNK
+
+
+async def read_frame(reader) -> Tuple[bytes, int]:
+    '''Read one (payload, flags) frame from an asyncio.StreamReader'''
+    length, flags = HEADER.unpack(await reader.readexactly(HEADER.size))
+    if length > MAX_FRAME_SIZE:
+        raise FrameError(f'Frame of {length} bytes exceeds the maximum of {MAX_FRAME_SIZE}')
+    payload = await reader.readexactly(length)
+    return payload, flags
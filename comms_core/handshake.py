@@ -0,0 +1,51 @@
+from typing import Dict, Tuple, Union
+
+from .framing import Frame, FLAG_CONTROL
+
+# The first message a client sends is 'Client: <hostname>', optionally followed by
+# ';key=value' options describing what the client supports.
+# Servers that do not know an option simply ignore it.
+HANDSHAKE_PREFIX = 'Client: '
+
+WIRE_FORMATS = ('text', 'binary')
+
+
+def build_handshake(hostname : str, **options) -> str:
+    message = HANDSHAKE_PREFIX + hostname
+    for key, value in options.items():
+        if value is None:
+            continue
+        message += f';{key}={value}'
+    return message
+
+
+def is_handshake(data : Union[str, bytes]) -> bool:
+    return isinstance(data, str) and data.startswith(HANDSHAKE_PREFIX)
+
+
+def parse_handshake(data : str) -> Tuple[str, Dict[str, str]]:
+    '''Returns the hostname and the options of a handshake message'''
+    items = data[len(HANDSHAKE_PREFIX):].split(';')
+    options = {}
+    for item in items[1:]:
+        if '=' in item:
+            key, value = item.split('=', 1)
+            options[key.strip()] = value.strip()
+    return items[0], options
+
+
+def check_wire_format(wire_format : str) -> str:
+    if wire_format not in WIRE_FORMATS:
+        raise ValueError(f'Unknown wire format {wire_format!r}, expected one of {WIRE_FORMATS}')
+    return wire_format
+
+
+# Control frames carry '<command> <argument>' on an established connection,
+# e.g. 'subscribe <topic>'. They are never passed to message callbacks.
+def control_frame(command : str, argument : str = '') -> Frame:
+    return Frame(f'{command} {argument}', FLAG_CONTROL)
+
+
+def parse_control(payload : bytes) -> Tuple[str, str]:
+    command, _, argument = payload.decode().partition(' ')
+    return command, argument
@@ -0,0 +1,192 @@
+from array import array
+from typing import Any, List, Tuple, Union
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+# array typecodes that hold a Python int or float exactly
+_TYPECODES = {int: 'q', float: 'd'}
+_INT_RANGE = (-(1 << 63), 1 << 63)
+
+
+def _fits_typecode(item, element_type) -> bool:
+    if type(item) is not element_type:
+        return False
+    return element_type is float or _INT_RANGE[0] <= item < _INT_RANGE[1]
+
+
+class History:
+    '''
+    Fixed capacity ring buffer of (timestamp, value) samples for one key.
+
+    Ints and floats are stored in preallocated arrays ('q' or 'd'), tuples or lists of a fixed
+    length with a single element type (e.g. a pose tuple) as rows of `width` items, ndarrays in
+    a preallocated ndarray of their shape and dtype, anything else in a preallocated list.
+    The storage is allocated on the first sample, appending after that only writes into it.
+    Values come back with the type and shape they were appended with. A sample that does not
+    match the storage (another type, length or shape) moves the buffer to the list storage.
+    Samples older than the newest one are dropped so the buffer stays sorted by time.
+    '''
+
+    def __init__(self, capacity = 256):
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1')
+        self.capacity = capacity
+        self.times = array('d', bytes(8 * capacity))
+        self.values : Union[array, list, Any] = None
+        # 'scalar', 'vector', 'ndarray' or 'object', decided by the first sample
+        self.kind = None
+        self.width = 1
+        # int or float for scalars and vector items, tuple or list for vectors
+        self.element_type = None
+        self.container = None
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def clear(self):
+        self.start = 0
+        self.count = 0
+
+    def _allocate(self, value):
+        value_type = type(value)
+        if value_type in _TYPECODES and _fits_typecode(value, value_type):
+            self.kind, self.width, self.element_type = 'scalar', 1, value_type
+            self.values = array(_TYPECODES[value_type], bytes(8 * self.capacity))
+        elif value_type in (tuple, list) and value and type(value[0]) in _TYPECODES \
+                and all(_fits_typecode(item, type(value[0])) for item in value):
+            self.kind, self.width = 'vector', len(value)
+            self.element_type, self.container = type(value[0]), value_type
+            self.values = array(_TYPECODES[self.element_type], bytes(8 * self.capacity * self.width))
+        elif np is not None and isinstance(value, np.ndarray):
+            self.kind, self.width = 'ndarray', 1
+            self.values = np.zeros((self.capacity,) + value.shape, dtype=value.dtype)
+        else:
+            self.kind, self.width = 'object', 1
+            self.values = [None] * self.capacity
+
+    def _fits(self, value) -> bool:
+        if self.kind == 'scalar':
+            return _fits_typecode(value, self.element_type)
+        if self.kind == 'vector':
+            return type(value) is self.container and len(value) == self.width \
+                and all(_fits_typecode(item, self.element_type) for item in value)
+        if self.kind == 'ndarray':
+            return isinstance(value, np.ndarray) and value.shape == self.values.shape[1:] and value.dtype == self.values.dtype
+        return True
+
+    def _to_objects(self):
+        '''A sample that does not fit the typed storage, keep the samples as plain values from now on'''
+        times = [self._time(index) for index in range(self.count)]
+        values = [self._get(index) for index in range(self.count)]
+        self.kind, self.width = 'object', 1
+        self.times[:self.count] = array('d', times)
+        self.values = values + [None] * (self.capacity - self.count)
+        self.start = 0
+
+    def append(self, timestamp : float, value : Any):
+        if self.count and timestamp < self.times[(self.start + self.count - 1) % self.capacity]:
+            return
+        if self.kind is None:
+            self._allocate(value)
+        elif not self._fits(value):
+            self._to_objects()
+        if self.count < self.capacity:
+            slot = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            slot = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.times[slot] = timestamp
+        if self.kind == 'vector':
+            values = self.values
+            offset = slot * self.width
+            for index, item in enumerate(value):
+                values[offset + index] = item
+        else:
+            self.values[slot] = value
+
+    def _time(self, index : int) -> float:
+        return self.times[(self.start + index) % self.capacity]
+
+    def _get(self, index : int) -> Any:
+        slot = (self.start + index) % self.capacity
+        if self.kind == 'vector':
+            return self.container(self.values[slot * self.width:(slot + 1) * self.width])
+        if self.kind == 'ndarray':
+            return self.values[slot].copy()
+        return self.values[slot]
+
+    def _slice(self, values : array, low : int, high : int) -> list:
+        '''Items low to high (sample indexes) of a typed array with one item per sample'''
+        first = (self.start + low) % self.capacity
+        last = first + high - low
+        if last <= self.capacity:
+            return values[first:last].tolist()
+        return values[first:].tolist() + values[:last - self.capacity].tolist()
+
+    def _bisect(self, timestamp : float, right = False) -> int:
+        '''Index of the first sample at (or after, with right) the timestamp'''
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            sample_time = self._time(middle)
+            if sample_time < timestamp or (right and sample_time == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def latest(self) -> Union[Tuple[float, Any], None]:
+        if not self.count:
+            return None
+        return self._time(self.count - 1), self._get(self.count - 1)
+
+    def window(self, start : float, end : float = None) -> Tuple[List[float], List[Any]]:
+        '''Lists of the timestamps and values of the samples with start <= timestamp <= end, oldest first'''
+        low = self._bisect(start)
+        high = self.count if end is None else self._bisect(end, right=True)
+        high = max(low, high)
+        times = self._slice(self.times, low, high)
+        if self.kind == 'scalar':
+            return times, self._slice(self.values, low, high)
+        return times, [self._get(index) for index in range(low, high)]
+
+    def nearest(self, timestamp : float) -> Union[Tuple[float, Any], None]:
+        '''(timestamp, value) of the sample closest in time'''
+        if not self.count:
+            return None
+        index = self._bisect(timestamp)
+        if index == self.count or (index > 0 and timestamp - self._time(index - 1) <= self._time(index) - timestamp):
+            index -= 1
+        return self._time(index), self._get(index)
+
+    def interpolate(self, timestamp : float) -> Any:
+        '''
+        Value at the timestamp, linearly interpolated between the samples around it.
+        Outside of the buffered time range the oldest or newest value is returned.
+        Only for numeric samples, vectors and ndarrays are interpolated per component.
+        '''
+        if not self.count:
+            return None
+        if self.kind not in ('scalar', 'vector', 'ndarray'):
+            raise TypeError(f'Cannot interpolate {self.kind} samples')
+        index = self._bisect(timestamp)
+        if index == 0:
+            return self._get(0)
+        if index == self.count:
+            return self._get(self.count - 1)
+        before, after = self._time(index - 1), self._time(index)
+        ratio = (timestamp - before) / (after - before) if after > before else 1.0
+        if self.kind in ('scalar', 'ndarray'):
+            a, b = self._get(index - 1), self._get(index)
+            if self.kind == 'ndarray' and a.dtype.kind in 'bu':
+                # b - a would wrap around for unsigned samples
+                a, b = a.astype(np.float64), b.astype(np.float64)
+            return a + (b - a) * ratio
+        return self.container(a + (b - a) * ratio for a, b in zip(self._get(index - 1), self._get(index)))
@@ -0,0 +1,128 @@
+import struct
+from typing import Dict, List, Tuple, Union
+
+from comms_core.data_interface import Interface
+from comms_core.codec import BinaryMessage, STR
+
+# Keys used in sync and ack messages, always encoded as the first key of the message
+SYNC_KEY = '__interface_sync__'
+ACK_KEY = '__interface_sync_ack__'
+
+# Offset of the first key in a binary message: magic, version, dict tag, item count
+_FIRST_KEY_OFFSET = 7
+
+
+def _first_key_is(message, key : str) -> bool:
+    '''Check the first key of a binary message without decoding it'''
+    if not BinaryMessage.is_binary(message):
+        return False
+    encoded = bytes([STR]) + struct.pack('<I', len(key)) + key.encode()
+    return bytes(message[_FIRST_KEY_OFFSET:_FIRST_KEY_OFFSET + len(encoded)]) == encoded
+
+
+class InterfaceSender:
+    '''
+    Sends an Interface as deltas: every message only carries the keys whose timestamp changed
+    since the last version the receiver acknowledged, plus the keys that were removed.
+    A full keyframe is sent first and then every `keyframe_interval` messages, so a receiver
+    that joins late or missed acks converges anyway.
+
+        sender = InterfaceSender(interface)
+        client.send(sender.encode())
+        # In the client callback
+        if InterfaceSender.is_ack(data):
+            sender.acknowledge(data)
+    '''
+
+    def __init__(self, interface : Interface, *, keyframe_interval = 50):
+        self.interface = interface
+        self.keyframe_interval = keyframe_interval
+        self.version = 0
+        self.messages_since_keyframe = None
+        # Timestamps of the keys the receiver has acknowledged
+        self.acked : Dict[str, float] = {}
+        # Versions sent but not yet acknowledged: version -> (keyframe, {key: timestamp}, removed keys)
+        self.pending : Dict[int, Tuple[bool, Dict[str, float], List[str]]] = {}
+
+    def force_keyframe(self):
+        self.messages_since_keyframe = None
+
+    def encode(self) -> bytes:
+        self.version += 1
+        keyframe = self.messages_since_keyframe is None or self.messages_since_keyframe + 1 >= self.keyframe_interval
+        # Expired keys are evicted first and show up as removed
+        self.interface.expire()
+        # Snapshot of (value, timestamp), the interface's expiry timer may change it from another thread
+        with self.interface.interface_lock:
+            local_data = {key: (data_object.data, data_object.timestamp)
+                          for key, data_object in self.interface.interface_local_data.items()}
+        if keyframe:
+            data = local_data
+            removed = []
+            self.messages_since_keyframe = 0
+        else:
+            acked = self.acked
+            data = {key: item for key, item in local_data.items() if acked.get(key) != item[1]}
+            # The receiver may have any key it acknowledged or that was sent since, however it was removed here
+            # (expired or deleted). Removals stay in the messages until a version carrying them is acknowledged.
+            known = set(acked)
+            for _, timestamps, _ in self.pending.values():
+                known.update(timestamps)
+            removed = [key for key in known if key not in local_data]
+            self.messages_since_keyframe += 1
+        self.pending[self.version] = (keyframe, {key: data[key][1] for key in data}, removed)
+        if len(self.pending) > 2 * self.keyframe_interval:
+            # Without acks the oldest versions are forgotten, their keys are simply sent again
+            del self.pending[min(self.pending)]
+        return BinaryMessage.encode({
+            SYNC_KEY: self.version,
+            'keyframe': keyframe,
+            'data': data,
+            'removed': removed,
+        })
+
+    def acknowledge(self, ack : Union[int, bytes, dict]):
+        '''Mark a version (or an ack message from InterfaceReceiver) as received'''
+        if isinstance(ack, bytes):
+            ack = BinaryMessage.decode(ack)
+        if isinstance(ack, dict):
+            ack = ack[ACK_KEY]
+        for version in sorted(v for v in self.pending if v <= ack):
+            keyframe, timestamps, removed = self.pending.pop(version)
+            if keyframe:
+                self.acked = dict(timestamps)
+            else:
+                self.acked.update(timestamps)
+                for key in removed:
+                    self.acked.pop(key, None)
+
+    @staticmethod
+    def is_ack(message) -> bool:
+        return _first_key_is(message, ACK_KEY)
+
+
+class InterfaceReceiver:
+    '''Applies messages from an InterfaceSender to a local Interface and builds the acks'''
+
+    def __init__(self, interface : Interface = None):
+        self.interface = interface if interface is not None else Interface()
+        self.version = 0
+
+    def apply(self, message : Union[bytes, dict]) -> bytes:
+        '''Apply a sync message, returns the ack message to send back'''
+        if isinstance(message, (bytes, bytearray, memoryview)):
+            message = BinaryMessage.decode(message)
+        version = message[SYNC_KEY]
+        if version > self.version:
+            if message['keyframe']:
+                for key in [key for key in self.interface if key not in message['data']]:
+                    del self.interface[key]
+            for key in message['removed']:
+                del self.interface[key]
+            self.interface.from_dict_with_timestamps(message['data'])
+            self.version = version
+        return BinaryMessage.encode({ACK_KEY: self.version})
+
+    @staticmethod
+    def is_sync(message) -> bool:
+        return _first_key_is(message, SYNC_KEY)
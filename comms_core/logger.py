@@ -1,11 +1,69 @@
+import atexit
 import logging
+import logging.handlers
 import os
+import queue
+
+class Payload:
+    '''
+    Message data passed as a log argument, cut to `limit` characters when it is created. Only the
+    text is kept, so a queued record neither holds on to the data nor shows later changes to it.
+    '''
+
+    __slots__ = ('text',)
+
+    def __init__(self, data, limit: int = 256):
+        # Only the part that is shown is converted, a text longer than `limit` is always cut
+        if isinstance(data, memoryview):
+            size = f'{data.nbytes} bytes'
+            text = str(bytes(data[:limit + 1]) if data.ndim == 1 else data.tobytes()[:limit + 1])
+        elif isinstance(data, (bytes, bytearray)):
+            size = f'{len(data)} bytes'
+            text = str(data[:limit + 1])
+        elif isinstance(data, str):
+            size = f'{len(data)} chars'
+            text = data[:limit + 1]
+        else:
+            text = str(data)
+            size = f'{len(text)} chars'
+        self.text = f'{text[:limit]}... ({size})' if len(text) > limit else text
+
+    def __str__(self) -> str:
+        return self.text
+
+
+class _BackgroundHandler(logging.handlers.QueueHandler):
+    '''
+    Hands records to a QueueListener thread that does the formatting and the disk I/O.
+    Unlike QueueHandler the record is not formatted on the calling thread, and when the
+    queue is full the record is dropped instead of blocking the I/O loop.
+    '''
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
 
 class Logger:
 
+    # Per-message logs (see message()) are truncated to this many characters of payload,
+    # and only every sample_every-th one is kept. Can be changed per instance.
+    max_payload_length = 256
+    sample_every = 1
+
     def __init__(self, name: str, level: int = logging.DEBUG):
         self.logger = logging.getLogger(name)
         self.logger.setLevel(level)
+        self.message_count = 0
 
         # Check if the logger already has handlers (to avoid adding duplicate handlers)
         if not self.logger.hasHandlers():
@@ -21,22 +79,48 @@ class Logger:
             file_handler = logging.FileHandler(f'{log_directory}/{name}.log', mode="w")
             file_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
             file_handler.setLevel(logging.DEBUG)  # Log all messages to the file
-            self.logger.addHandler(file_handler)
 
-    def log(self, message: str, level: int = logging.DEBUG):
-        self.logger.log(level, message)
+            # The file is written by a background thread so disk I/O never stalls the comms loops
+            log_queue = queue.Queue(10000)
+            listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+            listener.start()
+            atexit.register(listener.stop)
+            self.logger.addHandler(_BackgroundHandler(log_queue))
+
+    def log(self, message: str, level: int = logging.DEBUG, *, args: tuple = ()):
+        '''`args` are lazy %-style arguments, formatted only if the record is emitted'''
+        self.logger.log(level, message, *args)
+
+    def message(self, message: str, *args):
+        '''
+        DEBUG log for every message sent or received, with lazy %-style arguments:
+            self.message('Received: %s from %s', self.payload(data), addr)
+        Costs a level check when DEBUG is disabled, and only every `sample_every`-th call is logged.
+        '''
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        self.message_count += 1
+        if self.sample_every > 1 and self.message_count % self.sample_every:
+            return
+        self.logger.debug(message, *args)
+
+    def payload(self, data) -> Payload:
+        '''The text of `data` for message(), nothing is converted while DEBUG is disabled'''
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return None
+        return Payload(data, self.max_payload_length)
 
-    def debug(self, message: str):
-        self.log(message, logging.DEBUG)
+    def debug(self, message: str, *args):
+        self.log(message, logging.DEBUG, args=args)
 
-    def info(self, message: str):
-        self.log(message, logging.INFO)
+    def info(self, message: str, *args):
+        self.log(message, logging.INFO, args=args)
 
-    def warning(self, message: str):
-        self.log(message, logging.WARNING)
+    def warning(self, message: str, *args):
+        self.log(message, logging.WARNING, args=args)
 
-    def error(self, message: str):
-        self.log(message, logging.ERROR)
+    def error(self, message: str, *args):
+        self.log(message, logging.ERROR, args=args)
 
-    def critical(self, message: str):
-        self.log(message, logging.CRITICAL)
+    def critical(self, message: str, *args):
+        self.log(message, logging.CRITICAL, args=args)
@@ -0,0 +1,186 @@
+import json
+import time
+from threading import Thread, Event
+from typing import Callable, Dict, List, Tuple
+
+from .logger import Logger
+from .send_queue import PRIORITY_NAMES
+
+
+class Histogram:
+    '''
+    Log-linear histogram in the style of HdrHistogram. Values are recorded in microseconds
+    into buckets that keep `significant_bits` bits of precision (about 3% with the default 5),
+    so recording is a few integer operations and the memory use is fixed whatever the range.
+    '''
+
+    def __init__(self, *, significant_bits = 5, max_seconds = 60.0):
+        self.bits = significant_bits
+        self.sub_buckets = 1 << significant_bits
+        self.half = self.sub_buckets >> 1
+        self.max_value = int(max_seconds * 1e6)
+        self.counts : List[int] = [0] * (self._index(self.max_value) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def _index(self, value : int) -> int:
+        if value < self.sub_buckets:
+            return value
+        exponent = value.bit_length() - self.bits
+        return self.sub_buckets + (exponent - 1) * self.half + (value >> exponent) - self.half
+
+    def _value(self, index : int) -> int:
+        '''Middle of the range of values counted in a bucket'''
+        if index < self.sub_buckets:
+            return index
+        exponent = (index - self.sub_buckets) // self.half + 1
+        mantissa = (index - self.sub_buckets) % self.half + self.half
+        return (mantissa << exponent) + (1 << exponent) // 2
+
+    def record(self, seconds : float):
+        value = min(max(int(seconds * 1e6), 0), self.max_value)
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, percent : float) -> float:
+        '''Value in seconds below which `percent` of the recorded values fall'''
+        if not self.count:
+            return None
+        target = max(1, -(-self.count * percent // 100))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self._value(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def snapshot(self) -> Dict[str, float]:
+        '''Summary in milliseconds'''
+        if not self.count:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'min_ms': self.min / 1e3,
+            'mean_ms': self.total / self.count / 1e3,
+            'p50_ms': self.percentile(50) * 1e3,
+            'p90_ms': self.percentile(90) * 1e3,
+            'p99_ms': self.percentile(99) * 1e3,
+            'p999_ms': self.percentile(99.9) * 1e3,
+            'max_ms': self.max / 1e3,
+        }
+
+
+class ConnectionMetrics:
+    '''
+    Counters and histograms of one connection. Updated by the connection's I/O thread only,
+    stats() snapshots are taken without a lock and may be a few updates behind.
+    '''
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.messages_in = 0
+        self.messages_out = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.connected_at = time.time()
+        # Time spent in one iteration of the I/O loop, without the sleep
+        self.loop_time = Histogram()
+        # From send()/publish() putting the message in the queue to the write of its last byte (see FrameWriter.sent_marks)
+        self.enqueue_latency = Histogram()
+        # The same per priority lane (see LaneQueue)
+        self.lane_latency = [Histogram() for _ in PRIORITY_NAMES]
+
+    def on_connect(self):
+        if self.connects:
+            self.reconnects += 1
+        self.connects += 1
+        self.connected_at = time.time()
+
+    def on_read(self, nbytes : int, messages : int):
+        self.bytes_in += nbytes
+        self.messages_in += messages
+
+    def on_flush(self, sent : List[Tuple[float, int]], now : float):
+        '''`sent` holds the (enqueue time, priority) of the messages that were completely written'''
+        self.messages_out += len(sent)
+        record = self.enqueue_latency.record
+        lanes = self.lane_latency
+        for enqueued, priority in sent:
+            record(now - enqueued)
+            lanes[priority].record(now - enqueued)
+
+    def snapshot(self, send_queue, writer) -> dict:
+        '''Counters of the metrics plus those the send queue and frame writer keep themselves'''
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': writer.bytes_written,
+            'messages_in': self.messages_in,
+            'messages_out': self.messages_out,
+            'reconnects': self.reconnects,
+            'connected_for_s': time.time() - self.connected_at,
+            'queue_depth': len(send_queue),
+            'queue_dropped': send_queue.dropped,
+            'queue_coalesced': send_queue.coalesced,
+            'partial_writes': writer.partial_writes,
+            'pending_bytes': len(writer),
+            'loop_time': self.loop_time.snapshot(),
+            'enqueue_latency': self.enqueue_latency.snapshot(),
+            'lanes': {name: {'queue_depth': len(send_queue.lanes[priority]),
+                             'enqueue_latency': self.lane_latency[priority].snapshot()}
+                      for priority, name in enumerate(PRIORITY_NAMES)},
+        }
+
+
+class MetricsExporter(Logger):
+    '''
+    Calls `stats` (e.g. client.stats) every `interval` seconds and passes the snapshot to
+    `callback`, appends it as a JSON line to `path`, or logs it if neither is given.
+    '''
+
+    def __init__(self, stats : Callable[[], dict], *, interval = 10.0, callback : Callable[[dict], None] = None, path : str = None):
+        super().__init__('MetricsExporter')
+        self.stats = stats
+        self.interval = interval
+        self.callback = callback
+        self.path = path
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive():
+            self.thread.join()
+
+    def export(self):
+        snapshot = {'time': time.time(), **self.stats()}
+        if self.callback is not None:
+            self.callback(snapshot)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(snapshot) + '\n')
+        if self.callback is None and self.path is None:
+            self.info(json.dumps(snapshot))
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.export()
+            except Exception as e:
+                self.error(f'Metrics export failed: {e}')
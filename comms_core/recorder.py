@@ -0,0 +1,306 @@
+import os
+import mmap
+import atexit
+import time
+import queue
+import struct
+import bisect
+from threading import Event, Thread
+from typing import Callable, Iterator, List, NamedTuple, Tuple, Union
+
+from .logger import Logger
+from .framing import Frame, FLAG_BYTES, FLAG_CONTROL, FLAG_RPC, FLAG_TOPIC
+
+# File: [FILE_MAGIC][record]...
+# record: [RECORD_HEADER][peer : utf-8][topic : utf-8][payload]
+# header: timestamp, direction, flags (FLAG_BYTES / FLAG_TOPIC), peer length, topic length, payload length
+FILE_MAGIC = b'CSMREC\x00\x01'
+RECORD_HEADER = struct.Struct('<dBBHHI')
+
+# Sidecar '<path>.idx' with (timestamp, file offset) of every index_interval-th record
+INDEX_ENTRY = struct.Struct('<dQ')
+INDEX_INTERVAL = 256
+
+INBOUND = 0
+OUTBOUND = 1
+
+
+class Record(NamedTuple):
+    timestamp : float
+    direction : int
+    peer : str
+    topic : Union[str, None]
+    data : Union[str, bytes]
+
+
+def _peer_name(peer) -> str:
+    if isinstance(peer, tuple):
+        return f'{peer[0]}:{peer[1]}'
+    return str(peer)
+
+
+class FlightRecorder(Logger):
+    '''
+    Appends every message a Client or Server sends and receives to a compact binary log.
+    Pass it as `recorder=` to Client/Server, one recorder can be shared by several of them
+    and is closed by its owner. record() only queues the message, a writer thread does the
+    file I/O through a large file buffer, flushed every `flush_interval` seconds and on close.
+    When more than `max_pending` records wait for the disk new ones are dropped (and counted),
+    the first drop and records made after close() are logged as a warning.
+    '''
+
+    def __init__(self, path : str, *, index_interval = INDEX_INTERVAL, flush_interval = 1.0, buffer_size = 1 << 20,
+                 max_pending = 100000):
+        super().__init__('FlightRecorder')
+        self.path = path
+        self.index_interval = index_interval
+        self.flush_interval = flush_interval
+        self.file = open(path, 'wb', buffering=buffer_size)
+        self.file.write(FILE_MAGIC)
+        # A log opened right away is valid (and empty) instead of a file of size 0
+        self.file.flush()
+        self.index_file = open(path + '.idx', 'wb')
+        self.offset = len(FILE_MAGIC)
+        self.count = 0
+        self.dropped = 0
+        self.closed = False
+        # Records made after close() are dropped, warned about once
+        self.warned_closed = False
+        # (timestamp, header, peer, topic, payload) records, an Event to flush or None to stop
+        self.pending = queue.Queue(max_pending)
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+        # Records still queued at exit are written, like the log files (see Logger)
+        atexit.register(self.close)
+
+    def record(self, direction : int, peer, data : Union[str, bytes, bytearray, memoryview, list], topic : str = None):
+        if self.closed:
+            if not self.warned_closed:
+                self.warned_closed = True
+                self.warning('Recording to %s after it was closed, the records are dropped', self.path)
+            return
+        flags = 0
+        if isinstance(data, str):
+            payload = data.encode()
+        elif isinstance(data, list):
+            payload = b''.join(data)
+            flags |= FLAG_BYTES
+        else:
+            # A copy of mutable buffers, they may be reused before the writer thread gets to them
+            payload = data if isinstance(data, bytes) else bytes(data)
+            flags |= FLAG_BYTES
+        name = _peer_name(peer).encode()
+        topic_name = b''
+        if topic is not None:
+            topic_name = topic.encode()
+            flags |= FLAG_TOPIC
+        timestamp = time.time()
+        header = RECORD_HEADER.pack(timestamp, direction, flags, len(name), len(topic_name), len(payload))
+        try:
+            self.pending.put_nowait((timestamp, header, name, topic_name, payload))
+        except queue.Full:
+            self.dropped += 1
+            if self.dropped == 1:
+                self.warning('More than %d records wait for %s, dropping new ones', self.pending.maxsize, self.path)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while True:
+            try:
+                item = self.pending.get(timeout=self.flush_interval)
+            except queue.Empty:
+                item = ()
+            if item is None:
+                break
+            if isinstance(item, Event):
+                self._flush()
+                item.set()
+            elif item:
+                self._write(*item)
+            if time.monotonic() - last_flush > self.flush_interval:
+                self._flush()
+                last_flush = time.monotonic()
+        self._flush()
+        self.file.close()
+        self.index_file.close()
+
+    def _write(self, timestamp : float, header : bytes, name : bytes, topic_name : bytes, payload : bytes):
+        if self.count % self.index_interval == 0:
+            self.index_file.write(INDEX_ENTRY.pack(timestamp, self.offset))
+        self.file.write(header)
+        self.file.write(name)
+        self.file.write(topic_name)
+        self.file.write(payload)
+        self.offset += len(header) + len(name) + len(topic_name) + len(payload)
+        self.count += 1
+
+    def record_sent(self, peer, data : Union[str, bytes, list, Frame]):
+        '''Records an item taken from a send queue, control and RPC frames are skipped'''
+        if isinstance(data, Frame):
+            if not data.flags & (FLAG_CONTROL | FLAG_RPC):
+                self.record(OUTBOUND, peer, data.data, data.topic)
+        else:
+            self.record(OUTBOUND, peer, data)
+
+    def _flush(self):
+        self.file.flush()
+        self.index_file.flush()
+
+    def flush(self):
+        '''Waits until everything recorded so far is written to the files'''
+        if self.closed:
+            return
+        flushed = Event()
+        self.pending.put(flushed)
+        flushed.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        # Nothing left to do at exit, and the process no longer keeps the recorder alive
+        atexit.unregister(self.close)
+        self.pending.put(None)
+        self.thread.join()
+        if self.dropped:
+            self.warning('%d records were dropped from %s', self.dropped, self.path)
+
+
+class FlightLog:
+    '''
+    Memory-mapped reader of a FlightRecorder file. An incomplete last record (the recording
+    was cut short) is ignored, an empty file reads as a log without records. Without the index
+    file the index is rebuilt with a scan, keeping every `index_interval`-th record like the recorder.
+    '''
+
+    def __init__(self, path : str, *, index_interval = INDEX_INTERVAL):
+        self.path = path
+        self.index_interval = index_interval
+        with open(path, 'rb') as f:
+            # mmap refuses empty files, a recorder that has not written anything yet leaves one
+            size = os.fstat(f.fileno()).st_size
+            self.mmap : Union[mmap.mmap, bytes] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else FILE_MAGIC
+        if self.mmap[:len(FILE_MAGIC)] != FILE_MAGIC:
+            self.mmap.close()
+            raise ValueError(f'{path} is not a flight recorder log')
+        self.index : List[Tuple[float, int]] = self._load_index()
+        self.index_times = [timestamp for timestamp, _ in self.index]
+
+    def close(self):
+        if isinstance(self.mmap, mmap.mmap):
+            self.mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _load_index(self) -> List[Tuple[float, int]]:
+        try:
+            with open(self.path + '.idx', 'rb') as f:
+                data = f.read()
+            entries = [entry for entry in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size])]
+            return [(timestamp, offset) for timestamp, offset in entries if offset < len(self.mmap)]
+        except OSError:
+            return [(record.timestamp, offset) for offset, record in self._scan(len(FILE_MAGIC))][::self.index_interval]
+
+    def _scan(self, offset : int) -> Iterator[Tuple[int, Record]]:
+        buf = self.mmap
+        size = len(buf)
+        while offset + RECORD_HEADER.size <= size:
+            timestamp, direction, flags, peer_length, topic_length, payload_length = RECORD_HEADER.unpack_from(buf, offset)
+            start = offset + RECORD_HEADER.size
+            end = start + peer_length + topic_length + payload_length
+            if end > size:
+                return
+            peer = buf[start:start + peer_length].decode()
+            topic = buf[start + peer_length:start + peer_length + topic_length].decode() if flags & FLAG_TOPIC else None
+            payload = buf[start + peer_length + topic_length:end]
+            data = payload if flags & FLAG_BYTES else payload.decode()
+            yield offset, Record(timestamp, direction, peer, topic, data)
+            offset = end
+
+    def __iter__(self) -> Iterator[Record]:
+        return self.records()
+
+    def records(self, start : float = None, end : float = None, direction : int = None) -> Iterator[Record]:
+        '''Records between two timestamps (the index is used to skip to `start`), optionally of one direction'''
+        offset = len(FILE_MAGIC)
+        if start is not None and self.index:
+            position = bisect.bisect_right(self.index_times, start) - 1
+            if position >= 0:
+                offset = self.index[position][1]
+        for _, record in self._scan(offset):
+            if start is not None and record.timestamp < start:
+                continue
+            if end is not None and record.timestamp > end:
+                return
+            if direction is not None and record.direction != direction:
+                continue
+            yield record
+
+
+class Replayer(Logger):
+    '''
+    Feeds recorded messages back at their original timing, scaled by `speed`
+    (2.0 is twice as fast, None as fast as possible).
+
+        log = FlightLog('run.rec')
+        Replayer(log, speed=10).replay(callback)              # callback(data, peer) per message
+        Replayer(log, speed=None).replay_to_server(port=37564) # one Client per recorded peer
+    '''
+
+    def __init__(self, log : Union[FlightLog, str], *, speed : float = 1.0):
+        super().__init__('Replayer')
+        self.log_file = FlightLog(log) if isinstance(log, str) else log
+        self.speed = speed
+
+    def _timed(self, records : Iterator[Record]) -> Iterator[Record]:
+        first = None
+        started = time.monotonic()
+        for record in records:
+            if first is None:
+                first = record.timestamp
+            if self.speed:
+                delay = (record.timestamp - first) / self.speed - (time.monotonic() - started)
+                if delay > 0:
+                    time.sleep(delay)
+            yield record
+
+    def replay(self, callback : Callable, *, direction : int = INBOUND, start : float = None, end : float = None) -> int:
+        '''Calls callback(data, peer) for every recorded message, returns the number of messages'''
+        count = 0
+        for record in self._timed(self.log_file.records(start, end, direction)):
+            callback(record.data, record.peer)
+            count += 1
+        return count
+
+    def replay_to_server(self, host = '127.0.0.1', port = 37564, *, start : float = None, end : float = None,
+                         connect_timeout = 10.0, **client_options) -> int:
+        '''
+        Sends the messages a Server received (inbound records) to a local server, with one
+        Client per recorded peer so the server sees the same connections. Returns the number sent.
+        '''
+        from .client import Client
+        clients = {}
+        count = 0
+        try:
+            for record in self._timed(self.log_file.records(start, end, INBOUND)):
+                client = clients.get(record.peer)
+                if client is None:
+                    client = clients[record.peer] = Client(host, port=port, queue_policy='block', **client_options)
+                    client.start()
+                    deadline = time.time() + connect_timeout
+                    while not client.init and time.time() < deadline:
+                        time.sleep(0.01)
+                client.send(record.data)
+                count += 1
+            # Let the queues drain before the connections are closed
+            deadline = time.time() + connect_timeout
+            while any(client.queue_depth() or len(client.writer) for client in clients.values()) and time.time() < deadline:
+                time.sleep(0.01)
+        finally:
+            for client in clients.values():
+                client.stop()
+        return count
@@ -0,0 +1,141 @@
+import heapq
+import itertools
+import time
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+from threading import Lock
+from typing import Any, Callable, Dict, List, Tuple, Union
+
+from .logger import Logger
+from .framing import Frame, FLAG_RPC
+from .codec import BinaryMessage, BinaryCodecError
+
+
+# How long a handler's response waits for room in a full send queue before it is dropped (and logged)
+REPLY_TIMEOUT = 10.0
+
+
+class RPCError(Exception):
+    '''Set on a call's future when the remote handler raised or the method is not registered'''
+    pass
+
+
+def _settle(future : Future, result : Any = None, exception : BaseException = None):
+    # The caller may have cancelled the future in the meantime
+    if future.done():
+        return
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class RPCEndpoint(Logger):
+    '''
+    Outgoing calls and registered handlers of a Client or Server.
+
+    Requests and responses are FLAG_RPC frames on the existing connection, carrying a BinaryMessage dict:
+        request:  {'id': n, 'method': name, 'args': {...}}
+        response: {'id': n, 'result': value} or {'id': n, 'error': message}
+    Responses are matched to calls by id, so any number of calls can be in flight at once.
+    Handlers run on a small thread pool (created on the first request), never on the I/O thread.
+    '''
+
+    def __init__(self, workers = 4):
+        super().__init__('RPC')
+        self.workers = workers
+        self.executor : ThreadPoolExecutor = None
+        self.handlers : Dict[str, Callable] = {}
+        # id -> (future, peer) of the calls waiting for a response
+        self.pending : Dict[int, Tuple[Future, Any]] = {}
+        # (deadline, id) of calls with a timeout, answered calls are skipped when they come up
+        self.deadlines : List[Tuple[float, int]] = []
+        self.ids = itertools.count(1)
+        self.lock = Lock()
+
+    def register(self, method : str, handler : Callable):
+        self.handlers[method] = handler
+
+    def request(self, method : str, kwargs : dict, peer, timeout : float = None) -> Tuple[Future, Frame]:
+        '''Future of a new call and the frame to send to the peer'''
+        call_id = next(self.ids)
+        frame = Frame(BinaryMessage.encode({'id': call_id, 'method': method, 'args': kwargs}), FLAG_RPC)
+        future = Future()
+        with self.lock:
+            self.pending[call_id] = (future, peer)
+            if timeout is not None:
+                heapq.heappush(self.deadlines, (time.monotonic() + timeout, call_id))
+        return future, frame
+
+    def cancel(self, future : Future, error : BaseException):
+        '''The request of a call could not be sent'''
+        with self.lock:
+            for call_id, (pending, _) in list(self.pending.items()):
+                if pending is future:
+                    del self.pending[call_id]
+        _settle(future, exception=error)
+
+    def on_frame(self, data : bytes, peer, reply : Callable[[Frame], None]):
+        '''Handles a received FLAG_RPC frame, `reply` queues a frame for the peer. Called from the I/O thread.'''
+        try:
+            message = BinaryMessage.decode(data)
+            call_id = message['id']
+        except (BinaryCodecError, KeyError, TypeError) as e:
+            self.warning(f'Invalid RPC message from {peer}: {e}')
+            return
+        if 'method' in message:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='rpc')
+            self.executor.submit(self._handle, call_id, message['method'], message.get('args') or {}, reply)
+            return
+        with self.lock:
+            entry = self.pending.pop(call_id, None)
+        if entry is None:
+            # Timed out or cancelled
+            return
+        if 'error' in message:
+            _settle(entry[0], exception=RPCError(message['error']))
+        else:
+            _settle(entry[0], result=message.get('result'))
+
+    def _handle(self, call_id : int, method : str, kwargs : dict, reply : Callable[[Frame], None]):
+        try:
+            handler = self.handlers.get(method)
+            if handler is None:
+                raise RPCError(f'Unknown method {method!r}')
+            payload = BinaryMessage.encode({'id': call_id, 'result': handler(**kwargs)})
+        except Exception as e:
+            payload = BinaryMessage.encode({'id': call_id, 'error': f'{type(e).__name__}: {e}'})
+        reply(Frame(payload, FLAG_RPC))
+
+    def expire(self, now : float = None) -> Union[float, None]:
+        '''Fails the calls whose timeout passed with TimeoutError, returns the next deadline'''
+        if not self.deadlines:
+            return None
+        now = time.monotonic() if now is None else now
+        expired = []
+        with self.lock:
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, call_id = heapq.heappop(self.deadlines)
+                entry = self.pending.pop(call_id, None)
+                if entry is not None:
+                    expired.append(entry[0])
+            next_deadline = self.deadlines[0][0] if self.deadlines else None
+        for future in expired:
+            _settle(future, exception=TimeoutError('No response to the call in time'))
+        return next_deadline
+
+    def fail(self, error : BaseException, peer = None):
+        '''Fails the pending calls to a peer (or every call) with `error`'''
+        with self.lock:
+            call_ids = [call_id for call_id, (_, call_peer) in self.pending.items() if peer is None or call_peer == peer]
+            futures = [self.pending.pop(call_id)[0] for call_id in call_ids]
+        for future in futures:
+            _settle(future, exception=error)
+
+    def shutdown(self):
+        self.fail(ConnectionError('Connection closed'))
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,193 @@
+import struct
+from typing import Any, Dict, List, Tuple, Union
+
+from comms_core.data_interface import Interface
+
+# Schema messages start with their own magic byte, followed by the schema id and a presence bitmap
+MAGIC = b'\xb6'
+
+_U32 = struct.Struct('<I')
+
+_TYPE_CODES = {
+    int: 'q',
+    float: 'd',
+    bool: '?',
+}
+_STRUCT_CODES = 'bBhHiIlLqQefd?'
+_VARIABLE_TYPES = (str, bytes)
+
+
+class SchemaError(ValueError):
+    pass
+
+
+class Schema:
+    '''
+    Precompiled encoder/decoder for messages that always carry the same keys.
+
+    Fields are declared once with their types and are identified on the wire by their
+    position (field id) instead of their name. Fixed size fields are packed with a single
+    struct, str/bytes fields follow with a length prefix. Fields that are missing or None
+    are flagged in a presence bitmap and left out of the decoded message.
+
+    Supported types: int, float, bool, str, bytes, a struct format character ('f', 'i', 'B', ...),
+    or a fixed length sequence written as (type, n) for tuples or [type, n] for lists.
+
+        pose_schema = Schema(1, {'x': float, 'y': float, 'heading': 'f', 'pose': (float, 3), 'mode': int, 'name': str})
+        message = pose_schema.encode(interface)
+        interface = CustomSocketMessage.decode(message, as_interface=True)
+    '''
+
+    registry : Dict[int, 'Schema'] = {}
+
+    def __init__(self, schema_id : int, fields : Union[Dict[str, Any], List[Tuple[str, Any]]], *, register = True):
+        if not 0 <= schema_id <= 0xffff:
+            raise SchemaError(f'Schema id must fit in 16 bits, got {schema_id}')
+        self.schema_id = schema_id
+        self.fields : List[Tuple[str, Any]] = list(fields.items()) if isinstance(fields, dict) else list(fields)
+        if len(self.fields) > 64:
+            raise SchemaError('A schema can have at most 64 fields')
+        self.field_ids = {name: field_id for field_id, (name, _) in enumerate(self.fields)}
+        self._compile()
+        if register:
+            Schema.register(self)
+
+    @staticmethod
+    def register(schema : 'Schema'):
+        existing = Schema.registry.get(schema.schema_id)
+        if existing is not None and existing.fields != schema.fields:
+            raise SchemaError(f'A different schema is already registered with id {schema.schema_id}')
+        Schema.registry[schema.schema_id] = schema
+
+    @staticmethod
+    def _parse_type(field_type) -> Tuple[str, int, Any]:
+        '''Returns (struct code or variable type, count, container) for a field type'''
+        container = None
+        count = 1
+        if isinstance(field_type, (tuple, list)):
+            if len(field_type) != 2 or not isinstance(field_type[1], int) or field_type[1] < 1:
+                raise SchemaError(f'Sequence fields are declared as (type, n) or [type, n], got {field_type!r}')
+            container = type(field_type)
+            field_type, count = field_type
+        if field_type in _TYPE_CODES:
+            return _TYPE_CODES[field_type], count, container
+        if isinstance(field_type, str) and len(field_type) == 1 and field_type in _STRUCT_CODES:
+            return field_type, count, container
+        if field_type in _VARIABLE_TYPES and container is None:
+            return field_type, 1, None
+        raise SchemaError(f'Unsupported field type {field_type!r}')
+
+    def _compile(self):
+        presence_code = 'B' if len(self.fields) <= 8 else 'H' if len(self.fields) <= 16 else 'I' if len(self.fields) <= 32 else 'Q'
+        fixed_format = '<BH' + presence_code
+        namespace = {'_U32': _U32, 'Interface': Interface}
+        encode_lines = [
+            'def encode(data):',
+            '    if isinstance(data, Interface):',
+            '        data = data.interface_local_data',
+            '        get = lambda name: data[name].get_data() if name in data else None',
+            '    else:',
+            '        get = data.get',
+        ]
+        args = [f'{MAGIC[0]}', f'{self.schema_id}', 'present']
+        presence = []
+        variable_lines = []
+        decode_names = ['_magic', '_schema_id', 'present']
+        decode_lines = []
+        variable_decode_lines = []
+        for field_id, (name, field_type) in enumerate(self.fields):
+            code, count, container = self._parse_type(field_type)
+            value = f'v{field_id}'
+            encode_lines.append(f'    {value} = get({name!r})')
+            presence.append(f'(({value} is not None) << {field_id})')
+            bit = 1 << field_id
+            if code in _VARIABLE_TYPES:
+                if code is str:
+                    variable_lines.append(f'    if {value} is not None:\n        {value} = {value}.encode()')
+                else:
+                    variable_lines.append(f'    if {value} is not None:\n        {value} = bytes({value})')
+                variable_lines.append(f'        parts += (_U32.pack(len({value})), {value})')
+                variable_decode_lines += [
+                    f'    if present & {bit}:',
+                    '        length = _U32.unpack_from(buf, offset)[0]',
+                    '        offset += 4',
+                    '        if offset + length > len(buf):',
+                    f'            raise ValueError({f"{name} is truncated"!r})',
+                    f'        result[{name!r}] = buf[offset:offset + length]{".decode()" if code is str else ""}',
+                    '        offset += length',
+                ]
+                continue
+            fixed_format += f'{count}{code}'
+            zero = 'False' if code == '?' else '0'
+            if count == 1:
+                args.append(f'{value} if {value} is not None else {zero}')
+                decode_names.append(f'f{field_id}')
+                decode_lines.append(f'    if present & {bit}: result[{name!r}] = f{field_id}')
+            else:
+                namespace[f'_zeros{field_id}'] = (False if code == '?' else 0,) * count
+                args.append(f'*({value} if {value} is not None else _zeros{field_id})')
+                items = [f'f{field_id}_{i}' for i in range(count)]
+                decode_names += items
+                joined = ', '.join(items)
+                packed = f'[{joined}]' if container is list else f'({joined},)'
+                decode_lines.append(f'    if present & {bit}: result[{name!r}] = {packed}')
+        namespace['_fixed'] = self.fixed = struct.Struct(fixed_format)
+
+        encode_lines.append(f'    present = {" | ".join(presence) or "0"}')
+        encode_lines.append(f'    parts = (_fixed.pack({", ".join(args)}),)')
+        encode_lines += variable_lines
+        encode_lines.append("    return b''.join(parts) if len(parts) > 1 else parts[0]")
+
+        decode_source = [
+            'def decode(buf):',
+            f'    {", ".join(decode_names)}, = _fixed.unpack_from(buf, 0)',
+            '    result = {}',
+            *decode_lines,
+            f'    offset = {self.fixed.size}',
+            *variable_decode_lines,
+            '    return result',
+        ]
+        exec('\n'.join(encode_lines), namespace)
+        exec('\n'.join(decode_source), namespace)
+        self._encode = namespace['encode']
+        self._decode = namespace['decode']
+
+    def encode(self, data : Union[dict, Interface]) -> bytes:
+        try:
+            if isinstance(data, Interface):
+                # The generated encoder reads the interface's storage directly
+                with data.interface_lock:
+                    return self._encode(data)
+            return self._encode(data)
+        except (struct.error, TypeError, AttributeError) as e:
+            raise SchemaError(f'Message does not match schema {self.schema_id}: {e}') from e
+
+    def decode(self, message : bytes, *, as_interface = False) -> Union[dict, Interface]:
+        if not isinstance(message, bytes):
+            message = bytes(message)
+        try:
+            data = self._decode(message)
+        except (struct.error, ValueError) as e:
+            # ValueError covers truncated str/bytes fields and invalid utf-8
+            raise SchemaError(f'Malformed message for schema {self.schema_id}: {e}') from e
+        if as_interface:
+            interface = Interface()
+            interface.from_dict(data)
+            return interface
+        return data
+
+    @staticmethod
+    def is_schema_message(message) -> bool:
+        return isinstance(message, (bytes, bytearray, memoryview)) and len(message) >= 3 and message[0] == MAGIC[0]
+
+    @staticmethod
+    def lookup(message : bytes) -> 'Schema':
+        schema_id = message[1] | (message[2] << 8)
+        if schema_id not in Schema.registry:
+            raise SchemaError(f'Unknown schema id {schema_id}')
+        return Schema.registry[schema_id]
+
+    @staticmethod
+    def decode_message(message : bytes, *, as_interface = False) -> Union[dict, Interface]:
+        '''Decode a message with whichever registered schema it was encoded with'''
+        return Schema.lookup(message).decode(message, as_interface=as_interface)
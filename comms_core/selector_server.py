@@ -0,0 +1,230 @@
+import time
+import socket
+import selectors
+from threading import Thread
+
+from .server import Server
+from .framing import FrameBuffer, FrameError, FrameWriter
+from .metrics import ConnectionMetrics, Histogram
+from .session import ACK_INTERVAL
+
+class SelectorServer(Server):
+    '''
+    Server that runs every connection on a single thread with a selector (epoll on linux).
+    The loop only wakes up when a socket is readable, when a socket with queued data is
+    writable, or when send() queues new data. Same send/get_data/set_callback API as Server.
+    Keep the callback inboxes on 'drop_oldest': waiting for room with 'block' would stall every connection.
+    '''
+
+    def __init__(self, **options):
+        # Same options as Server, see its constructor
+        super().__init__(**options)
+        self.server_socket.setblocking(False)
+
+        self.selector = selectors.DefaultSelector()
+        self.wake_reader, self.wake_writer = socket.socketpair()
+        self.wake_reader.setblocking(False)
+        self.wake_writer.setblocking(False)
+        # Connections that had data queued since the last loop iteration
+        self.pending = set()
+        # Connections to look at again at a given time.monotonic(): delayed acknowledgements and held queues
+        self.deferred = {}
+        # One loop serves every connection, so its iteration time is measured once for the server
+        self.loop_time = Histogram() if self.metrics_enabled else None
+        self.loop_thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.active = True
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+        if self.udp is not None:
+            self.udp.start()
+        self.loop_thread.start()
+
+    def stop(self):
+        self.log("Shutting down server")
+        self.active = False
+        self._wake()
+        if self.loop_thread.is_alive():
+            self.loop_thread.join()
+        self.rpc.shutdown()
+        self.dispatcher.shutdown()
+        if self.udp is not None and self.udp.active:
+            self.udp.stop()
+        with self.lock:
+            for addr in list(self.connections.keys()):
+                self._close_client(addr)
+            for addr in list(self.parked):
+                self._drop_parked(addr)
+        self.selector.close()
+
+    def _wake(self):
+        try:
+            self.wake_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _run(self):
+        while self.active:
+            # Woken up in time for deferred work and for RPC timeouts
+            deadlines = list(self.deferred.values())
+            next_call_deadline = self.rpc.expire()
+            if next_call_deadline is not None:
+                deadlines.append(next_call_deadline)
+            timeout = max(0, min(deadlines) - time.monotonic()) if deadlines else 1
+            events_ready = self.selector.select(timeout=timeout)
+            start = time.perf_counter()
+            for key, events in events_ready:
+                if key.fileobj is self.server_socket:
+                    self._accept()
+                elif key.fileobj is self.wake_reader:
+                    self._drain_wakeups()
+                else:
+                    addr = key.data
+                    if events & selectors.EVENT_READ:
+                        self._on_readable(key.fileobj, addr)
+                    if events & selectors.EVENT_WRITE:
+                        self._on_writable(key.fileobj, addr)
+            self._update_interest()
+            if self.loop_time is not None:
+                self.loop_time.record(time.perf_counter() - start)
+
+    def _drain_wakeups(self):
+        try:
+            while self.wake_reader.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _accept(self):
+        while True:
+            try:
+                conn, addr = self.server_socket.accept()
+            except (BlockingIOError, socket.timeout):
+                return
+            conn.setblocking(False)
+            # Small urgent frames must not wait for the acknowledgement of a bulk piece
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with self.lock:
+                self._add_connection(conn, addr)
+                self.selector.register(conn, selectors.EVENT_READ, addr)
+                self.log(f'Connected to {addr}')
+
+    def _close_client(self, addr, park = False):
+        # Called with self.lock held
+        try:
+            self.selector.unregister(self.connections[addr]['conn'])
+        except (KeyError, ValueError):
+            pass
+        self._remove_connection(addr, park)
+        self.pending.discard(addr)
+        self.deferred.pop(addr, None)
+
+    def _kill_client(self, addr):
+        self.warning(f'Lost connection to {addr}')
+        self._close_client(addr, park=True)
+
+    def _on_readable(self, conn : socket.socket, addr):
+        with self.lock:
+            if addr not in self.connections:
+                return
+            frame_buffer : FrameBuffer = self.connections[addr]['frame_buffer']
+            metrics : ConnectionMetrics = self.connections[addr]['metrics']
+        try:
+            nbytes = frame_buffer.recv_into(conn)
+            if nbytes == 0:
+                raise ConnectionResetError('Connection closed by client')
+            frames = list(frame_buffer.frames())
+            if metrics is not None:
+                metrics.on_read(nbytes, len(frames))
+        except BlockingIOError:
+            return
+        except (ConnectionResetError, FrameError, OSError):
+            with self.lock:
+                if addr in self.connections:
+                    self._kill_client(addr)
+            return
+        for payload, flags in frames:
+            with self.lock:
+                if addr not in self.connections:
+                    return
+                data = self._on_frame(addr, payload, flags)
+                if data is None:
+                    continue
+                callback = self.connections[addr]['callback']
+            # The callback runs on the dispatcher's threads, without the lock so it is free to call send()
+            if callback:
+                self.dispatcher.submit(addr, callback, data, addr)
+        with self.lock:
+            # Acknowledgements are written by _on_writable, make sure it runs
+            session = self.connections[addr]['session'] if addr in self.connections else None
+            if session is not None and session.received > session.acked:
+                if session.ack_due(time.monotonic()):
+                    self.pending.add(addr)
+                else:
+                    self.deferred[addr] = session.last_ack + ACK_INTERVAL
+
+    def _on_writable(self, conn : socket.socket, addr):
+        with self.lock:
+            if addr not in self.connections:
+                return
+            info = self.connections[addr]
+            writer : FrameWriter = info['writer']
+            while True:
+                messages = self._write_queued(addr, info)
+                self._acknowledge(info)
+                full = not writer.has_room()
+                if messages:
+                    self.message('Writing %d messages to %s', len(messages), addr)
+                try:
+                    done = writer.flush(conn)
+                except OSError:
+                    self._kill_client(addr)
+                    return
+                self._count_completed(info)
+                if info['metrics'] is not None:
+                    sent = writer.sent_marks()
+                    if sent:
+                        info['metrics'].on_flush(sent, time.monotonic())
+                # Bulk messages go out one piece per flush, what was queued in the meantime goes before the next piece.
+                # Messages left in the queue because the writer was full go out once it was written.
+                if not (writer.chunks_waiting() or (done and full)):
+                    break
+            # Partial writes stay in the writer until the next writable event, as do the bulk messages
+            # still queued after the one that just finished (one at a time, between other connections)
+            if done and not len(info['send_queue']):
+                self.selector.modify(conn, selectors.EVENT_READ, addr)
+            elif info['shm'] is not None:
+                # The ring is full, the socket is always writable so try again shortly instead
+                self.selector.modify(conn, selectors.EVENT_READ, addr)
+                self.deferred[addr] = time.monotonic() + 0.001
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        if self.loop_time is not None:
+            stats['loop_time'] = self.loop_time.snapshot()
+        return stats
+
+    def _on_handshake(self, addr, data : str):
+        # Called with self.lock held, the reply may have been written to the connection's writer
+        super()._on_handshake(addr, data)
+        self.pending.add(addr)
+
+    def _update_interest(self):
+        with self.lock:
+            now = time.monotonic()
+            for addr in [addr for addr, due in self.deferred.items() if due <= now]:
+                del self.deferred[addr]
+                self.pending.add(addr)
+            pending, self.pending = self.pending, set()
+            for addr in pending:
+                if addr in self.connections:
+                    conn = self.connections[addr]['conn']
+                    self.selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, addr)
+
+    def _on_enqueue(self, addr):
+        if self._write_now(addr):
+            return
+        with self.lock:
+            self.pending.add(addr)
+        self._wake()
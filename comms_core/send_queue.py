@@ -0,0 +1,252 @@
+from collections import deque
+from typing import Any, Deque, Dict, Hashable, List, Tuple
+from threading import Condition
+import time
+
+from .framing import Frame, FLAG_CONTROL, FLAG_RPC
+
+QUEUE_POLICIES = ('block', 'drop_oldest', 'coalesce')
+
+
+def message_size(data : Any) -> int:
+    '''Payload bytes of a queued message, close enough for batching (str counts characters)'''
+    if isinstance(data, Frame):
+        return data.length
+    if isinstance(data, list):
+        return sum(len(part) for part in data)
+    if isinstance(data, (str, bytes, bytearray, memoryview)):
+        return len(data)
+    return 0
+
+
+def check_queue_policy(policy : str) -> str:
+    if policy not in QUEUE_POLICIES:
+        raise ValueError(f'Unknown queue policy {policy!r}, expected one of {QUEUE_POLICIES}')
+    return policy
+
+
+class SendQueue:
+    '''
+    Bounded queue of outgoing messages for one connection.
+
+    Policies when the queue is full:
+        block       - put() waits for room (or returns False if not blocking / timed out)
+        drop_oldest - the oldest queued message is dropped to make room
+        coalesce    - a message sent with a key replaces the queued message with the same key
+                      (keeping its place in the queue), otherwise behaves like drop_oldest
+    '''
+
+    def __init__(self, maxsize = 1024, policy = 'drop_oldest'):
+        check_queue_policy(policy)
+        if maxsize < 1:
+            raise ValueError('maxsize must be at least 1')
+        self.maxsize = maxsize
+        self.policy = policy
+        # Entries are [key, data, enqueue time] lists so coalescing can replace the data in place
+        # (a coalesced message keeps the enqueue time of the one it replaced)
+        self.entries : Deque[list] = deque()
+        self.keys : Dict[Hashable, list] = {}
+        self.condition = Condition()
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        # message_size() of everything queued
+        self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, data : Any, *, key : Hashable = None, block = True, timeout : float = None) -> bool:
+        '''Queue a message, returns False if it was not accepted'''
+        with self.condition:
+            if self.closed:
+                return False
+            if self.policy == 'coalesce' and key is not None and key in self.keys:
+                entry = self.keys[key]
+                self.size += message_size(data) - message_size(entry[1])
+                entry[1] = data
+                self.coalesced += 1
+                return True
+            if len(self.entries) >= self.maxsize:
+                if self.policy == 'block':
+                    if not block:
+                        return False
+                    deadline = None if timeout is None else time.monotonic() + timeout
+                    while len(self.entries) >= self.maxsize and not self.closed:
+                        remaining = None if deadline is None else deadline - time.monotonic()
+                        if remaining is not None and remaining <= 0:
+                            return False
+                        self.condition.wait(remaining)
+                    if self.closed:
+                        return False
+                else:
+                    self._drop_oldest()
+            entry = [key, data, time.monotonic()]
+            self.entries.append(entry)
+            self.size += message_size(data)
+            if self.policy == 'coalesce' and key is not None:
+                self.keys[key] = entry
+            return True
+
+    def _drop_oldest(self):
+        entry = self.entries.popleft()
+        key = entry[0]
+        if key is not None and self.keys.get(key) is entry:
+            del self.keys[key]
+        self.size -= message_size(entry[1])
+        self.dropped += 1
+
+    def get_all(self) -> List[Any]:
+        '''Remove and return every queued message, oldest first'''
+        return [data for data, _ in self.get_all_timed()]
+
+    def get_all_timed(self) -> List[Tuple[Any, float]]:
+        '''Like get_all, with the time.monotonic() each message was queued at'''
+        with self.condition:
+            if not self.entries:
+                return []
+            items = [(data, enqueued) for _, data, enqueued in self.entries]
+            self.entries.clear()
+            self.keys.clear()
+            self.size = 0
+            self.condition.notify_all()
+            return items
+
+    def get_timed(self, count : int, max_bytes : int = None) -> List[Tuple[Any, float]]:
+        '''
+        Like get_all_timed, for at most `count` of the oldest messages and, with `max_bytes`,
+        only as many as fit in that many bytes (at least one).
+        '''
+        with self.condition:
+            if count >= len(self.entries) and (max_bytes is None or self.size <= max_bytes):
+                return self.get_all_timed()
+            items = []
+            size = 0
+            while self.entries and len(items) < count:
+                entry = self.entries[0]
+                if max_bytes is not None and items and size + message_size(entry[1]) > max_bytes:
+                    break
+                self.entries.popleft()
+                key, data, enqueued = entry
+                if key is not None and self.keys.get(key) is entry:
+                    del self.keys[key]
+                items.append((data, enqueued))
+                size += message_size(data)
+            self.size -= size
+            if items:
+                self.condition.notify_all()
+            return items
+
+    def clear(self):
+        self.get_all()
+
+    def close(self):
+        '''Wake up blocked producers, later puts are rejected'''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def reopen(self):
+        with self.condition:
+            self.closed = False
+
+
+# Priority lanes of a connection, a lower number goes out first. Bulk messages are written in
+# pieces (see FrameWriter) so a high priority message never waits for a whole large one.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = ('high', 'normal', 'bulk')
+
+
+def check_priority(priority : int) -> int:
+    if priority not in range(len(PRIORITY_NAMES)):
+        raise ValueError(f'Unknown priority {priority!r}, expected one of PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_BULK')
+    return priority
+
+
+class LaneQueue:
+    '''
+    Send queue of one connection with a SendQueue per priority lane, each bounded to `maxsize`
+    messages with the same policy. get_all_by_priority() returns the high lane first, then the
+    normal lane and the bulk lane, a full lane only blocks (or drops) messages of its own priority.
+
+    RPC and control frames go to a lane of their own ahead of the others, whatever their priority.
+    It never evicts: when it is full put() waits or returns False like the 'block' policy, so the
+    caller learns about a call or response that was not sent instead of it disappearing.
+    '''
+
+    def __init__(self, maxsize = 1024, policy = 'drop_oldest'):
+        self.lanes = [SendQueue(maxsize, policy) for _ in PRIORITY_NAMES]
+        self.control = SendQueue(maxsize, 'block')
+        self.maxsize = maxsize
+        self.policy = policy
+
+    def __len__(self):
+        return sum(map(len, self.lanes)) + len(self.control)
+
+    @property
+    def dropped(self) -> int:
+        return sum(lane.dropped for lane in self.lanes)
+
+    @property
+    def coalesced(self) -> int:
+        return sum(lane.coalesced for lane in self.lanes)
+
+    def depths(self) -> Dict[str, int]:
+        return {name: len(lane) for name, lane in zip(PRIORITY_NAMES, self.lanes)}
+
+    def put(self, data : Any, *, key : Hashable = None, block = True, timeout : float = None, priority = PRIORITY_NORMAL) -> bool:
+        if isinstance(data, Frame) and data.flags & (FLAG_CONTROL | FLAG_RPC):
+            return self.control.put(data, block=block, timeout=timeout)
+        return self.lanes[priority].put(data, key=key, block=block, timeout=timeout)
+
+    def get_batch(self, max_bytes : int, bulk = True) -> List[Tuple[Any, float, int]]:
+        '''
+        (data, enqueue time, priority) of the messages that fit in `max_bytes` (at least one), most urgent
+        lane first. Bulk messages are written in pieces and not counted, at most one is taken and none
+        without `bulk`.
+        '''
+        batch = []
+        left = max_bytes
+        if len(self.control):
+            items = self.control.get_timed(len(self.control), left)
+            batch.extend((data, enqueued, PRIORITY_HIGH) for data, enqueued in items)
+            left -= sum(message_size(data) for data, _ in items)
+        for priority, lane in enumerate(self.lanes):
+            if not len(lane):
+                continue
+            if priority == PRIORITY_BULK:
+                if bulk:
+                    batch.extend((data, enqueued, priority) for data, enqueued in lane.get_timed(1))
+                break
+            if batch and left <= 0:
+                break
+            items = lane.get_timed(len(lane), left)
+            batch.extend((data, enqueued, priority) for data, enqueued in items)
+            if priority < PRIORITY_NORMAL:
+                left -= sum(message_size(data) for data, _ in items)
+        return batch
+
+    def get_all_by_priority(self) -> List[Tuple[Any, float, int]]:
+        '''(data, enqueue time, priority) of every queued message, most urgent lane first'''
+        control = [(data, enqueued, PRIORITY_HIGH) for data, enqueued in self.control.get_all_timed()]
+        return control + [(data, enqueued, priority) for priority, lane in enumerate(self.lanes) for data, enqueued in lane.get_all_timed()]
+
+    def get_all_timed(self) -> List[Tuple[Any, float]]:
+        return [(data, enqueued) for data, enqueued, _ in self.get_all_by_priority()]
+
+    def get_all(self) -> List[Any]:
+        return [data for data, _, _ in self.get_all_by_priority()]
+
+    def clear(self):
+        for lane in self.lanes + [self.control]:
+            lane.clear()
+
+    def close(self):
+        for lane in self.lanes + [self.control]:
+            lane.close()
+
+    def reopen(self):
+        for lane in self.lanes + [self.control]:
+            lane.reopen()
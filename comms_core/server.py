@@ -1,27 +1,78 @@
 import time
 import socket
-from typing import List, Dict, Callable, Union
+from typing import Any, List, Dict, Callable, Tuple, Union
+from concurrent.futures import Executor, Future
 from threading import Thread, Lock
 
 from .logger import Logger
+from .framing import FrameBuffer, FrameError, FrameWriter, Frame, FLAG_CONTROL, FLAG_RPC, unpack_message
+from .handshake import is_handshake, parse_handshake, parse_control, control_frame
+from .compression import DEFAULT_THRESHOLD, make_compressors, negotiate
+from .csm import CustomSocketMessage
+from .data_interface import Interface
+from .udp import UDPChannel
+from .send_queue import LaneQueue, PRIORITY_NORMAL, PRIORITY_BULK, check_queue_policy, check_priority
+from .metrics import ConnectionMetrics
+from .recorder import FlightRecorder, INBOUND
+from .session import Session, parse_count
+from .rpc import RPCEndpoint, REPLY_TIMEOUT
+from .shm import SHM_AVAILABLE, DEFAULT_SIZE, ShmLink, ShmWriter, is_same_host
+from .dispatch import CallbackDispatcher
 
 class Server(Logger):
 
-    def __init__(self, *, default_callback: Callable = None):
+    def __init__(self, *, default_callback: Callable = None, port = 37564, udp = False, telemetry_callback: Callable = None,
+                 queue_size = 1024, queue_policy = 'drop_oldest', compression = None, compression_threshold = DEFAULT_THRESHOLD,
+                 metrics = True, recorder : FlightRecorder = None, session_timeout = 30.0, retransmit_size = 1024,
+                 rpc_workers = 4, shared_memory = True, shm_size = DEFAULT_SIZE, callback_workers = 4,
+                 callback_executor : Executor = None, inbox_size = 1024, inbox_policy = 'drop_oldest',
+                 inbox_timeout = 1.0):
         super().__init__('Server')
-        self.local_server_address = ('0.0.0.0', 37564)
+        self.local_server_address = ('0.0.0.0', port)
         self.default_callback = default_callback
+        # Every connection gets its own bounded send queue per priority lane, see SendQueue for the policies
+        self.queue_size = queue_size
+        self.queue_policy = check_queue_policy(queue_policy)
+        # Codecs clients may choose from in their handshake, see compression.py
+        self.compressors = make_compressors(compression)
+        self.compression_threshold = compression_threshold
+        # Per connection counters and latency histograms for stats()
+        self.metrics_enabled = metrics
+        # Optional capture of every message sent and received, see recorder.py
+        self.recorder = recorder
+        # Clients that reconnect within session_timeout seconds resume their session, see session.py
+        self.session_timeout = session_timeout
+        self.retransmit_size = retransmit_size
+        # Handlers for the clients' calls and calls to the clients, see register() and call()
+        self.rpc = RPCEndpoint(rpc_workers)
+        # Clients on the same machine switch to shared memory rings after the handshake, see shm.py
+        self.shared_memory = shared_memory and SHM_AVAILABLE
+        self.shm_size = shm_size
+        # Callbacks run on a thread pool (or callback_executor) in each connection's order, see dispatch.py
+        self.dispatcher = CallbackDispatcher(callback_workers, inbox_size=inbox_size, inbox_policy=inbox_policy,
+                                             inbox_timeout=inbox_timeout,
+                                             executor=callback_executor)
 
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind(self.local_server_address)
         self.server_socket.listen(5)
         self.server_socket.settimeout(0.05)
 
         self.connections: Dict[tuple, Dict] = {}
+        # Indexes kept in step with self.connections (dicts used as ordered sets of addresses)
+        self.ip_index: Dict[str, Dict[tuple, None]] = {}
+        self.topics: Dict[str, Dict[tuple, None]] = {}
+        # Session id -> address of its connection. Records of lost connections with a session are
+        # parked (with their send queue and subscriptions) until the client resumes or they expire.
+        self.session_index: Dict[str, tuple] = {}
+        self.parked: Dict[tuple, Dict] = {}
         self.lock = Lock()
         self.active = False
         self.accept_thread = Thread(target=self._accept_connections)
-        
+        # Optional datagram channel on the same port number, see send_telemetry
+        self.udp = UDPChannel(bind_address=self.local_server_address, callback=telemetry_callback) if udp else None
+
     def __del__(self):
         self.stop()
         self.server_socket.close()
@@ -31,117 +82,597 @@ class Server(Logger):
             try:
                 conn, addr = self.server_socket.accept()
                 conn.settimeout(0.05)
+                # Small urgent frames must not wait for the acknowledgement of a bulk piece
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 with self.lock:
-                    self.connections[addr] = {
-                        'conn': conn,
-                        'ip': addr[0],
-                        'callback': self.default_callback,
-                        'data': None,
-                        'thread': Thread(target=self._handle_client, args=(conn, addr)),
-                        'send_queue': [],
-                        'send_lock': Lock(),
-                        'read_lock': Lock(),
-                    }
+                    self._add_connection(conn, addr, thread=Thread(target=self._handle_client, args=(conn, addr)))
                     self.connections[addr]['thread'].start()
                     self.log(f'Connected to {addr}')
             except socket.timeout:
                 continue
 
-    def _kill_client(self, addr):
-        self.warning(f'Lost connection to {addr}')
+    def _add_connection(self, conn : socket.socket, addr, **extra):
+        # Called with self.lock held
+        self.connections[addr] = {
+            'conn': conn,
+            'ip': addr[0],
+            'callback': self.default_callback,
+            'data': None,
+            'send_queue': LaneQueue(self.queue_size, self.queue_policy),
+            'wire_format': 'text',
+            'frame_buffer': FrameBuffer(),
+            'writer': FrameWriter(),
+            'read_lock': Lock(),
+            'topics': set(),
+            'compressor': None,
+            'metrics': ConnectionMetrics() if self.metrics_enabled else None,
+            'session': None,
+            'handshake': False,
+            # Only the first data frame of a connection can be its handshake
+            'first_frame': True,
+            'shm': None,
+            **extra,
+        }
+        self.ip_index.setdefault(addr[0], {})[addr] = None
+
+    def _remove_connection(self, addr, park = False):
+        # Called with self.lock held
+        info = self.connections.pop(addr)
         try:
-            self.connections[addr]['conn'].shutdown(socket.SHUT_RDWR)
-            self.connections[addr]['conn'].close()
-        except Exception as e:
+            info['conn'].shutdown(socket.SHUT_RDWR)
+            info['conn'].close()
+        except Exception:
             pass
-        del self.connections[addr]
+        self._discard(self.ip_index, info['ip'], addr)
+        for topic in info['topics']:
+            self._discard(self.topics, topic, addr)
+        if info['shm'] is not None:
+            info['shm'].close()
+        self.dispatcher.discard(addr)
+        if park and info['session'] is not None and self.session_timeout > 0:
+            # Bulk messages finished but not numbered yet, and those cut short (resent whole when the session resumes)
+            writer = info['writer']
+            for data in writer.completed() + writer.clear():
+                info['session'].on_sent(data, PRIORITY_BULK)
+            info['expires'] = time.monotonic() + self.session_timeout
+            self.parked[addr] = info
+            return
+        info['send_queue'].close()
+        if info['session'] is not None and self.session_index.get(info['session'].id) == addr:
+            del self.session_index[info['session'].id]
+        self.rpc.fail(ConnectionError(f'Lost connection to {addr}'), addr)
+
+    def _drop_parked(self, addr):
+        # Called with self.lock held
+        info = self.parked.pop(addr)
+        info['send_queue'].close()
+        if self.session_index.get(info['session'].id) == addr:
+            del self.session_index[info['session'].id]
+        self.rpc.fail(ConnectionError(f'Lost connection to {addr}'), addr)
+
+    def _expire_sessions(self):
+        # Called with self.lock held
+        now = time.monotonic()
+        for addr in [addr for addr, info in self.parked.items() if info['expires'] <= now]:
+            self.log(f'Session of {addr} expired')
+            self._drop_parked(addr)
+
+    @staticmethod
+    def _discard(index : Dict[str, Dict[tuple, None]], name : str, addr):
+        addresses = index.get(name)
+        if addresses is not None:
+            addresses.pop(addr, None)
+            if not addresses:
+                del index[name]
+
+    def _kill_client(self, addr):
+        self.warning(f'Lost connection to {addr}')
+        self._remove_connection(addr, park=True)
 
     def _handle_client(self, conn, addr):
+        with self.lock:
+            if addr not in self.connections:
+                return
+            metrics : ConnectionMetrics = self.connections[addr]['metrics']
+            frame_buffer : FrameBuffer = self.connections[addr]['frame_buffer']
         while self.active:
-            data = self._read_data(conn, addr)
-            if data:
-                self.log(f'Received: {data} from {addr}')
+            frames = self._read_data(conn, addr)
+            # Waiting for data (the socket timeout) and the sleep are not part of the loop time
+            start = time.perf_counter()
+            for payload, flags in frames:
                 with self.lock:
-                    if "Client: " not in data:
-                        self.connections[addr]['data'] = data
-                        if self.connections[addr]['callback']:
-                            self.connections[addr]['callback'](data, addr)
+                    if addr not in self.connections:
+                        break
+                    data = self._on_frame(addr, payload, flags)
+                    if data is None:
+                        continue
+                    callback = self.connections[addr]['callback']
+                # Handed over without the lock, the callback is free to call send()
+                if callback:
+                    self.dispatcher.submit(addr, callback, data, addr)
+            with self.lock:
+                if addr not in self.connections:
+                    return
             self._send_data(conn, addr)
-            time.sleep(0.01)
+            self.rpc.expire()
+            if metrics is not None:
+                metrics.loop_time.record(time.perf_counter() - start)
+            # The rest of a bulk message is read right away, its pieces would trickle in otherwise
+            if not frame_buffer.in_bulk:
+                time.sleep(0.01)
 
-    def _read_data(self, conn : socket.socket, addr):
+    def _on_frame(self, addr, payload : bytes, flags : int) -> Union[str, bytes, None]:
+        '''
+        Handles the protocol messages of a frame, returns the data to pass to the
+        callback or None if there is none. Called with self.lock held.
+        '''
+        if flags & FLAG_CONTROL:
+            self._on_control(addr, *parse_control(payload))
+            return None
         try:
-            data = conn.recv(4096).decode()
-            return data
-        except socket.timeout:
+            data, topic = unpack_message(payload, flags, self.connections[addr]['compressor'])
+        except FrameError as e:
+            self.warning(e)
+            self._kill_client(addr)
             return None
-        except ConnectionResetError:
-            with self.lock:
-                self._kill_client(addr)
+        self.message('Received: %s from %s', self.payload(data), addr)
+        first_frame = self.connections[addr]['first_frame']
+        self.connections[addr]['first_frame'] = False
+        if first_frame and self._is_handshake(data):
+            self._on_handshake(addr, data)
             return None
-        
+        if self.connections[addr]['session'] is not None:
+            self.connections[addr]['session'].on_received()
+        if flags & FLAG_RPC:
+            self.rpc.on_frame(data, addr, self._replier(addr))
+            return None
+        if self.recorder is not None:
+            self.recorder.record(INBOUND, addr, data, topic)
+        self.connections[addr]['data'] = data
+        return data
 
-    def _send_data(self, conn : socket.socket, addr):
+    def _on_control(self, addr, command : str, argument : str):
+        # Called with self.lock held
+        if command == 'ack':
+            count = parse_count(argument)
+            if count is None:
+                self.warning(f'Invalid ack {argument!r} from {addr}')
+            elif self.connections[addr]['session'] is not None:
+                self.connections[addr]['session'].on_ack(count)
+            return
+        if command == 'shm':
+            if argument == 'ready' and self.connections[addr]['shm'] is not None:
+                self.connections[addr]['shm'].start()
+            return
+        if command == 'subscribe':
+            self.topics.setdefault(argument, {})[addr] = None
+            self.connections[addr]['topics'].add(argument)
+        elif command == 'unsubscribe':
+            self._discard(self.topics, argument, addr)
+            self.connections[addr]['topics'].discard(argument)
+        else:
+            self.warning(f'Unknown control message {command!r} from {addr}')
+            return
+        self.log(f'{addr} {command}d to {argument!r}')
+
+    @staticmethod
+    def _is_handshake(data : Union[str, bytes]) -> bool:
+        return is_handshake(data)
+
+    def _on_handshake(self, addr, data : str):
+        # Called with self.lock held
+        hostname, options = parse_handshake(data)
+        info = self.connections[addr]
+        info['handshake'] = True
+        if options.get('format') == 'binary':
+            info['wire_format'] = 'binary'
+        if 'compress' in options:
+            compressor = info['compressor'] = negotiate(options['compress'], self.compressors)
+            # Written before any compressed frame, the client starts compressing once it has the reply.
+            # Only called from the connection's I/O thread, so the writer can be used directly.
+            info['writer'].add(control_frame('compress', compressor.token if compressor else 'none'))
+        self.log(f'Handshake from {hostname} at {addr}: {options}')
+        if 'session' in options:
+            received = parse_count(options.get('ack', '0'))
+            if received is None:
+                self.warning(f'Invalid ack {options["ack"]!r} in the handshake from {addr}, not resuming its session')
+                info['writer'].add(control_frame('session', 'none'))
+            else:
+                self._attach_session(addr, options['session'], received)
+        if options.get('shm') == '1' and self.shared_memory and is_same_host(info['conn']):
+            self._switch_to_shm(addr)
+
+    def _switch_to_shm(self, addr):
+        '''
+        Everything written after the 'shm' reply goes to the rings. The client answers with 'shm ready',
+        written after its last frame on the socket, and only then the client's ring is read.
+        Called with self.lock held from the connection's I/O thread.
+        '''
+        info = self.connections[addr]
+        try:
+            link = ShmLink.create(self.shm_size, lambda frames: self._on_shm_frames(addr, frames))
+        except OSError as e:
+            self.warning(f'Cannot create shared memory for {addr}, staying on TCP: {e}')
+            return
+        info['writer'].add(control_frame('shm', link.names))
+        info['writer'] = ShmWriter(link.send_ring, info['writer'])
+        info['shm'] = link
+        self.log(f'{addr} switched to shared memory')
+
+    def _on_shm_frames(self, addr, frames : List[Tuple[bytes, int]]):
+        # Called from the connection's shared memory reader thread
         with self.lock:
             if addr not in self.connections:
                 return
-            with self.connections[addr]['send_lock']:
-                for data in self.connections[addr]['send_queue']:
-                    try:
-                        data : str
-                        conn.send(data.encode())
-                        self.log(f'Sent: {data} to {addr}')
-                    except ConnectionResetError:
-                        with self.lock:
-                            self._kill_client(addr)
-                        break
-                    except BrokenPipeError:
-                        pass
-                self.connections[addr]['send_queue'] = []
+            metrics : ConnectionMetrics = self.connections[addr]['metrics']
+        if metrics is not None:
+            metrics.on_read(sum(len(payload) for payload, _ in frames), len(frames))
+        for payload, flags in frames:
+            with self.lock:
+                if addr not in self.connections:
+                    return
+                data = self._on_frame(addr, payload, flags)
+                if data is None:
+                    continue
+                callback = self.connections[addr]['callback']
+            if callback:
+                self.dispatcher.submit(addr, callback, data, addr)
+        # Writes the acknowledgements and anything the callbacks queued
+        self._on_enqueue(addr)
+
+    def _attach_session(self, addr, session_id : str, received : int):
+        '''
+        Starts or resumes the client's session, `received` is the number of our frames it got.
+        Called with self.lock held from the connection's I/O thread.
+        '''
+        self._expire_sessions()
+        info = self.connections[addr]
+        previous = self.session_index.get(session_id)
+        if previous in self.connections:
+            # The client reconnected before the old connection was found to be dead
+            self._kill_client(previous)
+        parked = self.parked.pop(previous, None)
+        self.session_index[session_id] = addr
+        if parked is None:
+            info['session'] = Session(session_id, self.retransmit_size)
+            info['writer'].add(control_frame('session', 'new'))
+            return
+        # Messages queued for the old connection (or while it was down) are sent before newer ones.
+        # The same client makes the same handshake offer, so the queued frames use the same compression.
+        for data, _, priority in info['send_queue'].get_all_by_priority():
+            parked['send_queue'].put(data, block=False, priority=priority)
+        info['send_queue'] = parked['send_queue']
+        info['callback'] = parked['callback']
+        info['data'] = parked['data']
+        # The topics are not taken over, the client subscribes to its current ones again after every handshake
+        session : Session = parked['session']
+        info['session'] = session
+        lost = session.lost
+        resend = session.unacknowledged(received)
+        # The reply goes first, the client only counts our frames once it has it
+        info['writer'].add(control_frame('session', str(session.received)))
+        for data, priority in resend:
+            # Numbered again like new messages, bulk ones in pieces so they do not hold up the others
+            bulk = priority == PRIORITY_BULK
+            info['writer'].add(data, bulk=bulk)
+            if not bulk:
+                session.on_sent(data, priority)
+        if session.lost > lost:
+            self.warning(f'{session.lost - lost} messages to {addr} were no longer in the retransmit buffer')
+        self.log(f'Resumed session {session_id} on {addr}, resent {len(resend)} messages')
+
+    def _read_data(self, conn : socket.socket, addr) -> List[Tuple[bytes, int]]:
+        with self.lock:
+            if addr not in self.connections:
+                return []
+            frame_buffer : FrameBuffer = self.connections[addr]['frame_buffer']
+            metrics : ConnectionMetrics = self.connections[addr]['metrics']
+        try:
+            nbytes = frame_buffer.recv_into(conn)
+            if nbytes == 0:
+                raise ConnectionResetError('Connection closed by client')
+            frames = list(frame_buffer.frames())
+            if metrics is not None:
+                metrics.on_read(nbytes, len(frames))
+            return frames
+        except socket.timeout:
+            return []
+        except (ConnectionResetError, FrameError, OSError):
+            with self.lock:
+                if addr in self.connections:
+                    self._kill_client(addr)
+            return []
+
+
+    def _send_data(self, conn : socket.socket, addr):
+        while True:
+            with self.lock:
+                if addr not in self.connections:
+                    return
+                info = self.connections[addr]
+                writer : FrameWriter = info['writer']
+                metrics : ConnectionMetrics = info['metrics']
+                # Taken from the queue under the lock, a resumed session moves the queue to the new connection
+                messages = self._write_queued(addr, info)
+                self._acknowledge(info)
+                full = not writer.has_room()
+            if messages:
+                self.message('Writing %d messages to %s', len(messages), addr)
+            try:
+                # Whatever the socket does not accept now is written on the next iteration
+                done = writer.flush(conn)
+            except OSError:
+                with self.lock:
+                    if addr in self.connections:
+                        self._kill_client(addr)
+                return
+            with self.lock:
+                # A parked connection's bulk messages were numbered when it was parked
+                if self.connections.get(addr) is not info:
+                    return
+                self._count_completed(info)
+            if metrics is not None:
+                # Messages whose last byte went out, in this flush or after an earlier partial write
+                sent = writer.sent_marks()
+                if sent:
+                    metrics.on_flush(sent, time.monotonic())
+            # Bulk messages go out one piece per flush, what was queued in the meantime goes before the next piece.
+            # Messages left in the queue because the writer was full go out once it was written.
+            if not (writer.chunks_waiting() or (done and full)):
+                return
+
+    def _write_queued(self, addr, info : Dict) -> List[Tuple[Any, float, int]]:
+        '''
+        Moves queued messages to the connection's writer while it has room, so the messages of a
+        stalled connection stay in the bounded send queue where its policy applies.
+        Returns the (data, enqueue time, priority) written. Called with self.lock held.
+        '''
+        writer : FrameWriter = info['writer']
+        messages = []
+        while len(info['send_queue']) and writer.has_room():
+            batch = info['send_queue'].get_batch(writer.room(), bulk=writer.has_room(bulk=True))
+            if not batch:
+                break
+            for data, enqueued, priority in batch:
+                self._write(addr, info, data, priority, (enqueued, priority) if info['metrics'] is not None else None)
+            messages += batch
+        return messages
+
+    def _write(self, addr, info : Dict, data, priority = PRIORITY_NORMAL, mark : Tuple[float, int] = None):
+        # Called with self.lock held, `mark` is the (enqueue time, priority) for the metrics
+        bulk = priority == PRIORITY_BULK
+        info['writer'].add(data, bulk=bulk, mark=mark)
+        if self.recorder is not None:
+            self.recorder.record_sent(addr, data)
+        # Bulk messages that finished while `data` was added went out before it
+        self._count_completed(info)
+        if info['session'] is not None and not bulk:
+            info['session'].on_sent(data, priority)
+
+    @staticmethod
+    def _count_completed(info : Dict):
+        # Called with self.lock held. A bulk message is numbered for the session once its last piece
+        # is written, that is when the client receives (and counts) it.
+        completed = info['writer'].completed()
+        if info['session'] is not None:
+            for data in completed:
+                info['session'].on_sent(data, PRIORITY_BULK)
+
+    def _acknowledge(self, info : Dict):
+        # Called from the connection's I/O thread
+        session : Session = info['session']
+        if session is not None:
+            now = time.monotonic()
+            if session.ack_due(now):
+                info['writer'].add(session.ack_frame(now))
 
     def start(self):
         self.active = True
+        if self.udp is not None:
+            self.udp.start()
         self.accept_thread.start()
 
     def stop(self):
         self.log("Shutting down server")
         self.active = False
         self.accept_thread.join()
+        self.rpc.shutdown()
+        self.dispatcher.shutdown()
+        if self.udp is not None:
+            self.udp.stop()
         with self.lock:
-            for addr, info in self.connections.items():
-                try:
-                    info['conn'].shutdown(socket.SHUT_RDWR)
-                    info['conn'].close()
-                except:
-                    continue
-            self.connections.clear()
+            for addr in list(self.connections):
+                self._remove_connection(addr)
+            for addr in list(self.parked):
+                self._drop_parked(addr)
 
-    def send(self, data: str, addr : Union[tuple, str] = None):
-        if addr is None:
-            with self.lock:
-                if len(self.connections) == 0:
-                    return
-                addr = list(self.connections.keys())[0]
+    def send(self, data: Union[str, bytes, dict, Interface], addr : Union[tuple, str] = None, *,
+             key = None, block = True, timeout : float = None, priority = PRIORITY_NORMAL) -> bool:
+        '''
+        Queue data for a client by address or ip (the first client if no address is given).
+        While a client with a session is reconnecting its messages are kept for it.
+        `key` is used by the 'coalesce' queue policy, `block` and `timeout` by the 'block' policy.
+        `priority` is the lane: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_BULK (see LaneQueue).
+        Returns False if no client matched or the message was not accepted.
+        '''
+        check_priority(priority)
+        with self.lock:
+            if addr is None:
+                targets = [next(iter(self.connections))] if self.connections else []
+            elif isinstance(addr, tuple):
+                targets = [addr] if addr in self.connections or addr in self.parked else []
+            else:
+                targets = self._ip_targets(addr)
+            queued = self._frames_for(targets, data)
+        return len(queued) > 0 and self._enqueue(queued, key, block, timeout, priority) == len(queued)
+
+    def _ip_targets(self, ip : str) -> List[tuple]:
+        '''
+        Addresses of the clients at an ip. Called with self.lock held. A client reconnecting from there has not
+        named its session yet, so the session's parked record keeps getting the messages until the handshake
+        moves it to the new connection, where they are written after what the client missed.
+        '''
+        connections = list(self.ip_index.get(ip, ()))
+        ready = [address for address in connections if self.connections[address]['handshake']]
+        return ready or [address for address in self.parked if address[0] == ip] or connections
+
+    def publish(self, topic : str, data: Union[str, bytes, dict, Interface], *,
+                key = None, block = False, timeout : float = None, priority = PRIORITY_NORMAL) -> int:
+        '''
+        Queue data for every client subscribed to the topic (see Client.subscribe).
+        The message is encoded once per wire format and compression in use and the same frame is shared by
+        every subscriber's queue. Does not block on a full 'block' queue unless `block` is set,
+        so one slow subscriber does not hold up the others. Returns the number of subscribers
+        that accepted the message.
+        '''
+        check_priority(priority)
+        with self.lock:
+            queued = self._frames_for(list(self.topics.get(topic, ())), data, topic)
+        return self._enqueue(queued, key, block, timeout, priority)
+
+    def broadcast(self, data: Union[str, bytes, dict, Interface], *,
+                  key = None, block = False, timeout : float = None, priority = PRIORITY_NORMAL) -> int:
+        '''Queue data for every client, encoded once like publish(). Returns the number of clients that accepted it.'''
+        check_priority(priority)
+        with self.lock:
+            queued = self._frames_for(list(self.connections), data)
+        return self._enqueue(queued, key, block, timeout, priority)
+
+    def call(self, addr : Union[tuple, str], method : str, *, timeout : float = None, **kwargs) -> Future:
+        '''
+        Calls a handler a client registered (by address, or the first client with that ip) and returns
+        a Future of its result, see Client.call.
+        '''
         with self.lock:
             if isinstance(addr, tuple):
-                if addr in self.connections:
-                    with self.connections[addr]['send_lock']:
-                        self.connections[addr]['send_queue'].append(data)
-            if isinstance(addr, str):
-                for address, info in self.connections.items():
-                    if info['ip'] == addr:
-                        with self.connections[address]['send_lock']:
-                            self.connections[address]['send_queue'].append(data)
+                targets = [addr] if addr in self.connections or addr in self.parked else []
+            else:
+                targets = self._ip_targets(addr)
+            info = (self.connections.get(targets[0]) or self.parked[targets[0]]) if targets else None
+        future, frame = self.rpc.request(method, kwargs, targets[0] if targets else addr, timeout)
+        if info is None:
+            self.rpc.cancel(future, ConnectionError(f'No client at {addr}'))
+        elif not self._enqueue([(targets[0], frame, info['send_queue'])], None, True, timeout):
+            self.rpc.cancel(future, ConnectionError(f'Send queue of {addr} is full or closed'))
+        return future
+
+    def register(self, method : str, handler : Callable):
+        '''Handler for the clients' calls of `method`, called as handler(**kwargs) on a worker thread'''
+        self.rpc.register(method, handler)
+
+    def _replier(self, addr) -> Callable[[Frame], None]:
+        # Called with self.lock held. The response goes to the send queue of the connection the call
+        # came from, which moves to the new connection if the session is resumed.
+        info = self.connections[addr]
+        send_queue : LaneQueue = info['send_queue']
+        session : Session = info['session']
+        def reply(frame : Frame):
+            # Called from an RPC worker, which can wait for room in the queue
+            if not send_queue.put(frame, timeout=REPLY_TIMEOUT):
+                self.warning(f'Dropped an RPC response to {addr}, the send queue is full or closed')
+            with self.lock:
+                current = self.session_index.get(session.id, addr) if session is not None else addr
+            self._on_enqueue(current)
+        return reply
+
+    def stats(self) -> dict:
+        '''Snapshot of every connection's counters and latency histograms (see metrics.py)'''
+        with self.lock:
+            connections = {f'{addr[0]}:{addr[1]}': {**info['metrics'].snapshot(info['send_queue'], info['writer']),
+                                                    'transport': 'shm' if info['shm'] is not None else 'tcp'}
+                           for addr, info in self.connections.items() if info['metrics'] is not None}
+            topics = {topic: len(addresses) for topic, addresses in self.topics.items()}
+        stats = {'connections': connections, 'topics': topics, 'callbacks': self.dispatcher.stats()}
+        if self.udp is not None:
+            stats['udp_dropped'] = self.udp.dropped
+        return stats
+
+    def subscribers(self, topic : str) -> List[tuple]:
+        with self.lock:
+            return list(self.topics.get(topic, ()))
+
+    def _frames_for(self, targets : List[tuple], data: Union[str, bytes, dict, Interface], topic : str = None) -> List[tuple]:
+        # Called with self.lock held, returns (address, frame, send queue) for every target
+        frames : Dict[tuple, Frame] = {}
+        queued = []
+        for address in targets:
+            info = self.connections.get(address) or self.parked[address]
+            variant = (info['wire_format'], info['compressor'])
+            if variant not in frames:
+                frames[variant] = Frame(self._encode(info['wire_format'], data), topic=topic,
+                                        compressor=info['compressor'], threshold=self.compression_threshold)
+            queued.append((address, frames[variant], info['send_queue']))
+        return queued
+
+    def _enqueue(self, queued : List[tuple], key, block : bool, timeout : float, priority = PRIORITY_NORMAL) -> int:
+        # Put outside the lock, a blocking put waits for the I/O thread that needs the lock
+        accepted = 0
+        for address, frame, send_queue in queued:
+            if send_queue.put(frame, key=key, block=block, timeout=timeout, priority=priority):
+                accepted += 1
+            self._on_enqueue(address)
+        return accepted
+
+    @staticmethod
+    def _encode(wire_format : str, data: Union[str, bytes, dict, Interface]) -> Union[str, bytes, list]:
+        if isinstance(data, (dict, Interface)):
+            return CustomSocketMessage.encode_for_wire(data, wire_format)
+        return data
+
+    def _on_enqueue(self, addr):
+        self._write_now(addr)
+
+    def _write_now(self, addr) -> bool:
+        '''
+        Shared memory connections are written by the thread that queued the data instead of waiting
+        for the I/O loop. Returns False if that was not possible or not everything could be written.
+        '''
+        with self.lock:
+            info = self.connections.get(addr)
+            if info is None or info['shm'] is None:
+                return False
+        self._send_data(info['conn'], addr)
+        return len(info['writer']) == 0
+
+    def queue_depth(self, addr : Union[tuple, str] = None) -> Union[int, Dict[tuple, int]]:
+        '''Number of queued messages for a client by address or ip, or for every client'''
+        with self.lock:
+            depths = {address: len(info['send_queue']) for address, info in self.connections.items()}
+        if addr is None:
+            return depths
+        if isinstance(addr, tuple):
+            return depths.get(addr, 0)
+        return sum(depth for address, depth in depths.items() if address[0] == addr)
+
+    def send_telemetry(self, stream : str, data: Union[str, bytes, dict, Interface], addr : Union[tuple, str] = None):
+        '''
+        Send on the UDP channel to a client by address or ip, or to every client
+        the channel has heard from if no address is given.
+        '''
+        if self.udp is None:
+            raise RuntimeError('Server was created without udp=True')
+        with self.udp.lock:
+            if addr is None:
+                peers = list(self.udp.peers.values())
+            else:
+                ip = addr[0] if isinstance(addr, tuple) else addr
+                peers = [self.udp.peers[ip]] if ip in self.udp.peers else []
+        for peer in peers:
+            self.udp.send(stream, data, peer)
+
+    def get_telemetry(self, stream : str, ip : str = None) -> Union[str, bytes]:
+        if self.udp is None:
+            return None
+        return self.udp.get_data(stream, ip)
 
     def set_callback(self, addr, callback: Callable):
         with self.lock:
             if addr in self.connections:
                 self.connections[addr]['callback'] = callback
 
-    def get_data(self, ip) -> str:
+    def get_data(self, ip) -> Union[str, bytes]:
         with self.lock:
-            for addr, info in self.connections.items():
-                if info["ip"] == ip:
-                    with self.connections[addr]['read_lock']:
-                        return self.connections[addr]['data']
+            for addr in self.ip_index.get(ip, ()):
+                with self.connections[addr]['read_lock']:
+                    return self.connections[addr]['data']
         return None
\ No newline at end of file
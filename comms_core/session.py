@@ -0,0 +1,96 @@
+import time
+from collections import deque
+from typing import Any, Deque, List, Tuple, Union
+
+from .framing import Frame, FLAG_CONTROL
+from .handshake import control_frame
+from .send_queue import PRIORITY_NORMAL
+
+# Received data frames are acknowledged every ACK_EVERY frames, or ACK_INTERVAL seconds after the first unacknowledged one
+ACK_EVERY = 32
+ACK_INTERVAL = 0.2
+
+
+def parse_count(argument : str) -> Union[int, None]:
+    '''Frame count of an 'ack' or 'session' message (or the handshake's ack option), None if it is not one'''
+    try:
+        count = int(argument)
+    except (TypeError, ValueError):
+        return None
+    return count if count >= 0 else None
+
+
+class Session:
+    '''
+    One side of a resumable connection.
+
+    Data frames are numbered implicitly in the order they are written (TCP keeps the order),
+    so they carry no sequence number on the wire. Each side acknowledges the number of frames
+    it received with 'ack <count>' control frames, and the frames the peer has not acknowledged
+    are kept in a bounded retransmit buffer. After a reconnect the client presents the session id
+    and its count in the handshake, the server replies with 'session <count>' (or 'session new'
+    if it does not know the session) and both sides write the frames the other one missed.
+    Those are numbered again as they are written, so a bulk message resent in pieces is counted
+    when its last piece goes out, in the order the peer receives it.
+    '''
+
+    def __init__(self, session_id : str, retransmit_size = 1024):
+        self.id = session_id
+        self.retransmit_size = retransmit_size
+        # (number, data, priority) of the frames the peer has not acknowledged
+        self.retransmit : Deque[Tuple[int, Any, int]] = deque()
+        self.sent = 0
+        self.received = 0
+        # Count sent in the last acknowledgement
+        self.acked = 0
+        self.last_ack = time.monotonic()
+        # Frames the peer missed that had already been pushed out of the retransmit buffer
+        self.lost = 0
+
+    def on_sent(self, data : Any, priority = PRIORITY_NORMAL):
+        if isinstance(data, Frame) and data.flags & FLAG_CONTROL:
+            return
+        self.sent += 1
+        if len(self.retransmit) >= self.retransmit_size:
+            self.retransmit.popleft()
+        self.retransmit.append((self.sent, data, priority))
+
+    def on_received(self):
+        self.received += 1
+
+    def on_ack(self, count : int):
+        if count > self.sent:
+            # The peer cannot have received more than was sent, such a count would discard frames it is missing
+            return
+        retransmit = self.retransmit
+        while retransmit and retransmit[0][0] <= count:
+            retransmit.popleft()
+
+    def unacknowledged(self, count : int) -> List[Tuple[Any, int]]:
+        '''
+        (data, priority) of the frames to write again after the peer reconnected having received `count`
+        of them. They leave the buffer and are numbered from `count` on again when on_sent() sees them.
+        '''
+        self.on_ack(count)
+        first = self.retransmit[0][0] if self.retransmit else self.sent + 1
+        self.lost += max(0, first - count - 1)
+        pending = [(data, priority) for _, data, priority in self.retransmit]
+        self.retransmit.clear()
+        self.sent = count
+        return pending
+
+    def restart(self) -> List[Tuple[Any, int]]:
+        '''The peer does not know the session (it restarted), count from zero again. Returns the unacknowledged frames.'''
+        pending = [(data, priority) for _, data, priority in self.retransmit]
+        self.retransmit.clear()
+        self.sent = self.received = self.acked = 0
+        return pending
+
+    def ack_due(self, now : float) -> bool:
+        pending = self.received - self.acked
+        return pending >= ACK_EVERY or (pending > 0 and now - self.last_ack >= ACK_INTERVAL)
+
+    def ack_frame(self, now : float) -> Frame:
+        self.acked = self.received
+        self.last_ack = now
+        return control_frame('ack', str(self.received))
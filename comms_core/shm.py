@@ -0,0 +1,545 @@
+import os
+import sys
+import time
+import socket
+import platform
+import struct
+import tempfile
+from collections import deque
+from threading import Thread, Lock, Event, current_thread
+from typing import Callable, Deque, List, Tuple, Union
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    shared_memory = None
+
+from .logger import Logger
+from .framing import Frame, ChunkAssembler, FLAG_CHUNK, FLAG_MORE, WRITE_LIMIT, _payload_parts
+
+# The ring is only correct where plain stores become visible in program order (x86's total store order):
+# the consumer must never see a new WRITE_POSITION before the record it publishes. Python has no store
+# fences, so on weaker memory models (ARM, POWER, ...) connections stay on TCP.
+SHM_ARCHITECTURES = ('x86_64', 'amd64', 'i386', 'i686', 'x86')
+# Shared memory also needs AF_UNIX datagram sockets for the wake-ups
+SHM_AVAILABLE = shared_memory is not None and hasattr(socket, 'AF_UNIX') and platform.machine().lower() in SHM_ARCHITECTURES
+
+# Ring block: [header : HEADER_SIZE][data : capacity]
+# The positions are ever increasing byte counts, each on its own cache line and each written by one side only
+HEADER_SIZE = 256
+WRITE_POSITION = 0
+READ_POSITION = 64
+# Set by the consumer while it waits for the doorbell
+CONSUMER_WAITING = 128
+CAPACITY = 192
+_U64 = struct.Struct('<Q')
+
+# Every record: [length : uint32][flags : uint8][more : uint8][2 padding bytes][payload, padded to 8 bytes]
+# `more` is set on every chunk of a large message except the last one
+RECORD_HEADER = struct.Struct('<IBB2x')
+# Marks the unused end of the data area, the next record starts at the beginning
+WRAP = 0xFFFFFFFF
+
+DEFAULT_SIZE = 8 * 1024 * 1024
+# The consumer polls this long before it goes to sleep on the doorbell, and sleeps at most WAIT_TIMEOUT
+SPIN_TIME = 50e-6
+WAIT_TIMEOUT = 0.01
+
+# Blocks created by this process, attaching to one of them must not touch the resource tracker
+_created = set()
+
+
+def _align(size : int) -> int:
+    return (size + 7) & ~7
+
+
+def _take(parts : List[memoryview], size : int) -> List[memoryview]:
+    '''Removes the first `size` bytes from a list of buffers and returns them as buffers'''
+    taken = []
+    while size and parts:
+        part = parts[0]
+        if part.nbytes <= size:
+            taken.append(parts.pop(0))
+            size -= part.nbytes
+        else:
+            taken.append(part[:size])
+            parts[0] = part[size:]
+            size = 0
+    return taken
+
+
+def is_same_host(sock : socket.socket) -> bool:
+    '''True if the peer of a connected socket runs on this machine (it connected to an address of ours)'''
+    try:
+        return sock.getsockname()[0] == sock.getpeername()[0]
+    except OSError:
+        return False
+
+
+class ShmRing:
+    '''
+    Single producer, single consumer ring buffer in a multiprocessing.shared_memory block.
+
+    Lock free: the producer only writes the write position, the consumer only the read position,
+    both as aligned 8 byte stores, and a record is published by storing the write position after
+    the data. The consumer sleeps on an AF_UNIX datagram socket (the doorbell) when the ring is
+    empty, the producer rings it only when the consumer said it is waiting.
+
+    Memory ordering: publishing relies on x86 keeping stores in order and loads in order (see
+    SHM_ARCHITECTURES). The doorbell handshake (the consumer stores CONSUMER_WAITING then loads
+    WRITE_POSITION, the producer stores WRITE_POSITION then loads CONSUMER_WAITING) also needs the
+    store-load order x86 does not keep, both sides go through _fence() between the two.
+    '''
+
+    def __init__(self, shm, *, owner : bool):
+        self.shm = shm
+        self.owner = owner
+        self.name = shm.name
+        self.buf = shm.buf
+        self.capacity = _U64.unpack_from(self.buf, CAPACITY)[0]
+        self.doorbell = None
+        self.doorbell_sender = None
+        self.fence_lock = Lock()
+
+    def _fence(self):
+        # Taking a lock is a locked read-modify-write, which x86 orders like a full fence (mfence)
+        self.fence_lock.acquire()
+        self.fence_lock.release()
+
+    @classmethod
+    def create(cls, size = DEFAULT_SIZE) -> 'ShmRing':
+        size = _align(size)
+        shm = shared_memory.SharedMemory(create=True, size=HEADER_SIZE + size)
+        shm.buf[:HEADER_SIZE] = bytes(HEADER_SIZE)
+        _U64.pack_into(shm.buf, CAPACITY, size)
+        _created.add(shm.name)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name : str) -> 'ShmRing':
+        shm = shared_memory.SharedMemory(name=name)
+        # The creator unlinks the block, our resource tracker must not do it when this process exits
+        if shm.name not in _created:
+            try:
+                resource_tracker.unregister(shm._name, 'shared_memory')
+            except Exception:
+                pass
+        return cls(shm, owner=False)
+
+    @property
+    def doorbell_address(self) -> str:
+        if sys.platform.startswith('linux'):
+            # Abstract socket namespace, nothing to clean up on disk
+            return '\0comms-' + self.name.lstrip('/')
+        return os.path.join(tempfile.gettempdir(), 'comms-' + self.name.lstrip('/') + '.sock')
+
+    def _load(self, offset : int) -> int:
+        return _U64.unpack_from(self.buf, offset)[0]
+
+    def _store(self, offset : int, value : int):
+        _U64.pack_into(self.buf, offset, value)
+
+    def __len__(self):
+        '''Bytes in use'''
+        if self.buf is None:
+            return 0
+        return self._load(WRITE_POSITION) - self._load(READ_POSITION)
+
+    # Producer side
+
+    def write(self, parts : List[memoryview], length : int, flags : int, more = False) -> bool:
+        '''Writes one record, returns False if there is not enough free space (or the ring was closed)'''
+        if self.buf is None:
+            return False
+        need = RECORD_HEADER.size + _align(length)
+        write = self._load(WRITE_POSITION)
+        free = self.capacity - (write - self._load(READ_POSITION))
+        offset = write % self.capacity
+        tail = self.capacity - offset
+        if need > tail:
+            if free < tail + need:
+                return False
+            RECORD_HEADER.pack_into(self.buf, HEADER_SIZE + offset, WRAP, 0, 0)
+            write += tail
+            offset = 0
+        elif free < need:
+            return False
+        position = HEADER_SIZE + offset
+        RECORD_HEADER.pack_into(self.buf, position, length, flags, more)
+        position += RECORD_HEADER.size
+        for part in parts:
+            self.buf[position:position + part.nbytes] = part
+            position += part.nbytes
+        # Publishes the record
+        self._store(WRITE_POSITION, write + need)
+        return True
+
+    def notify(self):
+        '''Wakes up the consumer if it is waiting'''
+        if self.buf is None:
+            return
+        # The write position stored by write() must be visible before the flag is read
+        self._fence()
+        if not self._load(CONSUMER_WAITING):
+            return
+        if self.doorbell_sender is None:
+            self.doorbell_sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.doorbell_sender.setblocking(False)
+        try:
+            self.doorbell_sender.sendto(b'\0', self.doorbell_address)
+        except OSError:
+            # Already rung (the socket buffer is full) or the consumer is gone
+            pass
+
+    # Consumer side
+
+    def open_doorbell(self):
+        self.doorbell = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if not self.doorbell_address.startswith('\0') and os.path.exists(self.doorbell_address):
+            os.unlink(self.doorbell_address)
+        self.doorbell.bind(self.doorbell_address)
+
+    def read(self) -> Union[Tuple[bytes, int, bool], None]:
+        '''(payload, flags, more) of the next record, None if the ring is empty'''
+        read = self._load(READ_POSITION)
+        while read != self._load(WRITE_POSITION):
+            offset = read % self.capacity
+            length, flags, more = RECORD_HEADER.unpack_from(self.buf, HEADER_SIZE + offset)
+            if length == WRAP:
+                read += self.capacity - offset
+                continue
+            start = HEADER_SIZE + offset + RECORD_HEADER.size
+            payload = bytes(self.buf[start:start + length])
+            # Frees the space for the producer
+            self._store(READ_POSITION, read + RECORD_HEADER.size + _align(length))
+            return payload, flags, bool(more)
+        self._store(READ_POSITION, read)
+        return None
+
+    def wait(self, timeout = WAIT_TIMEOUT):
+        '''Returns when the ring has data, or after the timeout'''
+        deadline = time.perf_counter() + SPIN_TIME
+        while time.perf_counter() < deadline:
+            if len(self):
+                return
+        self._store(CONSUMER_WAITING, 1)
+        try:
+            # The producer may have written before it could see the flag
+            self._fence()
+            if len(self):
+                return
+            self.doorbell.settimeout(timeout)
+            try:
+                self.doorbell.recv(64)
+            except (socket.timeout, OSError):
+                pass
+        finally:
+            self._store(CONSUMER_WAITING, 0)
+
+    def close(self):
+        for sock in (self.doorbell, self.doorbell_sender):
+            if sock is not None:
+                sock.close()
+        if self.doorbell is not None and not self.doorbell_address.startswith('\0'):
+            try:
+                os.unlink(self.doorbell_address)
+            except OSError:
+                pass
+        self.buf = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A payload view still exists, the block is freed with it
+            pass
+        self.unlink()
+
+    def unlink(self):
+        '''Removes the block's name (owner only), the mappings stay valid until they are closed'''
+        if self.owner and self.name in _created:
+            _created.discard(self.name)
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+class ShmWriter:
+    '''
+    Drop-in replacement for FrameWriter once a connection switched to shared memory.
+
+    add() writes frames straight into the ring. Whatever does not fit (the consumer is behind)
+    stays pending and is written by the next flush(), messages larger than a quarter of the ring
+    are written in chunks. Until the frames that were already in the connection's FrameWriter
+    (e.g. the reply that announced the switch) went out, flush() keeps writing those to the socket.
+    Bulk frames are written by flush() only, in FLAG_CHUNK pieces behind every other frame and using at
+    most half of the ring, so urgent frames added later still find room and overtake them.
+    '''
+
+    def __init__(self, ring : ShmRing, tcp_writer = None, *, limit : int = WRITE_LIMIT):
+        self.ring = ring
+        self.tcp_writer = tcp_writer
+        self.limit = limit
+        self.max_chunk = ring.capacity // 4 - RECORD_HEADER.size
+        # [buffers left to write, flags, mark] of frames not (completely) in the ring yet
+        self.pending : Deque[list] = deque()
+        self.pending_bytes = 0
+        # [buffers left to write, flags, message, mark] of bulk frames
+        self.bulk : Deque[list] = deque()
+        self.bulk_bytes = 0
+        # Messages of the bulk frames completely written since the last call to completed()
+        self.finished : List = []
+        # Marks of the frames completely written since the last call to sent_marks()
+        self.sent : List = []
+        self.lock = Lock()
+        self.bytes_written = tcp_writer.bytes_written if tcp_writer is not None else 0
+        self.partial_writes = tcp_writer.partial_writes if tcp_writer is not None else 0
+
+    def __len__(self):
+        return self.pending_bytes + self.bulk_bytes + (len(self.tcp_writer) if self.tcp_writer is not None else 0)
+
+    def has_room(self, bulk = False) -> bool:
+        '''See FrameWriter.has_room, `limit` applies to the bytes that did not fit in the ring'''
+        with self.lock:
+            if self.tcp_writer is not None and not self.tcp_writer.has_room(bulk):
+                return False
+            return not self.bulk if bulk else self.pending_bytes < self.limit
+
+    def room(self) -> int:
+        with self.lock:
+            room = self.limit - self.pending_bytes
+            if self.tcp_writer is not None:
+                room = min(room, self.tcp_writer.room())
+            return room
+
+    def add(self, data : Union[str, bytes, list, Frame], flags : int = 0, *, bulk = False, message = None, mark = None):
+        if isinstance(data, Frame):
+            parts, flags = [memoryview(part).cast('B') for part in data.parts], data.flags
+        else:
+            parts, flags = _payload_parts(data, flags)
+            parts = [memoryview(part).cast('B') for part in parts]
+        with self.lock:
+            if bulk:
+                self.bulk.append([parts, flags, data if message is None else message, mark])
+                self.bulk_bytes += sum(part.nbytes for part in parts)
+                return
+            self.pending.append([parts, flags, mark])
+            self.pending_bytes += sum(part.nbytes for part in parts)
+            self._write_pending()
+
+    def _write_pending(self):
+        # Called with self.lock held
+        ring = self.ring
+        while self.pending:
+            entry = self.pending[0]
+            parts, flags, mark = entry
+            length = sum(part.nbytes for part in parts)
+            size = min(length, self.max_chunk)
+            rest = list(parts)
+            chunk = _take(rest, size)
+            if not ring.write(chunk, size, flags, more=size < length):
+                self.partial_writes += 1
+                return
+            if rest:
+                entry[0] = rest
+            else:
+                self.pending.popleft()
+                if mark is not None:
+                    self.sent.append(mark)
+            self.pending_bytes -= size
+            self.bytes_written += size
+
+    def _write_bulk(self):
+        # Called with self.lock held, after _write_pending() wrote everything else
+        ring = self.ring
+        while self.bulk:
+            entry = self.bulk[0]
+            parts, flags, message, mark = entry
+            length = sum(part.nbytes for part in parts)
+            size = min(length, self.max_chunk)
+            if len(ring) + size > ring.capacity // 2:
+                return
+            rest = list(parts)
+            chunk = _take(rest, size)
+            if not ring.write(chunk, size, flags | FLAG_CHUNK if not rest else FLAG_CHUNK | FLAG_MORE):
+                self.partial_writes += 1
+                return
+            if rest:
+                entry[0] = rest
+            else:
+                self.bulk.popleft()
+                self.finished.append(message)
+                if mark is not None:
+                    self.sent.append(mark)
+            self.bulk_bytes -= size
+            self.bytes_written += size
+
+    def chunks_waiting(self) -> bool:
+        return self.tcp_writer is not None and self.tcp_writer.chunks_waiting()
+
+    def completed(self) -> List:
+        '''Messages of the bulk frames added since the last call, see FrameWriter.completed'''
+        with self.lock:
+            finished, self.finished = self.finished, []
+            if self.tcp_writer is not None:
+                finished = self.tcp_writer.completed() + finished
+        return finished
+
+    def sent_marks(self) -> List:
+        '''Marks of the frames written to the socket or the ring since the last call, see FrameWriter.sent_marks'''
+        with self.lock:
+            sent, self.sent = self.sent, []
+            if self.tcp_writer is not None:
+                sent = self.tcp_writer.sent_marks() + sent
+        return sent
+
+    def flush(self, sock : socket.socket = None) -> bool:
+        '''Writes what is pending and wakes up the consumer. Returns True once nothing is left to write.'''
+        with self.lock:
+            done = True
+            if self.tcp_writer is not None:
+                done = self.tcp_writer.flush(sock)
+                if done:
+                    # Its frames went out before anything in the ring
+                    self.finished = self.tcp_writer.completed() + self.finished
+                    self.sent = self.tcp_writer.sent_marks() + self.sent
+                    self.tcp_writer = None
+            self._write_pending()
+            if not self.pending:
+                self._write_bulk()
+            done = done and not self.pending and not self.bulk
+        self.ring.notify()
+        return done
+
+    def clear(self) -> List:
+        '''Drops everything pending, returns the messages of the bulk frames not written yet (see FrameWriter.clear)'''
+        with self.lock:
+            self.pending.clear()
+            self.pending_bytes = 0
+            unfinished = self.tcp_writer.clear() if self.tcp_writer is not None else []
+            unfinished += [message for _, _, message, _ in self.bulk]
+            self.bulk.clear()
+            self.bulk_bytes = 0
+        return unfinished
+
+
+class ShmReader(Logger):
+    '''
+    Thread that reads the frames of a ring and passes them to `on_frames` as a list of
+    (payload, flags), like FrameBuffer.frames(). Chunked messages and bulk pieces are put back together.
+    '''
+
+    def __init__(self, ring : ShmRing, on_frames : Callable[[List[Tuple[bytes, int]]], None], *, batch = 64,
+                 on_exit : Callable[[], None] = None):
+        super().__init__('ShmReader')
+        self.ring = ring
+        self.on_frames = on_frames
+        self.on_exit = on_exit
+        self.batch = batch
+        self.chunks : List[bytes] = []
+        self.assembler = ChunkAssembler()
+        self.stopped = Event()
+        self.thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.ring.open_doorbell()
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread.is_alive() and self.thread is not current_thread():
+            self.thread.join(1)
+
+    def _run(self):
+        try:
+            self._read_loop()
+        finally:
+            if self.on_exit is not None:
+                self.on_exit()
+
+    def _read_loop(self):
+        ring = self.ring
+        while not self.stopped.is_set():
+            frames = []
+            while len(frames) < self.batch:
+                record = ring.read()
+                if record is None:
+                    break
+                payload, flags, more = record
+                if more:
+                    self.chunks.append(payload)
+                    continue
+                if self.chunks:
+                    self.chunks.append(payload)
+                    payload = b''.join(self.chunks)
+                    self.chunks = []
+                frame = self.assembler.add(payload, flags)
+                if frame is not None:
+                    frames.append(frame)
+            if frames:
+                try:
+                    self.on_frames(frames)
+                except Exception as e:
+                    self.error(f'Shared memory frame handler failed: {e}')
+                continue
+            ring.wait()
+
+
+class ShmLink:
+    '''
+    The two rings of a connection that switched to shared memory and the thread reading one of them.
+    The server creates the rings and names them in a 'shm <server to client>,<client to server>'
+    control frame, the client attaches to them.
+    '''
+
+    def __init__(self, send_ring : ShmRing, recv_ring : ShmRing, on_frames : Callable[[List[Tuple[bytes, int]]], None]):
+        self.send_ring = send_ring
+        self.recv_ring = recv_ring
+        self.reader = ShmReader(recv_ring, on_frames, on_exit=self._close_rings)
+        self.lock = Lock()
+        self.closed = False
+
+    @classmethod
+    def create(cls, size : int, on_frames : Callable[[List[Tuple[bytes, int]]], None]) -> 'ShmLink':
+        send_ring = ShmRing.create(size)
+        try:
+            recv_ring = ShmRing.create(size)
+        except OSError:
+            send_ring.close()
+            raise
+        return cls(send_ring, recv_ring, on_frames)
+
+    @classmethod
+    def attach(cls, names : str, on_frames : Callable[[List[Tuple[bytes, int]]], None]) -> 'ShmLink':
+        '''Client side, `names` is the argument of the server's control frame'''
+        server_send, server_recv = names.split(',')
+        recv_ring = ShmRing.attach(server_send)
+        try:
+            send_ring = ShmRing.attach(server_recv)
+        except OSError:
+            recv_ring.close()
+            raise
+        return cls(send_ring, recv_ring, on_frames)
+
+    @property
+    def names(self) -> str:
+        return f'{self.send_ring.name},{self.recv_ring.name}'
+
+    def start(self):
+        self.reader.start()
+
+    def _close_rings(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+        self.send_ring.close()
+        self.recv_ring.close()
+
+    def close(self):
+        if self.reader.thread.is_alive():
+            # The reader closes the rings when it stops, it may be waiting for a lock the caller holds
+            self.send_ring.unlink()
+            self.recv_ring.unlink()
+            self.reader.stopped.set()
+        else:
+            self._close_rings()
@@ -0,0 +1,181 @@
+import os
+import socket
+import struct
+from typing import Callable, Dict, List, Tuple, Union
+from threading import Thread, Lock
+
+from .logger import Logger
+from .framing import FLAG_BYTES
+from .csm import CustomSocketMessage
+from .data_interface import Interface
+
+# Every datagram is [header][stream name][payload fragment]
+# header: magic, flags, sender epoch, sequence number, fragment index, fragment count, stream name length
+# The epoch is random per channel, a peer that restarted starts new sequence numbers under a new one
+DATAGRAM_HEADER = struct.Struct('!BBIIHHB')
+DATAGRAM_MAGIC = 0xd7
+
+# Empty datagram a client sends so the server learns its UDP address
+FLAG_HELLO = 0x02
+
+# Keeps datagrams under a typical 1500 byte MTU after IP/UDP headers
+DEFAULT_MAX_DATAGRAM = 1200
+
+
+def _is_newer(seq : int, last : int) -> bool:
+    '''Serial number comparison, handles the 32 bit sequence number wrapping around'''
+    return 0 < (seq - last) & 0xffffffff < 0x80000000
+
+
+class UDPChannel(Logger):
+    '''
+    Unreliable latest-value-wins datagram channel for high rate telemetry.
+
+    Every named stream has its own sequence numbers. The receiver drops datagrams that are
+    older than (or the same as) the last one delivered for that stream, so a late packet
+    never overwrites newer data and a lost packet never delays the next one.
+    Payloads larger than `max_datagram` are fragmented, an incomplete message is dropped
+    as soon as a fragment of a newer message arrives. Malformed datagrams are counted in
+    `dropped` and otherwise ignored.
+    Messages that must arrive should stay on the TCP connection.
+    '''
+
+    def __init__(self, *, bind_address : Tuple[str, int] = ('0.0.0.0', 0), callback : Callable = None, max_datagram = DEFAULT_MAX_DATAGRAM):
+        super().__init__('UDPChannel')
+        self.callback = callback
+        self.max_datagram = max_datagram
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(bind_address)
+        self.sock.settimeout(0.5)
+        self.local_address = self.sock.getsockname()
+
+        self.lock = Lock()
+        self.epoch = int.from_bytes(os.urandom(4), 'big')
+        self.send_sequence : Dict[str, int] = {}
+        # peer -> epoch of its sequence numbers
+        self.epochs : Dict[tuple, int] = {}
+        # (peer, stream) -> last delivered sequence number
+        self.receive_sequence : Dict[Tuple[tuple, str], int] = {}
+        # (peer, stream) -> [sequence number, fragments]
+        self.partial : Dict[Tuple[tuple, str], list] = {}
+        # (peer, stream) -> latest data, the most recently updated last
+        self.data : Dict[Tuple[tuple, str], Union[str, bytes]] = {}
+        # ip -> last address a datagram came from
+        self.peers : Dict[str, tuple] = {}
+        self.dropped = 0
+
+        self.active = False
+        self.read_thread = Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.active = True
+        self.read_thread.start()
+
+    def stop(self):
+        self.active = False
+        if self.read_thread.is_alive():
+            self.read_thread.join()
+        self.sock.close()
+
+    def _run(self):
+        while self.active:
+            try:
+                datagram, addr = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                self._on_datagram(datagram, addr)
+            except Exception as e:
+                with self.lock:
+                    self.dropped += 1
+                self.warning(f'Dropped datagram from {addr}: {type(e).__name__}: {e}')
+
+    def send_hello(self, addr : tuple):
+        self.sock.sendto(DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, FLAG_HELLO, self.epoch, 0, 0, 1, 0), addr)
+
+    def send(self, stream : str, data : Union[str, bytes, dict, Interface], addr : tuple):
+        if isinstance(data, (dict, Interface)):
+            data = CustomSocketMessage.encode(data, binary=True)
+        flags = 0
+        if isinstance(data, str):
+            payload = data.encode()
+        else:
+            payload = bytes(data)
+            flags |= FLAG_BYTES
+        name = stream.encode()
+        with self.lock:
+            sequence = self.send_sequence[stream] = (self.send_sequence.get(stream, 0) + 1) & 0xffffffff
+        chunk_size = self.max_datagram - DATAGRAM_HEADER.size - len(name)
+        count = max(1, -(-len(payload) // chunk_size))
+        if count > 0xffff:
+            raise ValueError(f'Payload of {len(payload)} bytes is too large for the UDP channel')
+        for index in range(count):
+            header = DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, flags, self.epoch, sequence, index, count, len(name))
+            self.sock.sendto(header + name + payload[index * chunk_size:(index + 1) * chunk_size], addr)
+
+    def _on_datagram(self, datagram : bytes, addr : tuple):
+        if len(datagram) < DATAGRAM_HEADER.size or datagram[0] != DATAGRAM_MAGIC:
+            return
+        _, flags, epoch, sequence, index, count, name_length = DATAGRAM_HEADER.unpack_from(datagram)
+        offset = DATAGRAM_HEADER.size
+        if index >= count or offset + name_length > len(datagram):
+            with self.lock:
+                self.dropped += 1
+            return
+        with self.lock:
+            self.peers[addr[0]] = addr
+            if self.epochs.get(addr) != epoch:
+                # New peer, or it restarted: its old sequence numbers mean nothing anymore
+                self.epochs[addr] = epoch
+                for key in [key for key in self.receive_sequence if key[0] == addr]:
+                    del self.receive_sequence[key]
+                for key in [key for key in self.partial if key[0] == addr]:
+                    del self.partial[key]
+        if flags & FLAG_HELLO:
+            self.log(f'UDP hello from {addr}')
+            return
+        stream = datagram[offset:offset + name_length].decode()
+        chunk = datagram[offset + name_length:]
+        key = (addr, stream)
+        with self.lock:
+            last = self.receive_sequence.get(key)
+            if last is not None and not _is_newer(sequence, last):
+                self.dropped += 1
+                return
+            if count == 1:
+                payload = chunk
+            else:
+                partial = self.partial.get(key)
+                if partial is not None and partial[0] == sequence and len(partial[1]) != count:
+                    self.dropped += 1
+                    return
+                if partial is None or partial[0] != sequence:
+                    if partial is not None and not _is_newer(sequence, partial[0]):
+                        self.dropped += 1
+                        return
+                    # A newer message replaces an incomplete older one
+                    partial = self.partial[key] = [sequence, [None] * count]
+                fragments : List[bytes] = partial[1]
+                fragments[index] = chunk
+                if None in fragments:
+                    return
+                del self.partial[key]
+                payload = b''.join(fragments)
+            data = payload if flags & FLAG_BYTES else payload.decode()
+            self.receive_sequence[key] = sequence
+            self.data.pop(key, None)
+            self.data[key] = data
+        if self.callback is not None:
+            self.callback(stream, data, addr)
+
+    def get_data(self, stream : str, ip : str = None) -> Union[str, bytes]:
+        '''Latest data received on a stream, from a given peer ip or from any peer'''
+        with self.lock:
+            for (addr, name), data in reversed(list(self.data.items())):
+                if name == stream and (ip is None or addr[0] == ip):
+                    return data
+        return None
@@ -0,0 +1,33 @@
+from comms_core import CustomSocketMessage, BinaryMessage
+
+from common import measure
+
+PAYLOADS = {
+    'scalars': {'mode': 1, 'heading': 182.5, 'status': 'docking', 'armed': True, 'target': None},
+    'bytes': {'frame': bytes(range(256)) * 16},
+    '2d_list': {'grid': [[row * 20 + col for col in range(20)] for row in range(20)]},
+    'large_list': {'ranges': [i * 0.01 for i in range(10000)]},
+}
+
+
+def run(quick = False) -> dict:
+    scale = 10 if quick else 1
+    results = {}
+    for name, payload in PAYLOADS.items():
+        number = max(1, (20 if name == 'large_list' else 2000) // scale)
+        text = CustomSocketMessage.encode(payload)
+        binary = BinaryMessage.encode(payload)
+        results[name] = {
+            'text_bytes': len(text.encode()),
+            'binary_bytes': len(binary),
+            'text_encode': measure(lambda: CustomSocketMessage.encode(payload), number=number),
+            'text_decode': measure(lambda: CustomSocketMessage.decode(text), number=number),
+            'binary_encode': measure(lambda: BinaryMessage.encode(payload), number=number),
+            'binary_decode': measure(lambda: BinaryMessage.decode(binary), number=number),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    import json
+    print(json.dumps(run(), indent=2))
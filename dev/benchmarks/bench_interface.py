@@ -0,0 +1,34 @@
+from comms_core import Interface
+
+from common import measure
+
+SIZES = (100, 1000, 10000)
+
+
+def _filled(size : int, remove_time = None) -> Interface:
+    interface = Interface(default_remove_time=remove_time)
+    interface.from_dict({f'key_{i}': float(i) for i in range(size)})
+    return interface
+
+
+def run(quick = False) -> dict:
+    results = {}
+    for size in SIZES[:2] if quick else SIZES:
+        interface = _filled(size)
+        expiring = _filled(size, remove_time=3600)
+        other = _filled(size)
+        number = max(1, 20000 // size)
+        results[str(size)] = {
+            'set': measure(lambda: setattr(interface, 'key_1', 1.0), number=10000),
+            'get': measure(lambda: interface.key_1, number=10000),
+            'to_dict': measure(interface.to_dict, number=number),
+            'to_dict_with_ttl': measure(expiring.to_dict, number=number),
+            'to_dict_with_timestamps': measure(interface.to_dict_with_timestamps, number=number),
+            'from_interface': measure(lambda: interface.from_interface(other), number=number),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    import json
+    print(json.dumps(run(), indent=2))
@@ -0,0 +1,121 @@
+import time
+import queue
+import socket
+from threading import Thread
+
+from comms_core import Server, SelectorServer, Client
+
+from common import percentile
+
+SERVERS = {'threaded': Server, 'selector': SelectorServer}
+
+
+def _free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class _Loopback:
+    '''A server echoing every message back to its sender (from a relay thread, Server callbacks hold its lock) and N clients'''
+
+    def __init__(self, server_class, client_count : int, on_reply):
+        self.port = _free_port()
+        self.received = 0
+        self.echo = queue.Queue()
+        self.server = server_class(port=self.port, default_callback=self._on_message, queue_size=65536, queue_policy='block')
+        self.clients = [Client('127.0.0.1', port=self.port, callback=on_reply, queue_size=65536, queue_policy='block')
+                        for _ in range(client_count)]
+        self.relay = Thread(target=self._relay, daemon=True)
+
+    def _on_message(self, data, addr):
+        self.received += 1
+        if data.startswith('ping'):
+            self.echo.put((data, addr))
+
+    def _relay(self):
+        while True:
+            item = self.echo.get()
+            if item is None:
+                return
+            self.server.send(*item)
+
+    def __enter__(self):
+        self.server.start()
+        self.relay.start()
+        for client in self.clients:
+            client.start()
+        deadline = time.time() + 20
+        while len(self.server.connections) < len(self.clients) or not all(client.init for client in self.clients):
+            if time.time() > deadline:
+                raise TimeoutError(f'Only {len(self.server.connections)} of {len(self.clients)} clients connected')
+            time.sleep(0.05)
+        # Let the handshakes go through
+        time.sleep(0.2)
+        self.received = 0
+        return self
+
+    def __exit__(self, *exc):
+        for client in self.clients:
+            client.stop()
+        self.echo.put(None)
+        self.server.stop()
+
+
+def throughput(server_class, client_count : int, messages_per_client : int) -> dict:
+    with _Loopback(server_class, client_count, None) as loopback:
+        payload = 'x' * 100
+        start = time.perf_counter()
+        for _ in range(messages_per_client):
+            for client in loopback.clients:
+                client.send(payload)
+        total = client_count * messages_per_client
+        deadline = time.time() + 60
+        while loopback.received < total and time.time() < deadline:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+    return {
+        'messages': loopback.received,
+        'expected': total,
+        'seconds': elapsed,
+        'messages_per_s': loopback.received / elapsed,
+    }
+
+
+def latency(server_class, client_count : int, duration : float, rate : float = 50) -> dict:
+    '''Every client sends `rate` pings per second, the round trip is measured from the send() call to the callback'''
+    samples = []
+
+    def on_reply(data, addr):
+        samples.append(time.perf_counter() - float(data.split()[1]))
+
+    with _Loopback(server_class, client_count, on_reply) as loopback:
+        end = time.time() + duration
+        while time.time() < end:
+            for client in loopback.clients:
+                client.send(f'ping {time.perf_counter()!r}')
+            time.sleep(1 / rate)
+        time.sleep(0.5)
+    return {
+        'samples': len(samples),
+        'p50_ms': percentile(samples, 50) * 1e3 if samples else None,
+        'p99_ms': percentile(samples, 99) * 1e3 if samples else None,
+        'max_ms': max(samples) * 1e3 if samples else None,
+    }
+
+
+def run(quick = False) -> dict:
+    client_counts = (1, 4) if quick else (1, 4, 16)
+    results = {}
+    for name, server_class in SERVERS.items():
+        for client_count in client_counts:
+            results[f'{name}_{client_count}_clients'] = {
+                'throughput': throughput(server_class, client_count, 500 if quick else 5000),
+                'latency': latency(server_class, client_count, 1 if quick else 5),
+            }
+    return results
+
+
+if __name__ == '__main__':
+    import json
+    print(json.dumps(run(), indent=2))
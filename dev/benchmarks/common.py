@@ -0,0 +1,47 @@
+import json
+import time
+import platform
+import subprocess
+from typing import Callable, Dict, List
+
+
+def measure(function : Callable, *, number : int, repeat : int = 5) -> Dict[str, float]:
+    '''Time `number` calls `repeat` times, reports the best and median run per call'''
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        runs.append((time.perf_counter() - start) / number)
+    runs.sort()
+    return {
+        'best_us': runs[0] * 1e6,
+        'median_us': runs[len(runs) // 2] * 1e6,
+        'ops_per_s': 1 / runs[0],
+    }
+
+
+def percentile(samples : List[float], percent : float) -> float:
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def metadata() -> Dict[str, str]:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, timeout=5).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+    }
+
+
+def save(results : dict, path : str):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
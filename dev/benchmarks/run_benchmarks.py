@@ -0,0 +1,80 @@
+'''
+Runs the benchmarks and saves the results as JSON, optionally comparing them to an earlier run.
+
+    python dev/benchmarks/run_benchmarks.py --output results.json
+    python dev/benchmarks/run_benchmarks.py --quick --only codec interface --compare results.json
+'''
+import os
+import sys
+import json
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import bench_codec
+import bench_interface
+import bench_transport
+from common import metadata, save
+
+SUITES = {
+    'codec': bench_codec.run,
+    'interface': bench_interface.run,
+    'transport': bench_transport.run,
+}
+
+# Lower is better for these, higher for everything in COMPARED_HIGHER
+COMPARED_LOWER = ('best_us', 'p50_ms', 'p99_ms')
+COMPARED_HIGHER = ('messages_per_s',)
+
+
+def _flatten(results : dict, prefix = '') -> dict:
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(_flatten(value, f'{prefix}{key}.'))
+        else:
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+
+def compare(baseline : dict, current : dict, threshold : float) -> list:
+    '''Metrics that got worse by more than `threshold` (a fraction)'''
+    old, new = _flatten(baseline.get('results', {})), _flatten(current['results'])
+    regressions = []
+    for name, value in new.items():
+        metric = name.rsplit('.', 1)[-1]
+        previous = old.get(name)
+        if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)) or previous <= 0:
+            continue
+        if metric in COMPARED_LOWER and value > previous * (1 + threshold):
+            regressions.append((name, previous, value))
+        if metric in COMPARED_HIGHER and value < previous * (1 - threshold):
+            regressions.append((name, previous, value))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='comms_core benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--only', nargs='+', choices=list(SUITES), default=list(SUITES))
+    parser.add_argument('--quick', action='store_true', help='fewer iterations and clients, for a smoke test')
+    parser.add_argument('--compare', help='earlier results file to check for regressions')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change reported as a regression')
+    args = parser.parse_args()
+
+    results = {'metadata': {**metadata(), 'quick': args.quick}, 'results': {}}
+    for name in args.only:
+        print(f'Running {name} benchmarks')
+        results['results'][name] = SUITES[name](quick=args.quick)
+    save(results, args.output)
+    print(f'Saved results to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, args.threshold)
+        for name, previous, value in regressions:
+            print(f'REGRESSION {name}: {previous:.4g} -> {value:.4g}')
+        if regressions:
+            sys.exit(1)
+        print('No regressions')
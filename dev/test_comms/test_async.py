@@ -0,0 +1,79 @@
+import asyncio
+import socket
+import time
+
+from comms_core import AsyncClient, AsyncServer, Client, CustomSocketMessage, PRIORITY_BULK
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        await asyncio.sleep(0.01)
+    return condition()
+
+
+def test_async_round_trip():
+    async def main():
+        port = free_port()
+        server = AsyncServer(port=port)
+        replies = []
+
+        async def on_reply(data, addr):
+            replies.append(data)
+
+        client = AsyncClient('127.0.0.1', port=port, wire_format='binary', callback=on_reply)
+        # Queued until the connection is made
+        assert await client.send('early')
+        await server.start()
+        await client.start()
+        try:
+            data, addr = await asyncio.wait_for(server.__anext__(), 5)
+            assert data == 'early'
+            await client.send({'x': 1.5, 'ok': True})
+            data, addr = await asyncio.wait_for(server.__anext__(), 5)
+            assert CustomSocketMessage.decode(data) == {'x': 1.5, 'ok': True}
+            # The handshake asked for the binary format
+            await server.send({'mode': 'auto'}, addr)
+            assert await wait_for(lambda: replies)
+            assert CustomSocketMessage.decode(replies[0]) == {'mode': 'auto'}
+            await client.subscribe('pose')
+            assert await wait_for(lambda: 'pose' in server.topics)
+            assert await server.publish('pose', 'x=1') == 1
+            assert await wait_for(lambda: client.get_data('pose') == 'x=1')
+            await client.unsubscribe('pose')
+            assert await wait_for(lambda: 'pose' not in server.topics)
+        finally:
+            await client.stop()
+            await server.stop()
+
+    asyncio.run(main())
+
+
+def test_threaded_client_talks_to_async_server():
+    async def main():
+        port = free_port()
+        server = AsyncServer(port=port)
+        await server.start()
+        client = Client('127.0.0.1', port=port, shared_memory=False)
+        client.start()
+        try:
+            # The server does not resume sessions, the client stops waiting for it
+            assert await wait_for(lambda: client.init and client.session_ready)
+            assert client.session is None
+            client.send(b'\x00' * 200_000, priority=PRIORITY_BULK)
+            data, addr = await asyncio.wait_for(server.__anext__(), 5)
+            # The bulk message was written in pieces and put back together
+            assert data == b'\x00' * 200_000
+            await server.send('reply', addr)
+            assert await wait_for(lambda: client.get_data() == 'reply')
+        finally:
+            client.stop()
+            await server.stop()
+
+    asyncio.run(main())
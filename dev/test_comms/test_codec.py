@@ -0,0 +1,63 @@
+import enum
+
+import pytest
+
+from comms_core import BinaryMessage, CustomSocketMessage, Interface
+from comms_core.codec import BinaryCodecError, MAGIC, VERSION
+
+
+class Mode(enum.IntEnum):
+    AUTO = 2
+
+
+def test_round_trip_keeps_types():
+    data = {
+        'int': -7, 'big': 1 << 80, 'float': 1.25, 'str': 'héllo', 'empty': '', 'true': True, 'false': False,
+        'none': None, 'bytes': b'\x00\xff', 'floats': [1.0, 2.5], 'ints': (1, 2, 3), 'mixed': [1, 'a', None, 2.0],
+        'nested': {'pose': (1.0, 2.0), 3: [[1, 2], [3]]}, 'empty_list': [], 'empty_tuple': (),
+        'huge_ints': [1 << 70, 1], 'enum': Mode.AUTO,
+    }
+    decoded = BinaryMessage.decode(BinaryMessage.encode(data))
+    expected = dict(data, enum=2)
+    assert decoded == expected
+    for key, value in expected.items():
+        assert type(decoded[key]) is type(value), key
+    assert type(decoded['nested']['pose']) is tuple and type(decoded['huge_ints']) is list
+
+
+def test_interfaces_and_encode_vars():
+    interface = Interface()
+    interface.x = 1.5
+    interface.name = 'boat'
+    message = BinaryMessage.encode(interface)
+    assert message == BinaryMessage.encode_vars(x=1.5, name='boat')
+    assert BinaryMessage.encode_buffers(interface) == message
+    decoded = BinaryMessage.decode(message, as_interface=True)
+    assert decoded.x == 1.5 and decoded.name == 'boat'
+    # Binary messages are recognised by CustomSocketMessage.decode
+    assert CustomSocketMessage.decode(message) == {'x': 1.5, 'name': 'boat'}
+    assert CustomSocketMessage.decode(bytearray(message)) == {'x': 1.5, 'name': 'boat'}
+
+
+def test_unsupported_values_are_rejected():
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.encode({'x': object()})
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.encode({'x': {1.5j}})
+
+
+def test_malformed_messages_raise_codec_errors():
+    message = BinaryMessage.encode({'name': 'boat', 'values': [1.0, 2.0], 'n': 3})
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.decode(b'plain text')
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.decode(MAGIC + bytes([VERSION + 1]) + message[2:])
+    # Every truncation of a valid message fails cleanly
+    for end in range(2, len(message)):
+        with pytest.raises(BinaryCodecError):
+            BinaryMessage.decode(message[:end])
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.decode(MAGIC + bytes([VERSION]) + b'?')
+    # Invalid utf-8 in a string
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.decode(BinaryMessage.encode({'s': 'ab'}).replace(b'ab', b'\xff\xfe'))
@@ -0,0 +1,92 @@
+import socket
+import time
+
+import pytest
+
+from comms_core import Client, Server
+from comms_core.compression import (LzmaCompressor, ZlibCompressor, build_dictionary, make_compressors, negotiate,
+                                    offer)
+from comms_core.framing import Frame, FrameError, FLAG_COMPRESSED, unpack_message
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+PAYLOAD = b'{x:1.0<float>}*%*{mode:auto<str>}*%*' * 200
+
+
+def test_codecs_round_trip_and_reject_bad_input():
+    dictionary = build_dictionary([PAYLOAD[:500]])
+    for compressor in (ZlibCompressor(), ZlibCompressor(zdict=dictionary), LzmaCompressor()):
+        compressed = compressor.compress(PAYLOAD)
+        assert len(compressed) < len(PAYLOAD)
+        assert compressor.decompress(compressed, len(PAYLOAD)) == PAYLOAD
+        # Larger than allowed (a decompression bomb), truncated, or not compressed data at all
+        with pytest.raises(FrameError):
+            compressor.decompress(compressed, len(PAYLOAD) - 1)
+        with pytest.raises(FrameError):
+            compressor.decompress(compressed[:len(compressed) // 2], len(PAYLOAD))
+        with pytest.raises(FrameError):
+            compressor.decompress(b'\xff' * 64, len(PAYLOAD))
+
+
+def test_negotiation():
+    dictionary = build_dictionary([PAYLOAD])
+    server = make_compressors(['zlib', LzmaCompressor()])
+    assert negotiate(offer(make_compressors(['lzma', 'zlib'])), server).name == 'lzma'
+    assert negotiate(offer(make_compressors('zlib')), server).name == 'zlib'
+    # The same codec with a different dictionary does not match
+    assert negotiate(offer([ZlibCompressor(zdict=dictionary)]), server) is None
+    assert negotiate(offer([ZlibCompressor(zdict=dictionary)]), [ZlibCompressor(zdict=dictionary)]) is not None
+    assert negotiate('brotli,snappy', server) is None
+    assert offer([]) is None and make_compressors(None) == []
+    with pytest.raises(ValueError):
+        make_compressors('brotli')
+
+
+def test_compressed_frames():
+    compressor = ZlibCompressor()
+    frame = Frame(PAYLOAD, topic='telemetry', compressor=compressor, threshold=512)
+    assert frame.flags & FLAG_COMPRESSED and frame.length < len(PAYLOAD)
+    assert unpack_message(b''.join(frame.parts), frame.flags, compressor) == (PAYLOAD, 'telemetry')
+    with pytest.raises(FrameError):
+        unpack_message(b''.join(frame.parts), frame.flags)
+    # Below the threshold, or when compressing does not make it smaller
+    assert not Frame(PAYLOAD[:100], compressor=compressor, threshold=512).flags & FLAG_COMPRESSED
+    assert not Frame(bytes(range(256)), compressor=compressor).flags & FLAG_COMPRESSED
+
+
+def test_compression_is_negotiated_per_connection():
+    port = free_port()
+    received = []
+    server = Server(port=port, shared_memory=False, compression='zlib',
+                    default_callback=lambda data, addr: received.append(data))
+    compressed = Client('127.0.0.1', port=port, shared_memory=False, compression=['lzma', 'zlib'])
+    plain = Client('127.0.0.1', port=port, shared_memory=False)
+    server.start()
+    compressed.start()
+    plain.start()
+    try:
+        assert wait_for(lambda: compressed.init and compressed.session_ready and plain.init and plain.session_ready)
+        assert wait_for(lambda: compressed.compressor is not None)
+        assert compressed.compressor.name == 'zlib' and plain.compressor is None
+        for client in (compressed, plain):
+            client.send(PAYLOAD)
+        assert wait_for(lambda: received == [PAYLOAD, PAYLOAD])
+        assert compressed.stats()['bytes_out'] < len(PAYLOAD) < plain.stats()['bytes_out']
+        assert server.broadcast(PAYLOAD) == 2
+        assert wait_for(lambda: compressed.get_data() == PAYLOAD and plain.get_data() == PAYLOAD)
+    finally:
+        compressed.stop()
+        plain.stop()
+        server.stop()
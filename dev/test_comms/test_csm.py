@@ -0,0 +1,53 @@
+import random
+
+from comms_core import CustomSocketMessage, CSMDecoder, CSMDecodeError
+
+DATA = {'pose': (1.5, 2.0, 3.25), 'mode': 2, 'name': 'gate ✓', 'raw': b'\x00\xff', 'grid': [[1, 2], [3, 4]]}
+
+
+def test_feed_in_chunks_of_every_size():
+    message = CustomSocketMessage.encode(DATA).encode()
+    for size in range(1, len(message) + 1):
+        decoder = CSMDecoder()
+        items = []
+        for start in range(0, len(message), size):
+            items += decoder.feed(message[start:start + size])
+        items += decoder.finish()
+        assert dict(items) == DATA, size
+        assert decoder.errors == []
+
+
+def test_feed_at_random_split_points():
+    rng = random.Random(7)
+    message = CustomSocketMessage.encode({f'key{i}': i for i in range(200)})
+    for _ in range(50):
+        cuts = sorted(rng.sample(range(1, len(message)), 40))
+        chunks = [message[a:b] for a, b in zip([0] + cuts, cuts + [len(message)])]
+        assert dict(CustomSocketMessage.decode_stream(chunks)) == {f'key{i}': i for i in range(200)}
+
+
+def test_feed_is_eager():
+    decoder = CSMDecoder()
+    # Not iterating the result does not lose the items
+    decoder.feed('{a:1<int>}*%*{b:')
+    assert decoder.feed('2<int>}*%*') == [('b', 2)]
+    assert decoder.finish() == []
+
+
+def test_malformed_items_and_bytes_are_reported():
+    decoder = CSMDecoder()
+    items = decoder.feed('{a:1<int>}*%*{broken}*%*{b:2<int>}*%*')
+    items += decoder.feed(b'\xff\xfe')
+    items += decoder.feed('{c:3<int>}*%*')
+    assert dict(items) == {'a': 1, 'b': 2, 'c': 3}
+    assert len(decoder.errors) == 2 and all(isinstance(error, CSMDecodeError) for error in decoder.errors)
+
+
+def test_decode_reports_errors_instead_of_raising():
+    errors = []
+    assert CustomSocketMessage.decode(b'{a:1<int>}*%*\xff', errors=errors) == {}
+    assert len(errors) == 1 and isinstance(errors[0], CSMDecodeError)
+    errors = []
+    assert CustomSocketMessage.decode('{a:1<int>}*%*{nope}*%*', errors=errors) == {'a': 1}
+    assert len(errors) == 1
+    assert CustomSocketMessage.decode(CustomSocketMessage.encode(DATA)) == DATA
@@ -0,0 +1,102 @@
+import threading
+import time
+
+from comms_core import Interface, InterfaceSender
+
+
+def test_membership_and_length_skip_expired_values():
+    interface = Interface()
+    interface.kept = 1
+    interface.gone = 2
+    interface.set_remove_time('gone', 0.02)
+    assert len(interface) == 2 and 'gone' in interface
+    time.sleep(0.03)
+    assert 'gone' not in interface
+    assert 'kept' in interface
+    assert len(interface) == 1
+
+
+def test_lookups_while_iterating_past_a_remove_time():
+    interface = Interface()
+    for i in range(20):
+        interface[f'key{i}'] = i
+        interface.set_remove_time(f'key{i}', 0.01 if i % 2 else None)
+    seen = []
+    for key in interface:
+        time.sleep(0.002)
+        # Used to remove the expired keys from the dict being iterated
+        if key in interface and len(interface):
+            seen.append(key)
+    assert len(seen) >= 10
+    assert sorted(interface) == sorted(f'key{i}' for i in range(0, 20, 2))
+
+
+def test_observers_hear_about_expiry_without_a_reader():
+    interface = Interface()
+    removed = []
+    interface.subscribe('pose_*', lambda changes, keys: removed.extend(keys))
+    interface.pose_x = 1.0
+    interface.set_remove_time('pose_x', 0.05)
+    interface.pose_y = 2.0
+    interface.set_remove_time('pose_y', 0.5)
+    # Nothing reads the interface, the timer evicts the key at its remove time
+    time.sleep(0.15)
+    assert removed == ['pose_x']
+    # An earlier deadline set while the timer sleeps wakes it up
+    interface.pose_z = 3.0
+    interface.set_remove_time('pose_z', 0.02)
+    time.sleep(0.1)
+    assert removed == ['pose_x', 'pose_z']
+
+
+def test_expiry_timer_stops_without_observers():
+    interface = Interface()
+    observer_id = interface.subscribe('*', lambda changes, keys: None)
+    timer = interface.interface_expiry_timer
+    assert timer is not None and timer.is_alive()
+    interface.unsubscribe(observer_id)
+    timer.join(1)
+    assert not timer.is_alive()
+    assert interface.interface_expiry_timer is None
+
+
+def test_wait_for_change_returns_on_expiry():
+    interface = Interface()
+    interface.mode = 1
+    interface.set_remove_time('mode', 0.05)
+    start = time.time()
+    assert interface.wait_for_change('mode', timeout=1)
+    assert time.time() - start < 0.5
+    assert not interface.wait_for_change('mode', timeout=0.05)
+
+
+def test_expiry_timer_runs_alongside_readers_and_writers():
+    interface = Interface(default_remove_time=0.001)
+    removed = []
+    interface.subscribe('*', lambda changes, keys: removed.extend(keys))
+    sender = InterfaceSender(interface, keyframe_interval=5)
+    errors = []
+
+    def writer():
+        try:
+            for i in range(20000):
+                interface[f'key{i % 500}'] = i
+                if i % 7 == 0:
+                    del interface[f'key{(i + 3) % 500}']
+        except Exception as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    # The timer evicts from its own thread while these copy or walk the storage
+    while thread.is_alive():
+        interface.to_dict()
+        interface.to_dict_with_timestamps()
+        list(interface)
+        len(interface)
+        sender.encode()
+        interface.expire()
+    thread.join()
+    assert errors == []
+    time.sleep(0.05)
+    assert interface.to_dict() == {} and removed
@@ -0,0 +1,173 @@
+import socket
+import threading
+import time
+
+from comms_core import Client, Server, SelectorServer
+from comms_core.dispatch import CallbackDispatcher
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_messages_of_a_connection_stay_in_order():
+    dispatcher = CallbackDispatcher(4)
+    received = {'a': [], 'b': []}
+    try:
+        for i in range(200):
+            for connection in received:
+                assert dispatcher.submit(connection, lambda data, peer: received[peer].append(data), i, connection)
+        assert wait_for(lambda: all(len(messages) == 200 for messages in received.values()))
+        assert all(messages == list(range(200)) for messages in received.values())
+    finally:
+        dispatcher.shutdown()
+
+
+def test_a_slow_connection_does_not_hold_the_others():
+    dispatcher = CallbackDispatcher(2)
+    release = threading.Event()
+    fast = []
+    try:
+        dispatcher.submit('slow', lambda data, peer: release.wait(5), None, 'slow')
+        for i in range(10):
+            dispatcher.submit('fast', lambda data, peer: fast.append(data), i, 'fast')
+        assert wait_for(lambda: len(fast) == 10, 2)
+        assert dispatcher.queue_depth('slow') == 0
+    finally:
+        release.set()
+        dispatcher.shutdown()
+
+
+def test_full_inbox_waits_then_drops_with_a_warning(caplog):
+    dispatcher = CallbackDispatcher(1, inbox_size=1, inbox_policy='block', inbox_timeout=0.05)
+    release = threading.Event()
+    try:
+        dispatcher.submit('c', lambda data, peer: release.wait(5), None, 'c')
+        assert wait_for(lambda: dispatcher.queue_depth('c') == 0)
+        assert dispatcher.submit('c', lambda data, peer: None, 1, 'c')
+        start = time.monotonic()
+        with caplog.at_level('WARNING', logger='CallbackDispatcher'):
+            assert not dispatcher.submit('c', lambda data, peer: None, 2, 'c')
+        assert time.monotonic() - start >= 0.05
+        assert dispatcher.stats()['dropped'] == 1
+        assert 'dropped a message' in caplog.text
+    finally:
+        release.set()
+        dispatcher.shutdown()
+
+
+def test_drop_oldest_warns_on_every_drop(caplog):
+    dispatcher = CallbackDispatcher(1, inbox_size=1)
+    release = threading.Event()
+    received = []
+    try:
+        dispatcher.submit('c', lambda data, peer: release.wait(5), None, 'c')
+        assert wait_for(lambda: dispatcher.queue_depth('c') == 0)
+        with caplog.at_level('WARNING', logger='CallbackDispatcher'):
+            for i in range(3):
+                assert dispatcher.submit('c', lambda data, peer: received.append(data), i, 'c')
+        assert caplog.text.count('dropped its oldest message') == 2
+        release.set()
+        assert wait_for(lambda: received == [2])
+        assert dispatcher.stats()['dropped'] == 2
+    finally:
+        release.set()
+        dispatcher.shutdown()
+
+
+def test_callback_errors_do_not_stop_the_inbox():
+    dispatcher = CallbackDispatcher(1)
+    received = []
+    try:
+        dispatcher.submit('c', lambda data, peer: 1 / 0, None, 'c')
+        dispatcher.submit('c', lambda data, peer: received.append(data), 'after', 'c')
+        assert wait_for(lambda: received == ['after'])
+    finally:
+        dispatcher.shutdown()
+
+
+def test_shutdown_releases_a_waiting_submit():
+    dispatcher = CallbackDispatcher(1, inbox_size=1, inbox_policy='block', inbox_timeout=None)
+    release = threading.Event()
+    results = []
+    dispatcher.submit('c', lambda data, peer: release.wait(5), None, 'c')
+    assert wait_for(lambda: dispatcher.queue_depth('c') == 0)
+    dispatcher.submit('c', lambda data, peer: None, 1, 'c')
+    waiting = threading.Thread(target=lambda: results.append(dispatcher.submit('c', lambda data, peer: None, 2, 'c')))
+    waiting.start()
+    time.sleep(0.05)
+    dispatcher.shutdown()
+    waiting.join(1)
+    release.set()
+    assert results == [False]
+
+
+def test_slow_callback_does_not_lose_messages_over_tcp():
+    port = free_port()
+    received = []
+
+    def slow(data, peer):
+        time.sleep(0.002)
+        received.append(data)
+
+    # Waiting for room slows the client down instead of dropping
+    server = Server(port=port, default_callback=slow, inbox_size=4, inbox_policy='block', shared_memory=False)
+    client = Client('127.0.0.1', port=port, shared_memory=False)
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        for i in range(200):
+            client.send(f'message {i}')
+        assert wait_for(lambda: len(received) == 200, 10)
+        assert received == [f'message {i}' for i in range(200)]
+        assert server.stats()['callbacks']['dropped'] == 0
+    finally:
+        client.stop()
+        server.stop()
+
+
+def test_io_threads_do_not_wait_for_inboxes_by_default():
+    for server_class in (Server, SelectorServer):
+        server = server_class(port=free_port(), shared_memory=False)
+        server.start()
+        try:
+            assert server.dispatcher.inbox_policy == 'drop_oldest'
+        finally:
+            server.stop()
+    client = Client('127.0.0.1', port=free_port(), shared_memory=False)
+    assert client.dispatcher.inbox_policy == 'drop_oldest'
+    client.dispatcher.shutdown()
+
+
+def test_full_inbox_does_not_hold_the_read_lock():
+    port = free_port()
+    release = threading.Event()
+    server = Server(port=port, shared_memory=False)
+    client = Client('127.0.0.1', port=port, shared_memory=False, callback=lambda data, peer: release.wait(5),
+                    inbox_size=1, inbox_policy='block', inbox_timeout=5)
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        for i in range(4):
+            server.send(f'message {i}', '127.0.0.1')
+        # The I/O thread waits for room in the inbox, get_data() still answers
+        assert wait_for(lambda: client.dispatcher.queue_depth() == 1)
+        time.sleep(0.1)
+        assert client.read_lock.acquire(timeout=0.5)
+        client.read_lock.release()
+        assert client.get_data() is not None
+    finally:
+        release.set()
+        client.stop()
+        server.stop()
@@ -0,0 +1,170 @@
+import select
+import socket
+
+import pytest
+
+from comms_core.framing import (ChunkAssembler, FrameBuffer, FrameError, FrameWriter, FLAG_BYTES, FLAG_CHUNK,
+                                FLAG_MORE, FLAG_RPC, HEADER, IOV_MAX, WRITE_LIMIT, pack_frame, unpack_payload)
+from comms_core.metrics import ConnectionMetrics
+
+
+def drain(sock : socket.socket) -> int:
+    received = 0
+    try:
+        while True:
+            data = sock.recv(1 << 20)
+            if not data:
+                break
+            received += len(data)
+    except BlockingIOError:
+        pass
+    return received
+
+
+def receive(buffer : FrameBuffer, sock : socket.socket) -> list:
+    payloads = []
+    try:
+        while buffer.recv_into(sock, 1 << 20):
+            payloads += [payload for payload, _ in buffer.frames()]
+    except BlockingIOError:
+        pass
+    return payloads
+
+
+def test_frames_are_returned_once_complete():
+    stream = pack_frame('hello') + pack_frame(b'\x00\xff') + pack_frame([b'ab', bytearray(b'cd')])[0]
+    stream += b'abcd'
+    buffer = FrameBuffer(size=8)
+    received = []
+    # One byte at a time, the buffer grows and keeps partial headers and payloads
+    for i in range(len(stream)):
+        buffer.feed(stream[i:i + 1])
+        received += [unpack_payload(payload, flags) for payload, flags in buffer.frames()]
+    assert received == ['hello', b'\x00\xff', b'abcd']
+    assert len(buffer) == 0
+
+
+def test_oversized_frames_are_rejected():
+    buffer = FrameBuffer(max_frame_size=100)
+    buffer.feed(HEADER.pack(101, FLAG_BYTES))
+    with pytest.raises(FrameError):
+        list(buffer.frames())
+    # The length is checked before the payload arrives
+    buffer = FrameBuffer(max_frame_size=100)
+    buffer.feed(HEADER.pack(100, FLAG_BYTES) + b'x' * 100)
+    assert [payload for payload, _ in buffer.frames()] == [b'x' * 100]
+
+
+def test_writer_room_and_partial_writes():
+    sender, receiver = socket.socketpair()
+    sender.setblocking(False)
+    receiver.setblocking(False)
+    try:
+        writer = FrameWriter()
+        assert writer.room() == WRITE_LIMIT
+        writer.add(b'x' * WRITE_LIMIT)
+        assert not writer.has_room()
+        # More than the socket takes at once, and more buffers than one sendmsg call accepts
+        writer.add(b'y' * (8 << 20))
+        for _ in range(IOV_MAX + 10):
+            writer.add(b'z' * 5000)
+        buffer = FrameBuffer()
+        received = []
+        while not writer.flush(sender):
+            received += receive(buffer, receiver)
+        received += receive(buffer, receiver)
+        assert writer.partial_writes > 0
+        assert received == [b'x' * WRITE_LIMIT, b'y' * (8 << 20)] + [b'z' * 5000] * (IOV_MAX + 10)
+        assert len(writer) == 0 and writer.room() == WRITE_LIMIT
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_marks_are_returned_once_the_last_byte_was_written():
+    sender, receiver = socket.socketpair()
+    sender.setblocking(False)
+    receiver.setblocking(False)
+    try:
+        writer = FrameWriter()
+        writer.add(b'small', mark='small')
+        writer.add(b'x' * (8 << 20), mark='large')
+        assert not writer.flush(sender)
+        # The large frame is still partly pending, only the first one left the writer
+        assert writer.sent_marks() == ['small']
+        while not writer.flush(sender):
+            assert writer.sent_marks() == []
+            drain(receiver)
+        assert writer.sent_marks() == ['large']
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_bulk_marks_and_clear():
+    sender, receiver = socket.socketpair()
+    sender.setblocking(False)
+    receiver.setblocking(False)
+    try:
+        writer = FrameWriter(chunk_size=1000)
+        writer.add(b'b' * 2500, bulk=True, mark='bulk')
+        writer.flush(sender)
+        assert writer.sent_marks() == []
+        writer.flush(sender)
+        writer.flush(sender)
+        assert writer.sent_marks() == ['bulk']
+        writer.add(b'y' * (8 << 20), mark='dropped')
+        writer.flush(sender)
+        writer.clear()
+        drain(receiver)
+        writer.add(b'after', mark='after')
+        assert writer.flush(sender)
+        assert writer.sent_marks() == ['after']
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_metrics_count_the_sent_marks():
+    metrics = ConnectionMetrics()
+    metrics.on_flush([(0.0, 0), (0.5, 2)], 1.0)
+    assert metrics.messages_out == 2
+    assert metrics.enqueue_latency.count == 2
+    assert metrics.lane_latency[2].count == 1
+
+
+def test_bulk_pieces_are_reassembled_between_other_frames():
+    sender, receiver = socket.socketpair()
+    sender.setblocking(False)
+    receiver.setblocking(False)
+    try:
+        writer = FrameWriter(chunk_size=1000)
+        buffer = FrameBuffer()
+        big = bytes(range(256)) * 20
+        writer.add(big, bulk=True)
+        writer.add(b'urgent')
+        received = []
+        while True:
+            done = writer.flush(sender)
+            while select.select([receiver], [], [], 0.01)[0] and buffer.recv_into(receiver):
+                received += [payload for payload, _ in buffer.frames()]
+            if done and not writer.chunks_waiting():
+                break
+        # The small frame overtook the bulk message, which arrives whole
+        assert received == [b'urgent', big]
+        assert not buffer.in_bulk
+    finally:
+        sender.close()
+        receiver.close()
+
+
+def test_chunk_assembler():
+    assembler = ChunkAssembler(max_size=10)
+    assert assembler.add(b'plain', 0) == (b'plain', 0)
+    assert assembler.add(b'ab', FLAG_CHUNK | FLAG_MORE) is None
+    assert assembler.add(b'cd', FLAG_CHUNK | FLAG_MORE) is None
+    # The last piece carries the message's flags
+    assert assembler.add(b'ef', FLAG_CHUNK | FLAG_RPC) == (b'abcdef', FLAG_RPC)
+    assembler.add(b'x' * 8, FLAG_CHUNK | FLAG_MORE)
+    with pytest.raises(FrameError):
+        assembler.add(b'x' * 8, FLAG_CHUNK | FLAG_MORE)
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from comms_core import History
+
+
+def test_ints_keep_their_type_and_precision():
+    history = History(4)
+    big = (1 << 62) + 1
+    history.append(1.0, big)
+    history.append(2.0, 5)
+    times, values = history.window(0)
+    assert values == [big, 5]
+    assert all(type(value) is int for value in values)
+    assert history.latest() == (2.0, 5)
+
+
+def test_vectors_and_arrays_keep_their_shape():
+    history = History(4)
+    history.append(1.0, (1.0, 2.0, 3.0))
+    history.append(2.0, (3.0, 4.0, 5.0))
+    assert history.window(0)[1] == [(1.0, 2.0, 3.0), (3.0, 4.0, 5.0)]
+    assert history.interpolate(1.5) == (2.0, 3.0, 4.0)
+
+    history = History(4)
+    first = np.arange(6, dtype=np.float32).reshape(2, 3)
+    history.append(1.0, first)
+    history.append(2.0, first + 2)
+    first[0, 0] = 100
+    times, values = history.window(0)
+    assert values[0].shape == (2, 3) and values[0].dtype == np.float32
+    assert values[0][0, 0] == 0
+    assert np.array_equal(history.interpolate(1.5), np.arange(6).reshape(2, 3) + 1)
+
+
+def test_window_returns_lists_across_the_wrap_around():
+    history = History(3)
+    for i in range(5):
+        history.append(float(i), float(i) * 10)
+    times, values = history.window(0)
+    assert times == [2.0, 3.0, 4.0]
+    assert values == [20.0, 30.0, 40.0]
+    assert history.window(3.0, 3.5) == ([3.0], [30.0])
+    assert history.window(10) == ([], [])
+
+
+def test_mismatched_sample_moves_to_plain_values():
+    history = History(4)
+    history.append(1.0, 1)
+    history.append(2.0, 2.5)
+    history.append(3.0, 'stale')
+    assert history.window(0)[1] == [1, 2.5, 'stale']
+    assert type(history.window(0)[1][0]) is int
+    with pytest.raises(TypeError):
+        history.interpolate(1.5)
@@ -0,0 +1,94 @@
+import time
+
+from comms_core import Interface, InterfaceReceiver, InterfaceSender, BinaryMessage
+from comms_core.interface_sync import SYNC_KEY
+
+
+def sync(sender : InterfaceSender, receiver : InterfaceReceiver, *, ack = True) -> dict:
+    message = sender.encode()
+    assert InterfaceReceiver.is_sync(message)
+    reply = receiver.apply(message)
+    assert InterfaceSender.is_ack(reply)
+    if ack:
+        sender.acknowledge(reply)
+    return BinaryMessage.decode(message)
+
+
+def test_only_changed_keys_are_sent_once_acknowledged():
+    interface = Interface()
+    interface.x = 1.0
+    interface.y = 2.0
+    sender = InterfaceSender(interface)
+    receiver = InterfaceReceiver()
+    message = sync(sender, receiver)
+    assert message['keyframe'] and set(message['data']) == {'x', 'y'}
+    assert receiver.interface.to_dict() == {'x': 1.0, 'y': 2.0}
+    interface.x = 3.0
+    message = sync(sender, receiver)
+    assert not message['keyframe'] and set(message['data']) == {'x'} and message['removed'] == []
+    message = sync(sender, receiver)
+    assert message['data'] == {} and message['removed'] == []
+    assert receiver.interface.get_data_object('x').timestamp == interface.get_data_object('x').timestamp
+
+
+def test_unacknowledged_changes_are_sent_again():
+    interface = Interface()
+    interface.x = 1.0
+    sender = InterfaceSender(interface)
+    receiver = InterfaceReceiver()
+    sync(sender, receiver)
+    interface.x = 2.0
+    # Lost on the way
+    sender.encode()
+    message = sync(sender, receiver)
+    assert set(message['data']) == {'x'}
+    assert receiver.interface.x == 2.0
+    # An old message arriving late is ignored
+    stale = sender.encode()
+    interface.x = 3.0
+    sync(sender, receiver)
+    receiver.apply(stale)
+    assert receiver.interface.x == 3.0
+
+
+def test_keys_removed_before_they_were_acknowledged():
+    interface = Interface()
+    interface.kept = 1
+    sender = InterfaceSender(interface)
+    receiver = InterfaceReceiver()
+    sync(sender, receiver)
+    # Added and sent, then deleted before the ack came back
+    interface.deleted = 1
+    interface.expiring = 2
+    interface.set_remove_time('expiring', 0.01)
+    pending = sender.encode()
+    receiver.apply(pending)
+    assert 'deleted' in receiver.interface and 'expiring' in receiver.interface
+    del interface.deleted
+    time.sleep(0.02)
+    message = sync(sender, receiver, ack=False)
+    assert sorted(message['removed']) == ['deleted', 'expiring']
+    assert receiver.interface.to_dict() == {'kept': 1}
+    # Still reported until a version carrying the removal is acknowledged
+    message = sync(sender, receiver)
+    assert sorted(message['removed']) == ['deleted', 'expiring']
+    assert sync(sender, receiver)['removed'] == []
+
+
+def test_keyframes_converge_a_late_receiver():
+    interface = Interface()
+    interface.x = 1
+    sender = InterfaceSender(interface, keyframe_interval=3)
+    for _ in range(2):
+        sender.encode()
+    interface.y = 2
+    late = InterfaceReceiver()
+    late.interface.stale = True
+    messages = [BinaryMessage.decode(sender.encode()) for _ in range(3)]
+    # Every third message is a keyframe
+    assert [message['keyframe'] for message in messages] == [False, True, False]
+    late.apply(messages[1])
+    assert late.interface.to_dict() == {'x': 1, 'y': 2}
+    sender.force_keyframe()
+    assert BinaryMessage.decode(sender.encode())['keyframe']
+    assert messages[1][SYNC_KEY] == 4
@@ -0,0 +1,33 @@
+import logging
+
+from comms_core.logger import Logger, Payload
+
+
+def test_payload_keeps_only_the_truncated_text():
+    data = bytearray(b'a' * 1000)
+    payload = Payload(data, 20)
+    data[:] = b'b' * 1000
+    assert str(payload) == "bytearray(b'aaaaaaaa... (1000 bytes)"
+    assert str(Payload('short', 10)) == 'short'
+    assert str(Payload('x' * 50, 10)) == 'xxxxxxxxxx... (50 chars)'
+    assert str(Payload(memoryview(b'abc'), 10)) == "b'abc'"
+    assert not hasattr(payload, 'data')
+
+
+def test_log_arguments_and_level(caplog):
+    logger = Logger('TestLogger')
+    with caplog.at_level(logging.DEBUG, logger='TestLogger'):
+        logger.log('plain %s %s', args=('a', 'b'))
+        # The level is the second positional parameter, as callers have always passed it
+        logger.log('at info', logging.INFO)
+        logger.log('at %s', logging.ERROR, args=('error',))
+        logger.warning('warned %d', 3)
+        logger.info('100%')
+    assert [(record.levelno, record.getMessage()) for record in caplog.records] == [
+        (logging.DEBUG, 'plain a b'), (logging.INFO, 'at info'), (logging.ERROR, 'at error'), (logging.WARNING, 'warned 3'),
+        (logging.INFO, '100%')]
+
+
+def test_payload_is_skipped_without_debug():
+    logger = Logger('TestLoggerQuiet', level=logging.INFO)
+    assert logger.payload(b'x' * 100) is None
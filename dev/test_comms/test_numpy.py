@@ -0,0 +1,84 @@
+import socket
+import time
+
+import pytest
+
+from comms_core import BinaryMessage, Client, CustomSocketMessage, Server
+from comms_core.codec import ARRAY_ALIGNMENT, BinaryCodecError
+
+# numpy is optional
+np = pytest.importorskip('numpy')
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_arrays_round_trip():
+    data = {
+        'image': np.arange(24, dtype=np.uint8).reshape(2, 3, 4),
+        'ranges': np.linspace(0, 1, 7, dtype='>f4'),
+        'strided': np.arange(20, dtype=np.int64)[::3],
+        'empty': np.zeros((0, 3)),
+        'scalar': np.float32(1.5),
+        'label': 'scan',
+    }
+    decoded = BinaryMessage.decode(BinaryMessage.encode(data))
+    for key in ('image', 'ranges', 'strided', 'empty'):
+        assert decoded[key].dtype == data[key].dtype and np.array_equal(decoded[key], data[key]), key
+    assert decoded['scalar'] == 1.5 and decoded['label'] == 'scan'
+
+
+def test_array_buffers_are_not_copied():
+    array = np.arange(1000, dtype=np.float64)
+    buffers = BinaryMessage.encode_buffers({'a': array, 'b': 1})
+    assert isinstance(buffers, list)
+    views = [buffer for buffer in buffers if isinstance(buffer, memoryview)]
+    assert len(views) == 1 and views[0].obj is array
+    # The raw data starts aligned, the decoded array is a view over the message
+    assert len(buffers[0]) % ARRAY_ALIGNMENT == 0
+    message = b''.join(buffers)
+    assert message == BinaryMessage.encode({'a': array, 'b': 1})
+    decoded = BinaryMessage.decode(message)
+    assert not decoded['a'].flags.writeable and np.array_equal(decoded['a'], array)
+
+
+def test_unsupported_and_malformed_arrays():
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.encode({'a': np.array([object()])})
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.encode({'a': np.zeros(2, dtype=[('x', 'f4')])})
+    message = BinaryMessage.encode({'a': np.arange(10, dtype=np.int32)})
+    for end in range(2, len(message)):
+        with pytest.raises(BinaryCodecError):
+            BinaryMessage.decode(message[:end])
+    with pytest.raises(BinaryCodecError):
+        BinaryMessage.decode(message.replace(b'<i4', b'<?9'))
+
+
+def test_arrays_over_a_binary_connection():
+    port = free_port()
+    received = []
+    server = Server(port=port, shared_memory=False, default_callback=lambda data, addr: received.append(data))
+    client = Client('127.0.0.1', port=port, wire_format='binary', shared_memory=False)
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        scan = np.random.default_rng(0).random((480, 640), dtype=np.float32)
+        client.send({'scan': scan, 'seq': 1})
+        assert wait_for(lambda: received)
+        decoded = CustomSocketMessage.decode(received[0])
+        assert decoded['seq'] == 1 and np.array_equal(decoded['scan'], scan)
+    finally:
+        client.stop()
+        server.stop()
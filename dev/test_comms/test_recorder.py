@@ -0,0 +1,80 @@
+import gc
+import logging
+import os
+import weakref
+
+from comms_core.recorder import FlightRecorder, FlightLog, INBOUND, OUTBOUND
+
+
+def test_empty_log_can_be_opened(tmp_path):
+    path = str(tmp_path / 'empty.rec')
+    open(path, 'wb').close()
+    with FlightLog(path) as log:
+        assert list(log) == []
+    recorder = FlightRecorder(str(tmp_path / 'new.rec'))
+    try:
+        with FlightLog(recorder.path) as log:
+            assert list(log) == []
+    finally:
+        recorder.close()
+
+
+def test_records_are_written_by_the_writer_thread(tmp_path):
+    path = str(tmp_path / 'run.rec')
+    recorder = FlightRecorder(path, index_interval=4)
+    buffer = bytearray(b'first')
+    recorder.record(INBOUND, ('10.0.0.2', 5000), buffer)
+    # The record keeps its own copy of a buffer that is reused
+    buffer[:] = b'other'
+    for i in range(20):
+        recorder.record(OUTBOUND, 'peer', f'message {i}', topic='pose' if i % 2 else None)
+    recorder.flush()
+    with FlightLog(path) as log:
+        records = list(log)
+    assert len(records) == 21
+    assert records[0].data == b'first' and records[0].peer == '10.0.0.2:5000'
+    assert records[2].data == 'message 1' and records[2].topic == 'pose'
+    recorder.close()
+    recorder.record(INBOUND, 'peer', 'after close')
+    with FlightLog(path) as log:
+        assert len(log.index) == 6
+        assert len(list(log)) == 21
+
+
+def test_index_rebuild_uses_the_interval(tmp_path):
+    path = str(tmp_path / 'run.rec')
+    recorder = FlightRecorder(path, index_interval=4)
+    for i in range(20):
+        recorder.record(INBOUND, 'peer', str(i))
+    recorder.close()
+    os.remove(path + '.idx')
+    with FlightLog(path, index_interval=4) as log:
+        assert len(log.index) == 5
+        assert [record.data for record in log.records(start=log.index[2][0])][0] == '8'
+
+
+def test_closed_recorders_are_released_and_warn(tmp_path, caplog):
+    recorder = FlightRecorder(str(tmp_path / 'closed.rec'))
+    recorder.close()
+    with caplog.at_level(logging.WARNING, logger='FlightRecorder'):
+        recorder.record(INBOUND, 'peer', 'late')
+        recorder.record(INBOUND, 'peer', 'later')
+    assert caplog.text.count('after it was closed') == 1
+    # atexit no longer holds on to it
+    reference = weakref.ref(recorder)
+    del recorder
+    gc.collect()
+    assert reference() is None
+
+
+def test_dropped_records_are_reported(tmp_path, caplog):
+    recorder = FlightRecorder(str(tmp_path / 'full.rec'), max_pending=1)
+    with caplog.at_level(logging.WARNING, logger='FlightRecorder'):
+        for i in range(20000):
+            recorder.record(OUTBOUND, 'peer', b'x' * 100)
+        recorder.close()
+    assert recorder.dropped > 0
+    assert caplog.text.count('dropping new ones') == 1
+    assert f'{recorder.dropped} records were dropped' in caplog.text
+    with FlightLog(recorder.path) as log:
+        assert len(list(log)) == 20000 - recorder.dropped
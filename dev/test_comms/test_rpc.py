@@ -0,0 +1,75 @@
+import socket
+import time
+
+import pytest
+
+from comms_core import Client, Server
+from comms_core.framing import Frame, FLAG_RPC
+from comms_core.send_queue import LaneQueue, PRIORITY_HIGH
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_rpc_frames_are_never_evicted():
+    queue = LaneQueue(2)
+    call = Frame(b'call', FLAG_RPC)
+    queue.put(call)
+    for i in range(10):
+        queue.put(f'filler {i}')
+        queue.put(f'urgent {i}', priority=PRIORITY_HIGH)
+    assert queue.dropped == 16
+    assert [data for data, _, _ in queue.get_batch(1 << 20)][0] is call
+    queue.put(Frame(b'1', FLAG_RPC))
+    queue.put(Frame(b'2', FLAG_RPC))
+    # A full control lane rejects the frame instead of dropping a queued one
+    assert not queue.put(Frame(b'3', FLAG_RPC), block=False)
+    assert [data.data for data, _, _ in queue.get_all_by_priority()[:2]] == [b'1', b'2']
+
+
+def test_calls_get_through_a_flooded_queue():
+    port = free_port()
+    server = Server(port=port, shared_memory=False, queue_size=4)
+    client = Client('127.0.0.1', port=port, shared_memory=False, queue_size=4)
+    server.register('add', lambda a, b: a + b)
+    client.register('echo', lambda value: value)
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        futures = []
+        for i in range(20):
+            for j in range(50):
+                client.send(f'filler {i} {j}', block=False)
+                server.send(f'filler {i} {j}', '127.0.0.1', block=False)
+            futures.append(client.call('add', a=i, b=1, timeout=5))
+            futures.append(server.call('127.0.0.1', 'echo', value=i, timeout=5))
+        results = [future.result(5) for future in futures]
+        assert results[0::2] == [i + 1 for i in range(20)]
+        assert results[1::2] == list(range(20))
+    finally:
+        client.stop()
+        server.stop()
+
+
+def test_call_fails_when_its_frame_cannot_be_queued():
+    client = Client('127.0.0.1', port=free_port(), shared_memory=False, queue_size=2)
+    try:
+        # Not started, the calls wait in the queue
+        client.call('a')
+        client.call('b')
+        future = client.call('c', timeout=0.05)
+        with pytest.raises(ConnectionError):
+            future.result(1)
+    finally:
+        client.stop()
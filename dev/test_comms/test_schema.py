@@ -0,0 +1,70 @@
+import pytest
+
+from comms_core import CustomSocketMessage, Interface, Schema
+from comms_core.schema import SchemaError
+
+
+def test_round_trip_and_presence():
+    schema = Schema(901, {'x': float, 'heading': 'f', 'mode': int, 'armed': bool, 'pose': (float, 3),
+                          'cells': ['H', 2], 'name': str, 'blob': bytes})
+    data = {'x': 1.5, 'heading': 0.5, 'mode': -3, 'armed': True, 'pose': (1.0, 2.0, 3.0), 'cells': [7, 8],
+            'name': 'boat', 'blob': b'\x00\x01'}
+    assert schema.decode(schema.encode(data)) == data
+    # Missing and None fields are left out of the decoded message
+    partial = schema.encode({'x': 2.0, 'name': None, 'pose': None})
+    assert schema.decode(partial) == {'x': 2.0}
+    # Registered schemas are found from the message
+    assert Schema.decode_message(partial) == {'x': 2.0}
+    assert CustomSocketMessage.decode(schema.encode(data)) == data
+
+
+def test_interfaces():
+    schema = Schema(902, [('x', float), ('name', str)])
+    interface = Interface()
+    interface.x = 3.0
+    interface.name = 'boat'
+    message = schema.encode(interface)
+    assert message == schema.encode({'x': 3.0, 'name': 'boat'})
+    decoded = schema.decode(message, as_interface=True)
+    assert decoded.x == 3.0 and decoded.name == 'boat'
+
+
+def test_many_fields_use_a_wider_bitmap():
+    fields = {f'f{i}': int for i in range(40)}
+    schema = Schema(903, fields)
+    data = {f'f{i}': i for i in range(0, 40, 3)}
+    assert schema.decode(schema.encode(data)) == data
+
+
+def test_invalid_declarations():
+    with pytest.raises(SchemaError):
+        Schema(1 << 16, {'x': float})
+    with pytest.raises(SchemaError):
+        Schema(904, {'x': complex})
+    with pytest.raises(SchemaError):
+        Schema(904, {'x': (float, 0)})
+    with pytest.raises(SchemaError):
+        Schema(904, {'x': (str, 2)})
+    with pytest.raises(SchemaError):
+        Schema(904, {f'f{i}': int for i in range(65)})
+    Schema(905, {'x': float})
+    with pytest.raises(SchemaError):
+        Schema(905, {'x': int})
+    # The same declaration can be registered again
+    Schema(905, {'x': float})
+
+
+def test_mismatched_and_malformed_messages():
+    schema = Schema(906, {'x': float, 'pose': (float, 2), 'name': str})
+    with pytest.raises(SchemaError):
+        schema.encode({'x': 'not a float'})
+    with pytest.raises(SchemaError):
+        schema.encode({'pose': (1.0,)})
+    message = schema.encode({'x': 1.0, 'pose': (1.0, 2.0), 'name': 'boat'})
+    for end in range(len(message)):
+        with pytest.raises(SchemaError):
+            schema.decode(message[:end])
+    with pytest.raises(SchemaError):
+        schema.decode(message.replace(b'boat', b'\xff\xfe\xfd\xfc'))
+    with pytest.raises(SchemaError):
+        Schema.decode_message(b'\xb6\xff\xfe\x00')
@@ -0,0 +1,83 @@
+import socket
+import time
+
+from comms_core import Client, SelectorServer, CustomSocketMessage
+from comms_core.framing import FrameBuffer, pack_frame
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_one_loop_serves_every_client():
+    port = free_port()
+    received = []
+    server = SelectorServer(port=port, shared_memory=False, default_callback=lambda data, addr: received.append(data))
+    replies = {}
+    clients = []
+    server.start()
+    try:
+        for i in range(8):
+            client = Client('127.0.0.1', port=port, shared_memory=False, wire_format='binary' if i % 2 else 'text',
+                            callback=lambda data, addr, i=i: replies.setdefault(i, []).append(data))
+            client.start()
+            clients.append(client)
+        assert wait_for(lambda: all(client.init and client.session_ready for client in clients))
+        for i, client in enumerate(clients):
+            for j in range(20):
+                client.send(f'{i}:{j}')
+        assert wait_for(lambda: len(received) == 160)
+        for i in range(8):
+            assert [data for data in received if data.startswith(f'{i}:')] == [f'{i}:{j}' for j in range(20)]
+        # Dicts are encoded once per wire format
+        assert server.broadcast({'speed': 1.5, 'mode': 'auto'}) == 8
+        assert wait_for(lambda: len(replies) == 8)
+        for i in range(8):
+            assert CustomSocketMessage.decode(replies[i][0]) == {'speed': 1.5, 'mode': 'auto'}
+        assert server.stats()['loop_time']['count'] > 0
+    finally:
+        for client in clients:
+            client.stop()
+        server.stop()
+
+
+def test_disconnected_and_malformed_clients_are_dropped():
+    port = free_port()
+    received = []
+    server = SelectorServer(port=port, shared_memory=False, default_callback=lambda data, addr: received.append(data))
+    server.start()
+    try:
+        closed = socket.create_connection(('127.0.0.1', port))
+        assert wait_for(lambda: len(server.connections) == 1)
+        closed.close()
+        assert wait_for(lambda: len(server.connections) == 0)
+        # A length above the maximum frame size
+        garbage = socket.create_connection(('127.0.0.1', port))
+        assert wait_for(lambda: len(server.connections) == 1)
+        garbage.sendall(b'\xff\xff\xff\xff\x00')
+        assert wait_for(lambda: len(server.connections) == 0)
+        garbage.close()
+        # The loop kept running
+        raw = socket.create_connection(('127.0.0.1', port))
+        raw.sendall(pack_frame('hello'))
+        assert wait_for(lambda: received == ['hello'])
+        server.send('reply', raw.getsockname())
+        buffer = FrameBuffer()
+        raw.settimeout(2)
+        frames = []
+        while not frames:
+            buffer.recv_into(raw)
+            frames = list(buffer.frames())
+        assert frames[0][0] == b'reply'
+        raw.close()
+    finally:
+        server.stop()
@@ -0,0 +1,90 @@
+import socket
+import time
+
+from comms_core import Client, Server, SelectorServer, PRIORITY_HIGH, PRIORITY_BULK
+from comms_core.framing import WRITE_LIMIT
+from comms_core.send_queue import LaneQueue
+
+
+def test_get_batch_stops_at_max_bytes():
+    queue = LaneQueue(100)
+    for i in range(10):
+        queue.put(b'x' * 1000)
+    batch = queue.get_batch(3500)
+    assert len(batch) == 3
+    assert len(queue) == 7
+    # At least one message, even if it is larger than max_bytes
+    assert len(queue.get_batch(10)) == 1
+
+
+def test_get_batch_takes_one_bulk_message_after_the_other_lanes():
+    queue = LaneQueue(100)
+    queue.put(b'big 1', priority=PRIORITY_BULK)
+    queue.put(b'big 2', priority=PRIORITY_BULK)
+    queue.put('normal')
+    queue.put('urgent', priority=PRIORITY_HIGH)
+    assert [data for data, _, _ in queue.get_batch(1 << 20)] == ['urgent', 'normal', b'big 1']
+    assert queue.get_batch(1 << 20, bulk=False) == []
+    assert [data for data, _, _ in queue.get_batch(1 << 20)] == [b'big 2']
+
+
+def test_get_batch_keeps_coalesce_keys_consistent():
+    queue = LaneQueue(100, 'coalesce')
+    queue.put('a1', key='a')
+    queue.put('b1', key='b')
+    assert [data for data, _, _ in queue.get_batch(2)] == ['a1']
+    queue.put('a2', key='a')
+    queue.put('b2', key='b')
+    assert queue.get_all() == ['b2', 'a2']
+
+
+def _fill(send, count = 400):
+    payload = b'x' * 100_000
+    for _ in range(count):
+        send(payload)
+        time.sleep(0.001)
+    time.sleep(0.3)
+
+
+def test_client_does_not_buffer_for_a_stalled_server():
+    listener = socket.create_server(('127.0.0.1', 0))
+    port = listener.getsockname()[1]
+    client = Client('127.0.0.1', port=port, queue_size=10, shared_memory=False)
+    client.start()
+    conn, _ = listener.accept()
+    try:
+        deadline = time.time() + 5
+        while not client.init and time.time() < deadline:
+            time.sleep(0.01)
+        _fill(lambda data: client.send(data, block=False))
+        # The queue's bound and policy apply, the writer holds at most about WRITE_LIMIT
+        assert client.queue_depth() == 10
+        assert client.send_queue.dropped > 0
+        assert len(client.writer) < WRITE_LIMIT + 100_000
+    finally:
+        client.stop()
+        conn.close()
+        listener.close()
+
+
+def test_servers_do_not_buffer_for_a_stalled_client():
+    for server_class in (Server, SelectorServer):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        server = server_class(port=port, queue_size=10, shared_memory=False)
+        server.start()
+        reader = socket.create_connection(('127.0.0.1', port))
+        try:
+            deadline = time.time() + 5
+            while not server.connections and time.time() < deadline:
+                time.sleep(0.01)
+            addr = list(server.connections)[0]
+            _fill(lambda data: server.send(data, addr))
+            info = server.connections[addr]
+            assert len(info['send_queue']) == 10
+            assert info['send_queue'].dropped > 0
+            assert len(info['writer']) < WRITE_LIMIT + 100_000
+        finally:
+            reader.close()
+            server.stop()
@@ -0,0 +1,179 @@
+import socket
+import time
+from threading import Thread
+
+from comms_core import Client, Server, SelectorServer, PRIORITY_NORMAL, PRIORITY_BULK
+from comms_core.handshake import control_frame
+from comms_core.session import Session, parse_count
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def drop_connections(server):
+    with server.lock:
+        for info in server.connections.values():
+            info['conn'].shutdown(socket.SHUT_RDWR)
+
+
+def test_retransmit_buffer():
+    session = Session('id', retransmit_size=3)
+    for data in ('a', 'b', control_frame('ack', '1'), 'c'):
+        session.on_sent(data)
+    session.on_sent(b'big', PRIORITY_BULK)
+    # Control frames are not numbered, 'a' was pushed out of the buffer
+    assert session.sent == 4
+    session.on_ack(2)
+    # A count above what was sent must not discard anything
+    session.on_ack(100)
+    assert len(session.retransmit) == 2
+    assert session.unacknowledged(2) == [('c', PRIORITY_NORMAL), (b'big', PRIORITY_BULK)]
+    assert session.lost == 0
+    # The resent frames are numbered again as they are written
+    assert session.sent == 2 and not session.retransmit
+    session.on_sent('c')
+    assert session.unacknowledged(0) == [('c', PRIORITY_NORMAL)] and session.lost == 2
+    session.on_sent('d')
+    assert session.restart() == [('d', PRIORITY_NORMAL)] and session.sent == 0
+
+
+def test_parse_count():
+    assert parse_count('12') == 12
+    assert parse_count('0') == 0
+    for argument in ('', 'x', '-1', '1.5', None):
+        assert parse_count(argument) is None
+
+
+def test_messages_survive_dropped_connections():
+    for server_class in (Server, SelectorServer):
+        port = free_port()
+        to_server, to_client = [], []
+        server = server_class(port=port, shared_memory=False, default_callback=lambda data, addr: to_server.append(data))
+        client = Client('127.0.0.1', port=port, shared_memory=False, callback=lambda data, addr: to_client.append(data))
+        server.start()
+        client.start()
+        try:
+            assert wait_for(lambda: client.init and client.session_ready)
+            for i in range(300):
+                client.send(f'c{i}')
+                server.send(f's{i}', '127.0.0.1')
+                if i % 100 == 50:
+                    drop_connections(server)
+                time.sleep(0.001)
+            expected_server = [f'c{i}' for i in range(300)]
+            expected_client = [f's{i}' for i in range(300)]
+            assert wait_for(lambda: to_server == expected_server and to_client == expected_client), server_class
+            assert client.stats()['reconnects'] >= 1
+        finally:
+            client.stop()
+            server.stop()
+
+
+def test_new_client_is_not_held_by_a_parked_session():
+    port = free_port()
+    server = Server(port=port, shared_memory=False)
+    server.start()
+    first = Client('127.0.0.1', port=port, shared_memory=False)
+    first.start()
+    second = None
+    try:
+        assert wait_for(lambda: first.init and first.session_ready)
+        first.stop()
+        assert wait_for(lambda: len(server.parked) == 1)
+        received = []
+        second = Client('127.0.0.1', port=port, shared_memory=False, resume=False,
+                        callback=lambda data, addr: received.append(time.monotonic()))
+        second.start()
+        assert wait_for(lambda: second.init and len(server.connections) == 1)
+        sent = time.monotonic()
+        server.send('hello', list(server.connections)[0])
+        assert wait_for(lambda: received)
+        assert received[0] - sent < 0.3
+    finally:
+        if second is not None:
+            second.stop()
+        first.stop()
+        server.stop()
+
+
+def test_invalid_counts_are_ignored():
+    port = free_port()
+    received = []
+    server = Server(port=port, shared_memory=False, default_callback=lambda data, addr: received.append(data))
+    client = Client('127.0.0.1', port=port, shared_memory=False, callback=lambda data, addr: received.append(data))
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        client._write_control(control_frame('ack', 'garbage'))
+        with server.lock:
+            addr = list(server.connections)[0]
+            server.connections[addr]['writer'].add(control_frame('ack', '-3'))
+        server._on_enqueue(addr)
+        client.send('to server')
+        server.send('to client', addr)
+        assert wait_for(lambda: sorted(received) == ['to client', 'to server'])
+        assert client.stats()['reconnects'] == 0
+    finally:
+        client.stop()
+        server.stop()
+
+
+def test_bulk_messages_are_resent_in_pieces():
+    for server_class in (Server, SelectorServer):
+        port = free_port()
+        to_server, to_client = [], []
+        server = server_class(port=port, shared_memory=False, default_callback=lambda data, addr: to_server.append(data))
+        client = Client('127.0.0.1', port=port, shared_memory=False, callback=lambda data, addr: to_client.append(data))
+        server.start()
+        client.start()
+        try:
+            assert wait_for(lambda: client.init and client.session_ready)
+            big = b'm' * (1 << 20)
+            for i in range(6):
+                client.send(big + bytes([i]), priority=PRIORITY_BULK)
+                server.send(big + bytes([i]), '127.0.0.1', priority=PRIORITY_BULK)
+                client.send(f'c{i}')
+                server.send(f's{i}', '127.0.0.1')
+                if i in (1, 4):
+                    drop_connections(server)
+            assert wait_for(lambda: len(to_server) == 12 and len(to_client) == 12, 10), server_class
+            # Each side gets every message once, the small ones in order
+            assert sorted(m for m in to_server if isinstance(m, bytes)) == [big + bytes([i]) for i in range(6)]
+            assert [m for m in to_server if isinstance(m, str)] == [f'c{i}' for i in range(6)]
+            assert sorted(m for m in to_client if isinstance(m, bytes)) == [big + bytes([i]) for i in range(6)]
+            assert [m for m in to_client if isinstance(m, str)] == [f's{i}' for i in range(6)]
+            assert client.stats()['reconnects'] >= 1
+        finally:
+            client.stop()
+            server.stop()
+
+
+def test_resent_messages_wait_for_the_write_lock():
+    client = Client('127.0.0.1', port=free_port(), shared_memory=False)
+    for data in ('a', 'b'):
+        client.session.on_sent(data)
+    client.write_lock.acquire()
+    resend = Thread(target=client._on_session, args=('0',), daemon=True)
+    resend.start()
+    time.sleep(0.1)
+    # Nothing was taken from the retransmit buffer while another thread writes
+    assert resend.is_alive() and len(client.session.retransmit) == 2
+    client.write_lock.release()
+    resend.join(1)
+    assert not resend.is_alive() and client.session.sent == 2
+
+
+def test_half_constructed_client_can_be_collected():
+    # __del__ runs even when the constructor failed before the socket was created
+    Client.__new__(Client).__del__()
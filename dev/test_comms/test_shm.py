@@ -0,0 +1,96 @@
+import time
+
+import pytest
+
+from comms_core.framing import FLAG_BYTES
+from comms_core.shm import SHM_AVAILABLE, RECORD_HEADER, ShmLink, ShmReader, ShmRing, ShmWriter
+
+pytestmark = pytest.mark.skipif(not SHM_AVAILABLE, reason='shared memory rings are not supported here')
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def make_pair(size = 4096):
+    ring = ShmRing.create(size)
+    return ring, ShmRing.attach(ring.name)
+
+
+def test_records_wrap_around():
+    producer, consumer = make_pair()
+    try:
+        received = []
+        for i in range(500):
+            payload = bytes([i % 256]) * (i % 300 + 1)
+            assert producer.write([memoryview(payload)], len(payload), FLAG_BYTES)
+            record = consumer.read()
+            received.append(record)
+            assert record == (payload, FLAG_BYTES, False)
+        # Far more bytes than the ring holds went through it
+        assert sum(len(payload) for payload, _, _ in received) > 10 * producer.capacity
+        assert consumer.read() is None
+    finally:
+        consumer.close()
+        producer.close()
+
+
+def test_full_ring_rejects_records_until_read():
+    producer, consumer = make_pair()
+    try:
+        payload = memoryview(b'x' * 500)
+        written = 0
+        while producer.write([payload], len(payload), 0):
+            written += 1
+        assert written == producer.capacity // (RECORD_HEADER.size + 504)
+        assert len(producer) > producer.capacity - 512
+        assert consumer.read() is not None
+        assert producer.write([payload], len(payload), 0)
+        for _ in range(written):
+            assert consumer.read() == (bytes(payload), 0, False)
+        assert consumer.read() is None
+    finally:
+        consumer.close()
+        producer.close()
+
+
+def test_large_messages_are_chunked_and_reassembled():
+    producer, consumer = make_pair()
+    frames = []
+    reader = ShmReader(consumer, frames.extend)
+    reader.start()
+    try:
+        writer = ShmWriter(producer)
+        messages = [bytes([i]) * size for i, size in enumerate((10, 5000, 30000, 1, 12345))]
+        for message in messages:
+            writer.add(message)
+        while not writer.flush():
+            time.sleep(0.001)
+        # Bulk messages go in FLAG_CHUNK pieces behind the others
+        writer.add(b'b' * 20000, bulk=True)
+        writer.add(b'after')
+        while not writer.flush():
+            time.sleep(0.001)
+        assert wait_for(lambda: len(frames) == 7)
+        assert frames[:5] == [(message, FLAG_BYTES) for message in messages]
+        assert frames[5:] == [(b'after', FLAG_BYTES), (b'b' * 20000, FLAG_BYTES)]
+    finally:
+        reader.stop()
+        consumer.close()
+        producer.close()
+
+
+def test_reader_stops_and_closes_the_rings():
+    link = ShmLink.create(4096, lambda frames: None)
+    link.start()
+    exited = time.time()
+    link.close()
+    link.reader.thread.join(2)
+    assert not link.reader.thread.is_alive()
+    assert time.time() - exited < 1
+    assert link.closed and link.recv_ring.buf is None
+    # Writing to a closed ring is refused instead of failing
+    assert not link.send_ring.write([memoryview(b'x')], 1, 0)
@@ -0,0 +1,86 @@
+import socket
+import time
+
+from comms_core import Client, Server
+
+
+def wait_for(condition, timeout = 5.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def test_subscribe_is_not_dropped_by_a_full_queue():
+    port = free_port()
+    server = Server(port=port, shared_memory=False)
+    client = Client('127.0.0.1', port=port, queue_size=2, shared_memory=False)
+    received = []
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        # Stuck behind a burst of messages, the subscription used to be evicted from the queue
+        for i in range(50):
+            client.send(f'filler {i}')
+        client.subscribe('pose', lambda data, peer: received.append(data))
+        for i in range(50):
+            client.send(f'filler {i}')
+        assert wait_for(lambda: server.publish('pose', 'x=1') == 1)
+        assert wait_for(lambda: 'x=1' in received)
+        client.unsubscribe('pose')
+        assert wait_for(lambda: server.publish('pose', 'x=2') == 0)
+    finally:
+        client.stop()
+        server.stop()
+
+
+def test_resumed_session_keeps_the_current_subscriptions():
+    port = free_port()
+    server = Server(port=port, shared_memory=False)
+    client = Client('127.0.0.1', port=port, shared_memory=False)
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        client.subscribe('a')
+        client.subscribe('b')
+        assert wait_for(lambda: server.publish('b', 'hi') == 1)
+        client.unsubscribe('b')
+        assert wait_for(lambda: server.publish('b', 'hi') == 0)
+        with server.lock:
+            for info in server.connections.values():
+                info['conn'].shutdown(socket.SHUT_RDWR)
+        assert wait_for(lambda: client.stats()['reconnects'] >= 1 and client.session_ready)
+        assert wait_for(lambda: server.publish('a', 'hi') == 1)
+        assert server.publish('b', 'hi') == 0
+    finally:
+        client.stop()
+        server.stop()
+
+
+def test_only_the_first_frame_is_a_handshake():
+    port = free_port()
+    received = []
+    server = Server(port=port, shared_memory=False, default_callback=lambda data, addr: received.append(data))
+    client = Client('127.0.0.1', port=port, wire_format='binary', shared_memory=False)
+    server.start()
+    client.start()
+    try:
+        assert wait_for(lambda: client.init and client.session_ready)
+        addr = list(server.connections)[0]
+        # Payloads that look like a handshake are data once the connection is established
+        client.send('Client: spoofed;format=text')
+        client.send('note: Client: inside')
+        assert wait_for(lambda: len(received) == 2)
+        assert received == ['Client: spoofed;format=text', 'note: Client: inside']
+        assert server.connections[addr]['wire_format'] == 'binary'
+    finally:
+        client.stop()
+        server.stop()
@@ -0,0 +1,96 @@
+import time
+
+from comms_core.udp import UDPChannel, DATAGRAM_HEADER, DATAGRAM_MAGIC
+
+
+def wait_for(condition, timeout = 2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def make_pair():
+    received = []
+    receiver = UDPChannel(bind_address=('127.0.0.1', 0), callback=lambda stream, data, addr: received.append((stream, data)))
+    sender = UDPChannel(bind_address=('127.0.0.1', 0))
+    receiver.start()
+    return receiver, sender, received
+
+
+def test_malformed_datagrams_are_dropped():
+    receiver, sender, received = make_pair()
+    try:
+        garbage = [
+            DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, 0, 1, 1, 5, 2, 1) + b'sx',      # index past the count
+            DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, 0, 1, 2, 0, 1, 200) + b'short',  # name longer than the datagram
+            DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, 0, 1, 3, 0, 1, 2) + b'\xff\xfe',  # stream name is not utf-8
+            DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, 0, 1, 4, 0, 1, 1) + b's\xff',    # text payload is not utf-8
+        ]
+        for datagram in garbage:
+            sender.sock.sendto(datagram, receiver.local_address)
+        assert wait_for(lambda: receiver.dropped == len(garbage))
+        # The reader thread survived
+        sender.send('s', 'still alive', receiver.local_address)
+        assert wait_for(lambda: received == [('s', 'still alive')])
+    finally:
+        receiver.stop()
+        sender.stop()
+
+
+def test_fragment_count_must_match():
+    receiver, sender, received = make_pair()
+    try:
+        sender.sock.sendto(DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, 0, 1, 1, 0, 3, 1) + b'sa', receiver.local_address)
+        sender.sock.sendto(DATAGRAM_HEADER.pack(DATAGRAM_MAGIC, 0, 1, 1, 1, 2, 1) + b'sb', receiver.local_address)
+        assert wait_for(lambda: receiver.dropped == 1)
+        assert received == []
+    finally:
+        receiver.stop()
+        sender.stop()
+
+
+def test_callback_errors_do_not_stop_the_reader():
+    receiver = UDPChannel(bind_address=('127.0.0.1', 0), callback=lambda stream, data, addr: 1 / 0)
+    sender = UDPChannel(bind_address=('127.0.0.1', 0))
+    receiver.start()
+    try:
+        sender.send('s', 'a', receiver.local_address)
+        sender.send('s', 'b', receiver.local_address)
+        assert wait_for(lambda: receiver.get_data('s') == 'b')
+    finally:
+        receiver.stop()
+        sender.stop()
+
+
+def test_restarted_peer_is_not_dropped_as_stale():
+    receiver, sender, received = make_pair()
+    try:
+        for i in range(50):
+            sender.send('s', f'old {i}', receiver.local_address)
+        assert wait_for(lambda: receiver.get_data('s') == 'old 49')
+        address = sender.local_address
+        sender.stop()
+        # Same port, sequence numbers start over
+        sender = UDPChannel(bind_address=address)
+        sender.send('s', 'new 0', receiver.local_address)
+        assert wait_for(lambda: receiver.get_data('s') == 'new 0')
+    finally:
+        receiver.stop()
+        sender.stop()
+
+
+def test_get_data_returns_the_latest_peer():
+    receiver, first, _ = make_pair()
+    second = UDPChannel(bind_address=('127.0.0.1', 0))
+    try:
+        first.send('s', 'from first', receiver.local_address)
+        assert wait_for(lambda: receiver.get_data('s') == 'from first')
+        second.send('s', 'from second', receiver.local_address)
+        assert wait_for(lambda: receiver.get_data('s') == 'from second')
+        first.send('s', 'first again', receiver.local_address)
+        assert wait_for(lambda: receiver.get_data('s') == 'first again')
+    finally:
+        receiver.stop()
+        first.stop()
+        second.stop()